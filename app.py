@@ -1,8 +1,109 @@
-from fastapi import FastAPI
+import os
+import json
+import math
+import logging
+from typing import List
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Header
 import uvicorn
-from search import lookup
-from fastapi.responses import JSONResponse
-app = FastAPI()
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from search import lookup, lookup_async, warm_caches, options, answer_of, MusicBrainzUnavailable
+from sql import db_init, db_dispose, async_db_dispose, get_db, get_async_db, db_pool_metrics
+from mb_client import mb_async
+from query_cache import query_cache, backfill_query_cache
+from discography import discographies
+from recording_index import local_index
+from ratelimit import mb_limiter, mb_breaker
+from pager import page_stats
+from metrics import metrics, histogram_samples, content_type
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from batch import lookup_batch, batch_options
+from write_behind import write_behind
+from cache_sync import cache_sync
+from catalogue import catalogue_options, start_in_background
+from response_cache import response_cache, CachedResponse
+from search_log import search_log_maintenance
+from ranking import candidate_cache
+
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    db_init()
+    backfill_query_cache()
+    try:
+        logger.info("Warmed caches: %s", warm_caches())
+    except Exception as e:
+        # A cold cache is only slower, the worker still serves requests.
+        logger.exception("Warming caches failed")
+    cache_sync.start()
+    search_log_maintenance.start()
+    if catalogue_options.get("on_startup"):
+        start_in_background()
+    yield
+    search_log_maintenance.stop()
+    cache_sync.stop()
+    write_behind.stop()
+    await mb_async.aclose()
+    await async_db_dispose()
+    db_dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+logger = logging.getLogger(__name__)
+
+
+def search_response(title: str, result: str, http_status_code: int, headers: dict = None) -> Response:
+    # A 204 must not carry a body, HTTP servers and clients reject or misread one.
+    if http_status_code == 204:
+        return Response(status_code=http_status_code, headers=headers)
+    return JSONResponse(status_code=http_status_code,
+                        content={title: result},
+                        headers=headers)
+
+
+def unavailable_response(title: str, error: MusicBrainzUnavailable) -> Response:
+    """
+    Answer a search MusicBrainz could not serve: with the last cached result marked stale, or a 503 to retry later.
+    """
+    if error.stale is not None:
+        result, http_status_code = error.stale
+        return search_response(title, result, http_status_code, headers={"Warning": '110 - "Response is Stale"'})
+    return search_response(title, "MusicBrainz is unavailable", 503,
+                           headers={"Retry-After": str(max(math.ceil(error.retry_after), 1)),
+                                    "Cache-Control": "no-store"})
+
+
+def cached_search_response(title: str, entry: CachedResponse, if_none_match: str = None) -> Response:
+    """
+    Answer a repeated search from the response cache: 304 when the client holds the answer already. Only the
+    searches table entry is queued, nothing else touches the database.
+    """
+    write_behind.put_search(entry.artist_mbid, title, entry.track)
+    headers = response_cache.headers(entry)
+    if response_cache.not_modified(entry, if_none_match):
+        return Response(status_code=304, headers=headers)
+    if entry.status == 204:
+        return Response(status_code=204, headers=headers)
+    return Response(content=entry.body, status_code=entry.status, media_type="application/json", headers=headers)
+
+
+def answer_search(title: str, artist: str, result: str, http_status_code: int, if_none_match: str = None) -> Response:
+    """
+    Build the answer to a search from lookup() and keep it in the response cache, with its ETag and Cache-Control.
+    """
+    response = search_response(title, result, http_status_code)
+    if http_status_code not in (200, 201, 204):
+        return response
+    answer = answer_of(title, artist)
+    if answer is None:
+        return response
+    entry = response_cache.put(artist, title, http_status_code, response.body, *answer)
+    if response_cache.not_modified(entry, if_none_match):
+        return Response(status_code=304, headers=response_cache.headers(entry))
+    response.headers.update(response_cache.headers(entry))
+    return response
 
 
 @app.get("/")
@@ -10,24 +111,195 @@ def load_home():
     return {"homepage": True}
 
 
-@app.get("/search", status_code=200)
-def search_song(title: str):
+def search_song(title: str, artist: str = None, if_none_match: str = Header(None),
+                session: Session = Depends(get_db)):
+    artist = artist or options.get("artist")
+    cached = response_cache.get(artist, title)
+    if cached is not None:
+        return cached_search_response(title, cached, if_none_match)
+    result = str()
+    http_status_code = int
+    unavailable = None
+    try:
+        with metrics.stage("request"):
+            result, http_status_code = lookup(title=title, session=session, artist=artist)
+    except MusicBrainzUnavailable as e:
+        unavailable = e
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        logger.exception("Search for %r failed", title)
+        result = "Failed"
+        http_status_code = 500
+    finally:
+        if unavailable is not None:
+            return unavailable_response(title, unavailable)
+        return answer_search(title, artist, result, http_status_code, if_none_match)
+
+
+async def search_song_async(title: str, artist: str = None, if_none_match: str = Header(None),
+                            session: AsyncSession = Depends(get_async_db)):
+    artist = artist or options.get("artist")
+    cached = response_cache.get(artist, title)
+    if cached is not None:
+        return cached_search_response(title, cached, if_none_match)
     result = str()
     http_status_code = int
+    unavailable = None
     try:
-        result, http_status_code = lookup(title=title)
+        with metrics.stage("request"):
+            result, http_status_code = await lookup_async(title=title, session=session, artist=artist)
+    except MusicBrainzUnavailable as e:
+        unavailable = e
     except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        logger.exception("Search for %r failed", title)
         result = "Failed"
         http_status_code = 500
     finally:
-        return JSONResponse(status_code=http_status_code,
-                            content={title: result})
+        if unavailable is not None:
+            return unavailable_response(title, unavailable)
+        return answer_search(title, artist, result, http_status_code, if_none_match)
+
+
+# MB_ASYNC=false switches /search back to the threadpool-based synchronous implementation.
+app.add_api_route("/search",
+                  search_song_async if options.get("async_mode") else search_song,
+                  methods=["GET"],
+                  status_code=200)
+
+
+class BatchSearch(BaseModel):
+    titles: List[str] = Field(min_length=1, max_length=batch_options.get("max_titles"))
+    artist: str = None
+
+
+@app.post("/search/batch")
+async def search_batch(batch: BatchSearch):
+    """
+    Resolve many titles at once. Streams one JSON line {"title", "status", "result"} per title as each one completes,
+    status being the one GET /search would answer with.
+    """
+    async def ndjson_lines():
+        async for line in lookup_batch(batch.titles, artist=batch.artist):
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics/db")
+def database_pool_metrics():
+    return db_pool_metrics()
+
+
+@app.get("/metrics/upstream")
+def upstream_metrics():
+    return {"pages": page_stats.as_dict(),
+            "rate_limiter": {"acquired": mb_limiter.acquired, "refused": mb_limiter.refused,
+                             "wait_seconds_total": round(mb_limiter.wait_seconds_total, 6)},
+            "circuit_breaker": mb_breaker.stats()}
+
+
+@app.get("/metrics/cache")
+def cache_metrics():
+    return {"query_cache": query_cache.stats(),
+            "discographies": discographies.stats(),
+            "local_index": local_index.stats(),
+            "write_behind": write_behind.stats(),
+            "cache_sync": cache_sync.stats(),
+            "responses": response_cache.stats(),
+            "candidates": candidate_cache.stats()}
+
+
+def collect_application_metrics():
+    """
+    Export the statistics kept by the pool, pager, caches and rate limiter as Prometheus metric families.
+    """
+    pool = db_pool_metrics()
+    yield "mb_db_pool_connections", "gauge", "Connections of the shared pool by state", \
+        [("", {"state": state}, pool[state]) for state in ("checked_in", "checked_out", "overflow") if state in pool]
+    yield "mb_db_pool_wait_seconds_total", "counter", "Time spent waiting for a pooled connection", \
+        [("", {}, pool["wait_seconds_total"])]
+    yield "mb_db_pool_timeouts_total", "counter", "Pool checkouts that timed out", [("", {}, pool["timeouts"])]
+
+    pages = page_stats.as_dict()
+    yield "mb_pages_per_lookup", "histogram", "MusicBrainz pages fetched per paginated search", \
+        histogram_samples(page_stats.buckets + (float("inf"),), pages["histogram"].values(),
+                          pages["pages_used"] + pages["pages_discarded"])
+    yield "mb_pages_total", "counter", "MusicBrainz pages fetched, by use", \
+        [("", {"use": "used"}, pages["pages_used"]), ("", {"use": "discarded"}, pages["pages_discarded"])]
+
+    cache = query_cache.stats()
+    yield "mb_query_cache_lookups_total", "counter", "Query result cache lookups, by outcome", \
+        [("", {"result": result}, cache[result]) for result in ("memory_hits", "db_hits", "misses")]
+    yield "mb_query_cache_stale_hits_total", "counter", "Expired results served while MusicBrainz was unavailable", \
+        [("", {}, cache["stale_hits"])]
+    yield "mb_query_cache_negative_hits_total", "counter", "Query result cache hits on a cached no match", \
+        [("", {}, cache["negative_hits"])]
+    yield "mb_query_cache_hit_ratio", "gauge", "Share of query result cache lookups that hit", \
+        [("", {}, cache["hit_ratio"])]
+    responses = response_cache.stats()
+    yield "mb_response_cache_lookups_total", "counter", "Response cache lookups of /search, by outcome", \
+        [("", {"result": result}, responses[result]) for result in ("hits", "misses")]
+    yield "mb_response_not_modified_total", "counter", "Searches answered with 304 Not Modified", \
+        [("", {}, responses["not_modified"])]
+    candidates = candidate_cache.stats()
+    yield "mb_ranked_lookups_total", "counter", "Paginated searches, by how ranking stopped them", \
+        [("", {"stop": stop}, candidates[stop]) for stop in ("confident", "exhausted")]
+    yield "mb_candidate_cache_lookups_total", "counter", "Lookups of the ranked candidates of a query, by outcome", \
+        [("", {"result": result}, candidates[result]) for result in ("hits", "misses")]
+    index = local_index.stats()
+    yield "mb_local_index_lookups_total", "counter", "Local recording index lookups, by outcome", \
+        [("", {"result": result}, index[result]) for result in ("hits", "misses")]
+    for cache_name, lru in (("query_cache", cache["memory"]), ("discographies", discographies.stats()),
+                            ("response_cache", responses["memory"]), ("candidate_cache", candidates["memory"])):
+        yield f"mb_{cache_name}_memory_entries", "gauge", "Entries of the in-process LRU", \
+            [("", {}, lru["entries"])]
+        yield f"mb_{cache_name}_memory_evictions_total", "counter", "Evictions from the in-process LRU", \
+            [("", {}, lru["evictions"])]
+
+    writes = write_behind.stats()
+    yield "mb_write_queue_depth", "gauge", "Rows waiting in the write-behind queue", [("", {}, writes["depth"])]
+    yield "mb_write_queue_rows_total", "counter", "Rows taken by the write-behind queue, by outcome", \
+        [("", {"result": result}, writes[result]) for result in ("written", "dropped", "failed", "retried")]
+    yield "mb_write_queue_batches_total", "counter", "Batches written by the write-behind queue", \
+        [("", {}, writes["batches"])]
+    sync = cache_sync.stats()
+    yield "mb_cache_events_total", "counter", "Cache invalidations shared with other workers, by direction", \
+        [("", {"direction": direction}, sync[direction]) for direction in ("published", "applied")]
+
+    yield "mb_rate_limiter_acquired_total", "counter", "Tokens taken from the MusicBrainz rate limiter", \
+        [("", {}, mb_limiter.acquired)]
+    yield "mb_rate_limiter_refused_total", "counter", "Calls refused, no token within MB_RATE_MAX_WAIT", \
+        [("", {}, mb_limiter.refused)]
+    yield "mb_rate_limiter_wait_seconds_total", "counter", "Time spent waiting for the MusicBrainz rate limiter", \
+        [("", {}, round(mb_limiter.wait_seconds_total, 6))]
+    breaker = mb_breaker.stats()
+    yield "mb_circuit_breaker_state", "gauge", "State of the MusicBrainz circuit breaker, 1 for the current one", \
+        [("", {"state": state}, int(breaker["state"] == state)) for state in ("closed", "open", "half_open")]
+    yield "mb_circuit_breaker_opened_total", "counter", "Times the MusicBrainz circuit breaker opened", \
+        [("", {}, breaker["opened"])]
+    yield "mb_circuit_breaker_rejected_total", "counter", "Calls refused while the circuit breaker was open", \
+        [("", {}, breaker["rejected"])]
+
+
+metrics.add_collector(collect_application_metrics)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=content_type)
 
 
 if __name__ == "__main__":
-    config = uvicorn.Config(app="app:app",
-                            host="0.0.0.0",
-                            port=8080,
-                            log_level="info")
-    server = uvicorn.Server(config)
-    server.run()
+    workers = int(os.environ.get("MB_WORKERS", 1))
+    if workers > 1:
+        # Workers import the application anew: share the MusicBrainz rate limit between them unless a shared
+        # backend was chosen, and create the schema and seed the query cache once instead of racing on them.
+        os.environ.setdefault("MB_RATE_BACKEND", "file")
+        db_init()
+        backfill_query_cache()
+    uvicorn.run(app="app:app",
+                host="0.0.0.0",
+                port=8080,
+                workers=workers,
+                log_level="info")
@@ -0,0 +1,241 @@
+import os
+import asyncio
+import logging
+import math
+import musicbrainzngs
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from sql import async_db_session
+from mb_client import mb_async, build_any_query
+from ratelimit import mb_call_async, mb_breaker
+from recording_filter import RecordingFilter
+from ranking import rank_candidates, ranking_options
+from discography import ArtistNotFound
+from query_cache import query_cache, normalize_query
+from recording_index import local_index
+from search import Search, AsyncSearch
+from metrics import metrics
+from write_behind import write_behind
+
+"""
+Resolution of many titles in one request (POST /search/batch), streamed back as results complete.
+
+Step 1. Resolve the artist once and look every normalized title up in the query result cache with one IN query.
+Step 2. Send cached results (200 / 204) and titles answered by the local recording index (200) right away.
+Step 3. Search the remaining distinct titles in groups of MB_BATCH_COMBINE with a single OR-ed Lucene query
+        ("Demons" OR "Believer") AND arid:"..." per group. A title is settled by that page only when a recording
+        titled exactly like it (after normalization) meets the criteria, since the page mixes the results of several
+        phrases, and its best ranked recording (ranking.py) is confident enough. Other titles get their own paginated
+        search, exactly as GET /search does (and coalesced with it). Up to MB_BATCH_CONCURRENCY groups run at once,
+        every call still takes a token from the shared rate limiter.
+        Titles MusicBrainz could not answer (timeout, 5xx answers, circuit breaker open) get their last cached result,
+        even expired, marked "stale": true, or a 503 line with "retry_after" seconds.
+Step 4. Queue new tracks and cache entries as each title is resolved, and one searches row per title, for the
+        write-behind queue to store in batches.
+"""
+
+batch_options = {
+    "max_titles": int(os.environ.get("MB_BATCH_MAX_TITLES", 500)),
+    "combine": int(os.environ.get("MB_BATCH_COMBINE", 10)),
+    "concurrency": int(os.environ.get("MB_BATCH_CONCURRENCY", 4))
+}
+
+logger = logging.getLogger(__name__)
+
+Track = Tuple[str, str, str, str]
+
+
+def result_line(title: str, http_status_code: int, track: Optional[Track] = None, message: str = None) -> dict:
+    """
+    One NDJSON line of the batch response, worded like the /search answers.
+    """
+    if track is not None:
+        return {"title": title, "status": http_status_code, "result": ", ".join(track)}
+    return {"title": title, "status": http_status_code,
+            "result": message or f"Query \'{title}\' was not processed correctly."}
+
+
+def unavailable_line(title: str, error: musicbrainzngs.NetworkError, stale: tuple = None) -> dict:
+    """
+    Line of a title MusicBrainz could not answer: its last cached result, stale is (track_id, track, expires_on) as
+    returned by QueryCache.get_stale(), or a 503 when the title was never cached.
+    """
+    if stale is not None:
+        metrics.degraded.inc("stale")
+        line = result_line(title, 200 if stale[1] is not None else 204, stale[1])
+        line["stale"] = True
+        return line
+    metrics.degraded.inc("unavailable")
+    retry_after = getattr(error, "retry_after", None) or mb_breaker.retry_after() or 1.0
+    line = result_line(title, 503, message="MusicBrainz is unavailable")
+    line["retry_after"] = max(math.ceil(retry_after), 1)
+    return line
+
+
+class BatchLookup:
+    """
+    Resolves the titles of one batch request for one artist.
+    """
+    def __init__(self, artist: tuple, combine: int = batch_options.get("combine"),
+                 concurrency: int = batch_options.get("concurrency")):
+        self.artist = artist
+        self.artist_mbid, self.artist_name, self.discography = artist
+        self.combine = max(combine, 1)
+        self._semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.seen_candidates = list()
+
+    def _filter(self) -> RecordingFilter:
+        return RecordingFilter(artist_name=self.artist_name,
+                               discography=self.discography.ensure_loaded().index,
+                               stop_words=Search.stop_words)
+
+    async def _search_one(self, title: str) -> Optional[Track]:
+        search = AsyncSearch(query=title, artist=self.artist)
+        found = await search.call_mb()
+        self.seen_candidates.extend(search.seen_candidates)
+        if not found:
+            return None
+        return search.title, search.artist_name, search.album, search.length
+
+    async def _search_group(self, group: Dict[str, str], results: asyncio.Queue):
+        """
+        Resolve a group of {query_key: title} with one combined page, then one search per title left.
+
+        When MusicBrainz is unavailable (NetworkError, CircuitOpen included) every title of the group gets the error
+        instead of a search of its own, which would fail too.
+        """
+        async with self._semaphore:
+            pending = dict(group)
+            if len(group) > 1:
+                try:
+                    raw_api_response = await mb_call_async(mb_async.search_recordings,
+                                                           query=build_any_query(group.values(),
+                                                                                 arid=self.artist_mbid),
+                                                           limit=Search.default_step)
+                    recording_filter = self._filter()
+                    by_title = dict()
+                    for raw_record in raw_api_response["recording-list"]:
+                        by_title.setdefault(normalize_query(raw_record.get("title", "")), []).append(raw_record)
+                    for query_key in list(pending):
+                        with metrics.stage("filter"):
+                            candidates = recording_filter.filter_page(by_title.get(query_key, []))
+                            ranked = rank_candidates(candidates, group[query_key], self.discography.positions)
+                        self.seen_candidates.extend(candidates)
+                        if ranked and ranked[0].confidence >= ranking_options.get("threshold"):
+                            del pending[query_key]
+                            await results.put((query_key, tuple(ranked[0].candidate[:4]), None))
+                except musicbrainzngs.NetworkError as e:
+                    for query_key in pending:
+                        await results.put((query_key, None, e))
+                    return
+                except musicbrainzngs.WebServiceError as e:
+                    # The combined query is only a shortcut, every title still gets its own search.
+                    logger.warning("Combined search of %d titles failed: %s", len(group), e)
+
+            async def search_one(query_key: str, title: str):
+                try:
+                    await results.put((query_key, await self._search_one(title), None))
+                except Exception as e:
+                    await results.put((query_key, None, e))
+
+            await asyncio.gather(*(search_one(query_key, title) for query_key, title in pending.items()))
+
+    async def resolve(self, pending: Dict[str, str]) -> AsyncIterator[Tuple[str, Optional[Track], Exception]]:
+        """
+        Yield (query_key, track or None, error or None) for every pending {query_key: title}, as they complete.
+        An unexpected error of a group is raised here rather than waiting for its results forever.
+        """
+        results = asyncio.Queue()
+        keys = list(pending)
+        groups = [{query_key: pending[query_key] for query_key in keys[start:start + self.combine]}
+                  for start in range(0, len(keys), self.combine)]
+        tasks = [asyncio.ensure_future(self._search_group(group, results)) for group in groups]
+        running = set(tasks)
+        getter = None
+        try:
+            for _ in range(len(keys)):
+                getter = asyncio.ensure_future(results.get())
+                while not getter.done():
+                    done, _ = await asyncio.wait(running | {getter}, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done - {getter}:
+                        running.discard(task)
+                        task.result()
+                yield getter.result()
+        finally:
+            if getter is not None:
+                getter.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+async def lookup_batch(titles: List[str], artist: str = None) -> AsyncIterator[dict]:
+    """
+    Called by FastAPI endpoint POST /search/batch, yields one result_line() per title, in completion order.
+
+    :param titles: User's input queries, duplicates (also after normalization) are searched once
+    :param artist: Name of the artist to search recordings of, options["artist"] by default
+    """
+    artist = artist or Search.default_artist
+    try:
+        artist_tuple = await asyncio.to_thread(Search.prepare_artist, artist)
+    except ArtistNotFound:
+        for title in titles:
+            yield result_line(title, 204, message=f"Artist \'{artist}\' was not found.")
+        return
+    except musicbrainzngs.NetworkError as e:
+        for title in titles:
+            yield unavailable_line(title, e)
+        return
+    artist_mbid = artist_tuple[0]
+
+    titles_by_key = dict()
+    for title in titles:
+        titles_by_key.setdefault(normalize_query(title), []).append(title)
+
+    session = async_db_session()
+    try:
+        with metrics.stage("cache_lookup"):
+            cached = await session.run_sync(query_cache.get_many, artist_mbid, titles_by_key)
+        tracks = dict()
+        for query_key, (_, track, _) in cached.items():
+            tracks[query_key] = track
+            for title in titles_by_key[query_key]:
+                yield result_line(title, 200 if track is not None else 204, track)
+
+        pending = {query_key: same_titles[0] for query_key, same_titles in titles_by_key.items()
+                   if query_key not in cached}
+        with metrics.stage("local_index"):
+            local = {query_key: await session.run_sync(local_index.match, artist_mbid, title)
+                     for query_key, title in pending.items()}
+        for query_key, track in local.items():
+            if track is None:
+                continue
+            del pending[query_key]
+            tracks[query_key] = track
+            query_cache.put(artist_mbid, query_key, track)
+            for title in titles_by_key[query_key]:
+                yield result_line(title, 200, track)
+
+        batch_lookup = BatchLookup(artist_tuple)
+        async for query_key, track, error in batch_lookup.resolve(pending):
+            if error is None:
+                tracks[query_key] = track
+                query_cache.put(artist_mbid, query_key, track)
+            elif isinstance(error, musicbrainzngs.NetworkError):
+                stale = await session.run_sync(query_cache.get_stale, artist_mbid, query_key)
+                for title in titles_by_key[query_key]:
+                    yield unavailable_line(title, error, stale)
+                continue
+            for title in titles_by_key[query_key]:
+                if error is not None:
+                    metrics.errors.inc(type(error).__name__)
+                    yield result_line(title, 500, message="Failed")
+                else:
+                    yield result_line(title, 201 if track is not None else 204, track)
+
+        if batch_lookup.seen_candidates:
+            with metrics.stage("index_update"):
+                await session.run_sync(local_index.add, artist_mbid, batch_lookup.seen_candidates)
+        for title in titles:
+            write_behind.put_search(artist_mbid, title, tracks.get(normalize_query(title)))
+    finally:
+        await session.close()
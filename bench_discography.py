@@ -0,0 +1,109 @@
+import bisect
+import random
+import argparse
+import timeit
+from xml.sax.saxutils import escape
+from musicbrainzngs import musicbrainz as mb_ws
+from cache import deep_sizeof
+from discography import build_discography
+from releases import compact_release_groups
+from search import options
+
+"""
+Build-time and memory benchmark of the discography over a large synthetic catalogue.
+
+A catalogue of --release-groups release groups with --releases releases each (reissues, deluxe and regional editions
+sharing titles, as large catalogues do) is rendered as MusicBrainz WS/2 XML and parsed by musicbrainzngs, so the
+baseline holds exactly what MB's API hands back. Compares the bisect.insort build on raw dicts and the list, set and
+dict it kept per artist with the sorted build on releases.py records and the tuple and dict kept now:
+    python bench_discography.py --release-groups 5000 --releases 8
+"""
+
+TYPES = ("Album", "EP", "Single", "Demo", "Compilation", "Live", "Broadcast")
+STATUSES = ("Official", "Official", "Official", "Promotion", "Bootleg")
+EDITIONS = ("", " (Deluxe Edition)", " (Remastered)", " (Live)", " (Expanded Edition)", " (iTunes Session)")
+
+
+def legacy_build_discography(raw_release_groups: list, include: tuple, exclude: tuple) -> list:
+    """
+    The build that build_discography replaced, kept as the baseline: bisect.insort per release, list dedup.
+    """
+    albums_list = list()
+    for raw_release_group in raw_release_groups:
+        if raw_release_group.get("type") not in include:
+            continue
+        if any((word.lower() in raw_release_group.get("title").lower() for word in exclude)):
+            continue
+        first_release_date = raw_release_group.get("first-release-date")
+        if not first_release_date:
+            continue
+        for release in raw_release_group["release-list"]:
+            if any((word.lower() in release.get("title").lower() for word in exclude)):
+                continue
+            if release.get("status") != 'Official':
+                continue
+            bisect.insort(albums_list, (first_release_date, release.get("title")), lo=0)
+
+    clean_albums_list = list()
+    [clean_albums_list.append(item[1]) for item in albums_list if item[1] not in clean_albums_list]
+    return clean_albums_list
+
+
+def synthetic_catalogue(release_groups: int, releases: int, seed: int = 0) -> bytes:
+    """
+    :return: A WS/2 release-group search response listing the whole catalogue
+    """
+    rng = random.Random(seed)
+    groups = list()
+    for number in range(release_groups):
+        title = f"Record {number // 3}"
+        date = f"{rng.randint(1960, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        release_list = "".join(
+            f'<release id="{rng.getrandbits(64):016x}"><title>{escape(title + rng.choice(EDITIONS))}</title>'
+            f'<status>{rng.choice(STATUSES)}</status></release>' for _ in range(releases))
+        groups.append(f'<release-group id="{rng.getrandbits(64):016x}" type="{rng.choice(TYPES)}">'
+                      f'<title>{escape(title)}</title><first-release-date>{date}</first-release-date>'
+                      f'<release-list count="{releases}">{release_list}</release-list></release-group>')
+    return ('<?xml version="1.0" encoding="UTF-8"?><metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+            f'<release-group-list count="{release_groups}" offset="0">{"".join(groups)}</release-group-list>'
+            '</metadata>').encode("utf-8")
+
+
+def run(release_groups: int, releases: int, repeat: int) -> dict:
+    """
+    :return: A dict with catalogue size, build times in milliseconds and memory use in bytes
+    """
+    include, exclude = options.get("discography_includes"), options.get("discography_excludes")
+    raw_release_groups = mb_ws.mb_parser_xml(synthetic_catalogue(release_groups, releases))["release-group-list"]
+    records = compact_release_groups(raw_release_groups)
+
+    legacy_albums = legacy_build_discography(raw_release_groups, include, exclude)
+    albums = build_discography(records, include, exclude)
+    assert albums == legacy_albums, "both builds must return the same albums in the same order"
+    album_tuple = tuple(albums)
+    positions = {album: i for i, album in enumerate(album_tuple)}
+
+    return {"release_groups": release_groups,
+            "releases": release_groups * releases,
+            "albums": len(albums),
+            "legacy_build_ms": round(timeit.timeit(lambda: legacy_build_discography(raw_release_groups, include,
+                                                                                    exclude),
+                                                   number=repeat) / repeat * 1e3, 2),
+            "build_ms": round(timeit.timeit(lambda: build_discography(records, include, exclude),
+                                            number=repeat) / repeat * 1e3, 2),
+            "compact_ms": round(timeit.timeit(lambda: compact_release_groups(raw_release_groups),
+                                              number=repeat) / repeat * 1e3, 2),
+            "raw_release_groups_bytes": deep_sizeof(raw_release_groups),
+            "release_group_records_bytes": deep_sizeof(records),
+            "legacy_index_bytes": deep_sizeof((legacy_albums, frozenset(legacy_albums),
+                                               {album: i for i, album in enumerate(legacy_albums)})),
+            "index_bytes": deep_sizeof((album_tuple, positions, positions))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build-time and memory benchmark of the discography")
+    parser.add_argument("--release-groups", type=int, default=5000)
+    parser.add_argument("--releases", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args()
+    print(run(arguments.release_groups, arguments.releases, arguments.repeat))
@@ -0,0 +1,79 @@
+import argparse
+import datetime as dt
+import timeit
+from recording_filter import RecordingFilter
+from discography import build_discography
+from releases import compact_release_groups
+from search import options
+from mb_replay import load_pages
+
+"""
+Microbenchmark of the recording filter over recorded MusicBrainz search pages (fixtures/musicbrainz).
+
+Compares the per-record loop Search.process_raw_recording_list used to run with RecordingFilter.filter_page and
+reports the cost of filtering one page:
+    python bench_filter.py --repeat 200
+"""
+
+
+def legacy_filter(raw_recording_list: list, artist_name: str, artist_discography: list, stop_words: set):
+    """
+    The per-record loop that RecordingFilter replaced, kept as the baseline (list membership included).
+    """
+    for raw_record in raw_recording_list:
+        if not raw_record.get("length"):
+            continue
+        raw_length = dt.timedelta(milliseconds=int(raw_record.get("length")))
+        if raw_record.get("artist-credit-phrase") != artist_name:
+            continue
+        if any((word in raw_record.get("title").lower() for word in stop_words)):
+            continue
+        if "release-list" not in raw_record.keys():
+            continue
+        album_from_discography = any((release.get("title") in artist_discography
+                                      for release in raw_record["release-list"]))
+        if not album_from_discography:
+            continue
+        for release in raw_record["release-list"]:
+            if release.get("title") not in artist_discography:
+                continue
+            album_from_discography = release.get("title")
+            break
+        return (raw_record.get("title"), artist_name, album_from_discography,
+                ':'.join(str(raw_length).split(':')[-2:]).split('.')[0])
+    return None
+
+
+def run(repeat: int) -> dict:
+    """
+    Filter every recorded recording page `repeat` times with both implementations.
+
+    :return: A dict with page counts and the average cost per page in microseconds
+    """
+    artist_name, stop_words = options.get("artist"), options.get("discography_excludes")
+    release_groups = compact_release_groups(load_pages("release-group")[0]["release-group-list"])
+    albums = build_discography(release_groups, include=options.get("discography_includes"), exclude=stop_words)
+    pages = [page["recording-list"] for page in load_pages("recording")]
+    recording_filter = RecordingFilter(artist_name=artist_name, discography=frozenset(albums), stop_words=stop_words)
+
+    def legacy():
+        for page in pages:
+            legacy_filter(page, artist_name, albums, stop_words)
+
+    def batched():
+        for page in pages:
+            recording_filter.filter_page(page)
+
+    per_page = len(pages) * repeat
+    return {"pages": len(pages),
+            "recordings": sum(len(page) for page in pages),
+            "candidates": sum(len(recording_filter.filter_page(page)) for page in pages),
+            "legacy_us_per_page": round(timeit.timeit(legacy, number=repeat) / per_page * 1e6, 2),
+            "batched_us_per_page": round(timeit.timeit(batched, number=repeat) / per_page * 1e6, 2)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark of the recording filter")
+    parser.add_argument("--repeat", type=int, default=200)
+    arguments = parser.parse_args()
+    print(run(arguments.repeat))
@@ -0,0 +1,81 @@
+import re
+import argparse
+from musicbrainzngs import musicbrainz as mb_ws
+from recording_filter import RecordingFilter
+from discography import build_discography
+from releases import compact_release_groups
+from ranking import Ranking, ranking_options
+from search import options
+from mb_replay import load_fixtures
+
+"""
+Pages fetched per lookup over the recorded MusicBrainz searches (fixtures/musicbrainz), first hit against ranking.
+
+Replays the pagination of every recorded recording search without a server: "first_hit" stops at the first page
+holding a candidate and keeps its best scored one, as Search.process_raw_recording_list used to, "ranked" ranks the
+candidates of every page (ranking.Ranking) and stops at the first confident one. Prefetched pages are not counted,
+see pager.page_stats for those. Reports pages per lookup and the queries answered differently:
+    python bench_ranking.py --threshold 0.75
+"""
+
+_phrase = re.compile(r'^"((?:[^"\\]|\\.)*)"')
+_escaped = re.compile(r"\\(.)")
+
+
+def recorded_searches() -> dict:
+    """
+    :return: A dict {title: [parsed pages, by offset]} of every recorded recording search, and the discography
+    """
+    searches, discography = dict(), None
+    for (entity, query, offset), raw_response in sorted(load_fixtures().items()):
+        if entity == "release-group":
+            discography = build_discography(
+                compact_release_groups(mb_ws.mb_parser_xml(raw_response)["release-group-list"]),
+                include=options.get("discography_includes"), exclude=options.get("discography_excludes"))
+        elif entity == "recording" and _phrase.match(query):
+            title = _escaped.sub(r"\1", _phrase.match(query).group(1))
+            searches.setdefault(title, []).append((offset, mb_ws.mb_parser_xml(raw_response)["recording-list"]))
+    return {title: [page for _, page in sorted(pages, key=lambda page: page[0])]
+            for title, pages in searches.items()}, discography
+
+
+def run(threshold: float) -> dict:
+    """
+    :return: A dict with the number of lookups, pages per lookup of both strategies and the differing answers
+    """
+    searches, discography = recorded_searches()
+    positions = {album: i for i, album in enumerate(discography)}
+    recording_filter = RecordingFilter(artist_name=options.get("artist"), discography=positions,
+                                       stop_words=options.get("discography_excludes"))
+    report = {"lookups": len(searches), "first_hit_pages": 0, "ranked_pages": 0, "confident_stops": 0,
+              "changed": dict()}
+    for title, pages in searches.items():
+        first_hit = None
+        for number, page in enumerate(pages, 1):
+            candidates = recording_filter.filter_page(page)
+            if candidates:
+                first_hit = tuple(candidates[0][:4])
+                break
+        report["first_hit_pages"] += number
+
+        ranking = Ranking(title, positions, threshold=threshold)
+        for number, page in enumerate(pages, 1):
+            ranking.add(recording_filter.filter_page(page))
+            if ranking.confident():
+                report["confident_stops"] += 1
+                break
+        report["ranked_pages"] += number
+        ranked = tuple(ranking.best().candidate[:4]) if ranking.best() else None
+        if ranked != first_hit:
+            report["changed"][title] = {"first_hit": first_hit, "ranked": ranked}
+
+    report["first_hit_pages_per_lookup"] = round(report["first_hit_pages"] / report["lookups"], 3)
+    report["ranked_pages_per_lookup"] = round(report["ranked_pages"] / report["lookups"], 3)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pages fetched per lookup, first hit against ranked best match")
+    parser.add_argument("--threshold", type=float, default=ranking_options.get("threshold"))
+    arguments = parser.parse_args()
+    print(run(arguments.threshold))
@@ -0,0 +1,131 @@
+import os
+import json
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import time
+
+"""
+Reproducible benchmark of the /search hot path: the application served by uvicorn in this process, on a throwaway
+SQLite database, with MusicBrainz replaced by mb_replay.ReplayServer.
+
+Workloads:
+ - cold_miss  - titles that match, caches emptied before every round (201 after paginating MusicBrainz)
+ - local_hit  - titles that match, query result cache emptied before every round, answered from the local recording
+                index (200)
+ - warm_hit   - titles that match, answered from the query result cache (200)
+ - no_match   - titles that match nothing, caches emptied before every round (204 after paginating MusicBrainz)
+ - mixed      - every title at once from many connections, starting with empty caches
+"Emptied caches" are the query result cache and the ranked candidates (ranking.candidate_cache). The local recording
+index is switched off as well: it is loaded from recordings and tracks tables, which keep every title found before.
+Each one reports requests/s and p50/p95/p99 latency (load_test.summarize), plus the upstream calls it caused.
+
+    python bench_search.py --mode sync --latency 0.05 --error-rate 0.01 --concurrency 50 --requests 500
+"""
+
+found_titles = ["Demons", "Amsterdam", "It's Time", "Bad Liar", "Radioactive", "Monster", "Polaroid",
+                "Mouth of the River", "My Life", "Natural", "Monday", "Machine", "Love of Mine", "Love",
+                "Every Night", "Believer", "Thunder", "Whatever it Takes", "Not Today", "Next to Me", "Fallen",
+                "Nothing Left to Say", "Tokyo", "Real Life", "Cha-Ching", "Round and Round", "Cover Up"]
+missing_titles = ["Back in Black", "Fed Up", "What's my age"]
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark of the /search endpoint against replayed MusicBrainz")
+    parser.add_argument("--mode", choices=("sync", "async"),
+                        default="async" if os.environ.get("MB_ASYNC", "true").lower() in ("1", "true", "yes")
+                        else "sync")
+    parser.add_argument("--latency", type=float, default=0.05, help="Replayed MusicBrainz latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency, up to seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of MusicBrainz calls answered with 503")
+    parser.add_argument("--mb-rate", type=float, default=1000.0,
+                        help="Outbound MusicBrainz calls per second (MB_RATE_LIMIT), unpaced by default")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds of the cold workloads")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500, help="Requests of the warm_hit and mixed workloads")
+    parser.add_argument("--workloads", nargs="*", default=["cold_miss", "local_hit", "warm_hit", "no_match", "mixed"])
+    return parser.parse_args()
+
+
+def main(arguments) -> dict:
+    # The request path, database and rate limit are read from the environment when the modules are imported.
+    database_dir = tempfile.mkdtemp(prefix="mb_bench_")
+    os.environ["MB_ASYNC"] = "true" if arguments.mode == "async" else "false"
+    os.environ["MB_DB_URL"] = f"sqlite:///{os.path.join(database_dir, 'bench.db')}"
+    os.environ["MB_RATE_LIMIT"] = os.environ["MB_RATE_BURST"] = str(arguments.mb_rate)
+
+    import uvicorn
+    from app import app
+    from sql import db_session
+    from query_cache import query_cache
+    from ranking import candidate_cache
+    from recording_index import local_index
+    from mb_replay import ReplayServer, use_replay
+    from load_test import collect, summarize
+
+    index_enabled = local_index.enabled
+
+    def clear_cache(keep_local_index: bool = False):
+        session = db_session()
+        try:
+            query_cache.clear(session)
+        finally:
+            session.close()
+        candidate_cache.clear()
+        local_index.forget()
+        local_index.enabled = index_enabled and keep_local_index
+
+    report = {"mode": arguments.mode, "latency_s": arguments.latency, "error_rate": arguments.error_rate}
+    with ReplayServer(latency=arguments.latency, jitter=arguments.jitter, error_rate=arguments.error_rate,
+                      seed=0) as replay, use_replay(replay):
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=free_port(), log_level="warning"))
+        thread = threading.Thread(target=server.run, name="bench-server", daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+        url = f"http://127.0.0.1:{server.config.port}"
+
+        # Resolve the artist and load the discography once, they are not part of any workload.
+        asyncio.run(collect(url, 1, 1, missing_titles[:1]))
+
+        workloads = {"cold_miss": (found_titles, 1, None),
+                     "local_hit": (found_titles, 1, None),
+                     "warm_hit": (found_titles, arguments.concurrency, arguments.requests),
+                     "no_match": (missing_titles, 1, None),
+                     "mixed": (found_titles + missing_titles, arguments.concurrency, arguments.requests)}
+        for name in arguments.workloads:
+            titles, concurrency, total_requests = workloads[name]
+            rounds = arguments.rounds if total_requests is None else 1
+            if name in ("local_hit", "warm_hit"):
+                # Every title is looked up once first, for the recording index or the query result cache to hold it.
+                clear_cache(keep_local_index=True)
+                asyncio.run(collect(url, 1, len(titles), titles))
+            upstream_calls = replay.counters["requests"]
+            results, elapsed = list(), 0.0
+            for _ in range(rounds):
+                if name != "warm_hit":
+                    clear_cache(keep_local_index=name == "local_hit")
+                round_results, round_elapsed = asyncio.run(collect(url, concurrency, total_requests or len(titles),
+                                                                   titles))
+                results.extend(round_results)
+                elapsed += round_elapsed
+            report[name] = dict(summarize(results, elapsed, concurrency),
+                                upstream_calls=replay.counters["requests"] - upstream_calls)
+
+        local_index.enabled = index_enabled
+        report["upstream"] = dict(replay.counters)
+        server.should_exit = True
+        thread.join()
+    return report
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(parse_arguments()), indent=1))
@@ -0,0 +1,150 @@
+import os
+import time
+import socket
+import logging
+import threading
+from typing import Callable, Optional
+from sql import db_session, db_put_cache_event, db_get_cache_events, db_last_cache_event
+
+"""
+Propagation of cache invalidations between worker processes (uvicorn --workers, MB_WORKERS) sharing one database.
+
+Query results and discographies are shared through the database (query_cache, release_groups and releases tables).
+Only the in-memory tiers in front of it are per process, so dropping or replacing an entry in one worker is
+recorded in cache_events table with cache_sync.publish(kind, artist_mbid), and every other worker polls that table
+every MB_CACHE_SYNC_INTERVAL seconds and calls the handlers subscribed to that kind of event, which drop their copy.
+Events older than MB_CACHE_EVENT_TTL seconds are deleted. MB_CACHE_SYNC=false keeps every worker to itself.
+
+event_id is assigned when an event is inserted but visible once it is committed, so an event can show up after one
+with a higher event_id was applied. IDs skipped over by the last applied event are kept as gaps and read again on
+every poll until they show up or MB_CACHE_SYNC_GAP_TIMEOUT seconds have passed (a rolled back insert never does).
+"""
+
+cache_sync_options = {
+    "enabled": os.environ.get("MB_CACHE_SYNC", "true").lower() in ("1", "true", "yes"),
+    "interval": float(os.environ.get("MB_CACHE_SYNC_INTERVAL", 1.0)),
+    "event_ttl": int(os.environ.get("MB_CACHE_EVENT_TTL", 24 * 60 * 60)),
+    "gap_timeout": float(os.environ.get("MB_CACHE_SYNC_GAP_TIMEOUT", 60.0)),
+    "max_gaps": 1000,
+    "warm_results": int(os.environ.get("MB_WARM_QUERY_RESULTS", 5000)),
+    "warm_artists": int(os.environ.get("MB_WARM_ARTISTS", 16))
+}
+
+logger = logging.getLogger(__name__)
+
+
+class CacheSync:
+    """
+    Publishes invalidations of this process and applies those of the other processes, from a background thread.
+    """
+    def __init__(self, interval: float, event_ttl: int, enabled: bool = True,
+                 gap_timeout: float = cache_sync_options.get("gap_timeout")):
+        self.interval = interval
+        self.event_ttl = event_ttl
+        self.gap_timeout = gap_timeout
+        self.enabled = enabled
+        self.handlers = dict()
+        self.last_event_id = None
+        self.gaps = dict()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {"published": 0, "applied": 0, "failed_polls": 0}
+
+    @property
+    def origin(self) -> str:
+        # Read on every use, a forked worker gets its own pid.
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def subscribe(self, kind: str, handler: Callable[[Optional[str]], None]):
+        """
+        Call handler(artist_mbid) for every event of this kind published by another process.
+        """
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, artist_mbid: str = None):
+        """
+        Tell the other processes to drop their in-memory copy of kind, for one artist or (artist_mbid None) all.
+        """
+        if not self.enabled:
+            return
+        session = db_session()
+        try:
+            db_put_cache_event(session, kind, artist_mbid, self.origin, self.event_ttl)
+        finally:
+            session.close()
+        with self._lock:
+            self.counters["published"] += 1
+
+    def poll(self) -> int:
+        """
+        Apply the events published by other processes since the previous poll, and those committed late.
+
+        :return: Number of applied events
+        """
+        session = db_session()
+        try:
+            if self.last_event_id is None:
+                self.last_event_id = db_last_cache_event(session)
+                self.gaps.clear()
+                return 0
+            now = time.monotonic()
+            for event_id in [event_id for event_id, noticed in self.gaps.items() if noticed + self.gap_timeout < now]:
+                del self.gaps[event_id]
+            events = db_get_cache_events(session, min(self.gaps, default=self.last_event_id + 1) - 1)
+        finally:
+            session.close()
+        applied, origin = 0, self.origin
+        for event_id, kind, artist_mbid, event_origin in events:
+            if event_id > self.last_event_id:
+                skipped = range(max(self.last_event_id + 1, event_id - cache_sync_options.get("max_gaps")), event_id)
+                self.gaps.update(dict.fromkeys(skipped, now))
+                self.last_event_id = event_id
+            elif self.gaps.pop(event_id, None) is None:
+                continue
+            if event_origin == origin:
+                continue
+            for handler in self.handlers.get(kind, ()):
+                handler(artist_mbid)
+            applied += 1
+        with self._lock:
+            self.counters["applied"] += applied
+        return applied
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                with self._lock:
+                    self.counters["failed_polls"] += 1
+                logger.exception("Polling cache events failed")
+
+    def start(self):
+        """
+        Skip the events published so far and start polling. Called on application startup.
+        """
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.last_event_id = None
+        self.poll()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters.update({"enabled": self.enabled, "last_event_id": self.last_event_id, "gaps": len(self.gaps)})
+        return counters
+
+
+cache_sync = CacheSync(interval=cache_sync_options.get("interval"),
+                       event_ttl=cache_sync_options.get("event_ttl"),
+                       enabled=cache_sync_options.get("enabled"))
@@ -0,0 +1,148 @@
+import os
+import json
+import logging
+import argparse
+import threading
+import musicbrainzngs
+from typing import List
+from sql import db_init, db_session, db_retrieve_discography, db_retrieve_browsed_releases, db_put_browsed_release
+from ratelimit import mb_call
+from recording_filter import RecordingFilter
+from recording_index import local_index
+from query_cache import normalize_query
+from discography import resolve_artist, get_discography, official_releases
+from cache_sync import cache_sync
+from search import Search
+
+"""
+Catalogue warm-up: resolve every official recording of an artist before anyone searches for it.
+
+Step 1. Resolve the artist and load its discography (release_groups and releases tables, MB's API if not stored).
+Step 2. Take one release per album of the discography (discography.official_releases()) and skip the releases
+        browsed by a previous run (browsed_releases table), so a run only browses releases that are new since then.
+Step 3. Browse the recordings of every remaining release (MB's /ws/2/recording?release=... browse endpoint) and keep
+        those meeting the search criteria (recording_filter.RecordingFilter, with the release as their album).
+Step 4. Store them in recordings table and the local recording index (the title -> track index searches are
+        answered from without calling MusicBrainz), and the first one of every new title in tracks table.
+Every call takes a token from the shared rate limiter; when MusicBrainz fails the run stops and the next one resumes
+where it stopped. Other workers reload their local index through cache_sync.py. Run it from a shell or cron:
+    python catalogue.py --artist "Imagine Dragons"
+or on application startup, in a background thread, with MB_CATALOGUE_WARMUP=true.
+"""
+
+catalogue_options = {
+    "on_startup": os.environ.get("MB_CATALOGUE_WARMUP", "false").lower() in ("1", "true", "yes"),
+    "page_size": 100
+}
+
+logger = logging.getLogger(__name__)
+
+
+def browse_release_recordings(release_id: str, page_size: int = catalogue_options.get("page_size")) -> List[dict]:
+    """
+    Get every recording of a release from MB's browse endpoint, following pagination.
+
+    :param release_id: MusicBrainz ID of the release
+    :param page_size: Number of recordings requested per call (MB's maximum is 100)
+    :return: A list of raw recording dicts, as musicbrainzngs.browse_recordings() returns them
+    """
+    recordings = list()
+    offset = 0
+    while True:
+        raw_api_response = mb_call(musicbrainzngs.browse_recordings,
+                                   release=release_id,
+                                   includes=["artist-credits"],
+                                   limit=page_size,
+                                   offset=offset)
+        page = raw_api_response["recording-list"]
+        recordings.extend(page)
+        offset += page_size
+        if not page or raw_api_response["recording-count"] <= offset:
+            break
+    return recordings
+
+
+def warm_catalogue(artist: str = None, full: bool = False) -> dict:
+    """
+    Browse the official releases of an artist not browsed yet and store their recordings.
+
+    :param artist: Name of the artist, options["artist"] by default
+    :param full: Browse every release again, not only those new since the previous run
+    :return: A report dict: releases of the discography, browsed and skipped ones, stored recordings and tracks,
+             and the number of titles answered without calling MusicBrainz before and after the run
+    """
+    artist = artist or Search.default_artist
+    artist_mbid, artist_name = resolve_artist(artist, claim_legacy_rows=artist == Search.default_artist)
+    discography = get_discography(artist_mbid, artist_name,
+                                  include=Search.album_types, exclude=Search.stop_words).ensure_loaded()
+    recording_filter = RecordingFilter(artist_name=artist_name, discography=discography.index,
+                                       stop_words=Search.stop_words)
+
+    session = db_session()
+    try:
+        release_groups, _ = db_retrieve_discography(session, artist_mbid)
+        releases = official_releases(release_groups, include=Search.album_types, exclude=Search.stop_words)
+        browsed = set() if full else db_retrieve_browsed_releases(session, artist_mbid)
+        known_titles = set(local_index.titles(session, artist_mbid))
+        report = {"artist": artist_name, "releases": len(releases), "browsed": 0,
+                  "skipped": sum(release.id in browsed for release in releases), "recordings": 0, "tracks": 0,
+                  "answerable_before": len(known_titles), "complete": True}
+
+        for release in releases:
+            if release.id in browsed:
+                continue
+            try:
+                raw_recording_list = browse_release_recordings(release.id)
+            except musicbrainzngs.ResponseError as e:
+                # Removed or merged since the discography was fetched, the next refresh drops it.
+                logger.warning("Browsing release %s failed: %s", release.id, e)
+                continue
+            except musicbrainzngs.NetworkError as e:
+                logger.warning("Browsing release %s failed, stopping: %s", release.id, e)
+                report["complete"] = False
+                break
+            for raw_record in raw_recording_list:
+                raw_record["release-list"] = [{"id": release.id, "title": release.title}]
+            candidates = recording_filter.filter_page(raw_recording_list)
+            tracks = dict()
+            for candidate in candidates:
+                title_key = normalize_query(candidate.title)
+                if title_key not in known_titles:
+                    tracks.setdefault(title_key, tuple(candidate[:4]))
+            known_titles.update(tracks)
+            local_index.add(session, artist_mbid, candidates)
+            report["tracks"] += db_put_browsed_release(session, artist_mbid, release.id, release.title,
+                                                       len(candidates), tracks.values())
+            report["browsed"] += 1
+            report["recordings"] += len(candidates)
+
+        report["answerable"] = len(local_index.titles(session, artist_mbid))
+    finally:
+        session.close()
+    if report["browsed"]:
+        cache_sync.publish("local_index", artist_mbid)
+    return report
+
+
+def start_in_background(artist: str = None) -> threading.Thread:
+    """
+    Run warm_catalogue() in a daemon thread, e.g. on application startup, logging its report.
+    """
+    def run():
+        try:
+            logger.info("Catalogue warm-up: %s", warm_catalogue(artist))
+        except Exception as e:
+            logger.exception("Catalogue warm-up failed")
+
+    thread = threading.Thread(target=run, name="catalogue-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store every official recording of an artist ahead of searches")
+    parser.add_argument("--artist", default=Search.default_artist)
+    parser.add_argument("--full", action="store_true", help="Browse every release again, not only new ones")
+    arguments = parser.parse_args()
+    db_init()
+    print(json.dumps(warm_catalogue(arguments.artist, full=arguments.full)))
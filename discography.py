@@ -0,0 +1,364 @@
+import os
+import time
+import threading
+import musicbrainzngs
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+from sql import db_session, db_put_discography, db_retrieve_discography, db_retrieve_artist, db_put_artist, \
+    db_claim_legacy_rows, db_retrieve_recent_artists
+from ratelimit import mb_call, SingleFlight
+from cache import LRUCache, deep_sizeof
+from cache_sync import cache_sync
+from releases import ReleaseGroupRecord, ReleaseRecord, compact_release_groups, intern
+from recording_filter import compile_stop_words
+
+discography_options = {
+    "ttl": int(os.environ.get("MB_DISCOGRAPHY_TTL", 24 * 60 * 60)),
+    "retry_after": 5 * 60,
+    "page_size": 100,
+    "cache_entries": int(os.environ.get("MB_DISCOGRAPHY_CACHE_ENTRIES", 64)),
+    "cache_bytes": int(os.environ.get("MB_DISCOGRAPHY_CACHE_BYTES", 64 * 1024 * 1024)),
+    "unknown_artist_ttl": int(os.environ.get("MB_UNKNOWN_ARTIST_TTL", 60 * 60)),
+    "unknown_artist_entries": 10000
+}
+
+
+class ArtistNotFound(LookupError):
+    pass
+
+
+def fetch_artist(artist_name: str) -> Tuple[str, str]:
+    """
+    Find the MusicBrainz artist whose name matches artist_name (case-insensitive), best search score first.
+
+    :param artist_name: A string used to call for MB API search_artists
+
+    :return: Tuple of strings (artist_mbid, name as spelled by MusicBrainz)
+    """
+    raw_api_response = mb_call(musicbrainzngs.search_artists,
+                               artist=artist_name,
+                               strict=True,
+                               limit=25)
+    lookup_name = artist_name.strip().lower()
+    for raw_artist in raw_api_response["artist-list"]:
+        if raw_artist.get("name", "").lower() == lookup_name:
+            return raw_artist["id"], raw_artist["name"]
+    raise ArtistNotFound(artist_name)
+
+
+def fetch_release_groups(artist_mbid: str,
+                         page_size: int = discography_options.get("page_size")) -> List[ReleaseGroupRecord]:
+    """
+    Get every release group MB's search returns for an artist, following pagination past the first page.
+
+    Each page is converted to compact records (releases.py) as it arrives, the raw dicts are not kept.
+
+    :param artist_mbid: MusicBrainz ID of the artist, used as arid field of MB API search_release_groups
+    :param page_size: Number of release groups requested per call (MB's maximum is 100)
+
+    :return: A list of releases.ReleaseGroupRecord tuples
+    """
+    release_groups = list()
+    offset = 0
+    while True:
+        raw_api_response = mb_call(musicbrainzngs.search_release_groups,
+                                   arid=artist_mbid,
+                                   strict=True,
+                                   limit=page_size,
+                                   offset=offset)
+        page = raw_api_response["release-group-list"]
+        release_groups.extend(compact_release_groups(page))
+        offset += page_size
+        if not page or raw_api_response["release-group-count"] <= offset:
+            break
+    return release_groups
+
+
+def build_discography(release_groups: Iterable[ReleaseGroupRecord], include: tuple, exclude: tuple) -> List[str]:
+    """
+    Get a list of albums from release groups, sorted by first release date
+
+    Official releases of allowed release group types whose titles contain no stop word are collected as
+    (first release date, title) pairs, sorted once and deduplicated in order (first release date wins): O(n log n).
+
+    :param release_groups: An iterable of releases.ReleaseGroupRecord tuples
+    :param include: A tuple of strings representing types of release-groups that contain official recordings/tracks
+    :param exclude: A tuple of strings representing stop-words that should not be included in official discography
+
+    :return: A list of strings (album names) previously sorted by first release date
+    """
+    albums = [(first_release_date, release.title)
+              for first_release_date, release in _official_releases(release_groups, include, exclude)]
+    albums.sort()
+    return list(dict.fromkeys(title for _, title in albums))
+
+
+def _official_releases(release_groups: Iterable[ReleaseGroupRecord], include: tuple,
+                       exclude: tuple) -> Iterator[Tuple[str, ReleaseRecord]]:
+    """
+    :return: (first release date, release) of every release meeting the discography criteria, unsorted
+    """
+    allowed_album_types = frozenset(include)
+    stop_words = compile_stop_words(frozenset(exclude))
+    for release_group in release_groups:
+        if release_group.type not in allowed_album_types or not release_group.first_release_date:
+            continue
+        if stop_words is not None and stop_words.search(release_group.title):
+            continue
+        for release in release_group.releases:
+            if release.status == "Official" and (stop_words is None or not stop_words.search(release.title)):
+                yield release_group.first_release_date, release
+
+
+def official_releases(release_groups: Iterable[ReleaseGroupRecord], include: tuple,
+                      exclude: tuple) -> List[ReleaseRecord]:
+    """
+    One release per album of the discography (the first one of the album's earliest release group), in the order
+    of build_discography().
+
+    :return: A list of releases.ReleaseRecord tuples
+    """
+    releases = sorted(_official_releases(release_groups, include, exclude),
+                      key=lambda dated_release: (dated_release[0], dated_release[1].title))
+    first_releases = dict()
+    for _, release in releases:
+        first_releases.setdefault(release.title, release)
+    return list(first_releases.values())
+
+
+def fetch_discography(artist_mbid: str, include: tuple, exclude: tuple) -> List[str]:
+    """
+    Get a list of albums released by an artist, sorted by first release date, straight from MB's API
+
+    :return: A list of strings (album names) previously sorted by first release date
+    """
+    return build_discography(fetch_release_groups(artist_mbid), include=include, exclude=exclude)
+
+
+class Discography:
+    """
+    Official discography of one artist, stored in release_groups/releases tables and indexed in memory.
+
+    Nothing is loaded until first use. The first use reads the database and only calls MB's API when nothing is
+    stored yet. Once the stored copy is older than `ttl` seconds, it keeps being served while a background thread
+    fetches a new one, unless another worker process already stored a newer copy. Other workers are told to reload
+    theirs through cache_sync.py. Supports `in` (O(1) album membership), len() and iteration in release order;
+    `albums` is a tuple of interned titles and `positions` maps every album to its place in that order. `index`,
+    used for membership tests, is the same dict rather than a separate set.
+    """
+    def __init__(self, artist_mbid: str, artist_name: str, include: tuple, exclude: tuple,
+                 ttl: int = discography_options.get("ttl")):
+        self.artist_mbid = artist_mbid
+        self.artist_name = artist_name
+        self.include = include
+        self.exclude = exclude
+        self.ttl = timedelta(seconds=ttl)
+        self.albums = tuple()
+        self.index = self.positions = dict()
+        self.fetched_on = None
+        self._next_refresh = None
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    def _set(self, release_groups: List[ReleaseGroupRecord], fetched_on: datetime):
+        albums = tuple(map(intern, build_discography(release_groups, include=self.include, exclude=self.exclude)))
+        positions = {album: i for i, album in enumerate(albums)}
+        # Swap the whole index at once so concurrent readers never see a partially built one.
+        self.albums, self.index, self.positions, self.fetched_on = albums, positions, positions, fetched_on
+        self._next_refresh = fetched_on + self.ttl
+
+    def refresh(self) -> "Discography":
+        """
+        Fetch release groups from MB's API, store them and rebuild the in-memory index.
+        """
+        release_groups = fetch_release_groups(self.artist_mbid)
+        session = db_session()
+        try:
+            db_put_discography(session, self.artist_mbid, self.artist_name, release_groups)
+        finally:
+            session.close()
+        self._set(release_groups, datetime.now())
+        cache_sync.publish("discography", self.artist_mbid)
+        return self
+
+    def load(self) -> "Discography":
+        """
+        Build the in-memory index from the database, falling back to MB's API when nothing is stored.
+        """
+        with self._lock:
+            if self.fetched_on is not None:
+                return self
+            session = db_session()
+            try:
+                release_groups, fetched_on = db_retrieve_discography(session, self.artist_mbid)
+            finally:
+                session.close()
+            if fetched_on is None:
+                return self.refresh()
+            self._set(release_groups, fetched_on)
+            return self
+
+    def _refresh_quietly(self):
+        session = db_session()
+        try:
+            release_groups, fetched_on = db_retrieve_discography(session, self.artist_mbid)
+        finally:
+            session.close()
+        if fetched_on is not None and fetched_on + self.ttl > datetime.now():
+            # Another worker refreshed it already.
+            self._set(release_groups, fetched_on)
+            return
+        try:
+            self.refresh()
+        except musicbrainzngs.WebServiceError:
+            # Keep serving the stored copy, try again later.
+            self._next_refresh = datetime.now() + timedelta(seconds=discography_options.get("retry_after"))
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_quietly,
+                                                    name="discography-refresh",
+                                                    daemon=True)
+            self._refresh_thread.start()
+
+    def ensure_loaded(self) -> "Discography":
+        """
+        Load the index on first use, start a background refresh when it is older than ttl.
+        """
+        if self.fetched_on is None:
+            self.load()
+        elif datetime.now() > self._next_refresh:
+            self._refresh_in_background()
+        return self
+
+    def __contains__(self, album) -> bool:
+        return album in self.ensure_loaded().index
+
+    def __iter__(self):
+        return iter(self.ensure_loaded().albums)
+
+    def __len__(self) -> int:
+        return len(self.ensure_loaded().albums)
+
+    def memory_size(self) -> int:
+        """
+        Approximate memory used by the in-memory index, in bytes.
+        """
+        return deep_sizeof((self.albums, self.index, self.positions))
+
+
+_artists = dict()
+_artist_lock = threading.Lock()
+discographies = LRUCache(max_entries=discography_options.get("cache_entries"),
+                         max_bytes=discography_options.get("cache_bytes"),
+                         sizeof=Discography.memory_size)
+_discography_flight = SingleFlight()
+_artist_flight = SingleFlight()
+# Names MusicBrainz knows no artist by, {lookup_name: expiry (time.monotonic())}, asked again once expired.
+_unknown_artists = LRUCache(max_entries=discography_options.get("unknown_artist_entries"))
+
+
+def resolved_artist(artist_name: str) -> Optional[Tuple[str, str]]:
+    """
+    Memory-only counterpart of resolve_artist(): no database read, no call to MB's API.
+
+    :return: Tuple of strings (artist_mbid, name as spelled by MusicBrainz), None if not resolved in this process yet
+    """
+    return _artists.get(artist_name.strip().lower())
+
+
+def resolve_artist(artist_name: str, claim_legacy_rows: bool = False) -> Tuple[str, str]:
+    """
+    Map an artist name to its MusicBrainz ID: memory first, then artists table, then MB's API.
+
+    Names MusicBrainz does not know are remembered for MB_UNKNOWN_ARTIST_TTL seconds (default 3600) and raise
+    ArtistNotFound at once, concurrent lookups of the same name share one database read and API call.
+
+    :param artist_name: Artist name as given by the user
+    :param claim_legacy_rows: Assign rows stored before multi-artist support to this artist (default artist only)
+
+    :return: Tuple of strings (artist_mbid, name as spelled by MusicBrainz)
+    """
+    lookup_name = artist_name.strip().lower()
+    artist = _artists.get(lookup_name)
+    if artist is not None:
+        return artist
+    expires_on = _unknown_artists.get(lookup_name)
+    if expires_on is not None:
+        if expires_on > time.monotonic():
+            raise ArtistNotFound(artist_name)
+        _unknown_artists.pop(lookup_name)
+    return _artist_flight.do(lookup_name, _resolve_artist, artist_name, lookup_name, claim_legacy_rows)
+
+
+def _resolve_artist(artist_name: str, lookup_name: str, claim_legacy_rows: bool) -> Tuple[str, str]:
+    session = db_session()
+    try:
+        artist = db_retrieve_artist(session, lookup_name)
+        if artist is None:
+            try:
+                artist_mbid, name = fetch_artist(artist_name)
+            except ArtistNotFound:
+                _unknown_artists.put(lookup_name, time.monotonic() + discography_options.get("unknown_artist_ttl"))
+                raise
+            artist = db_put_artist(session, artist_mbid, name, lookup_name)
+        if claim_legacy_rows:
+            db_claim_legacy_rows(session, artist[0], artist[1])
+    finally:
+        session.close()
+    with _artist_lock:
+        _artists[lookup_name] = artist
+    return artist
+
+
+def _load_discography(artist_mbid: str, artist_name: str, include: tuple, exclude: tuple) -> Discography:
+    discography = Discography(artist_mbid, artist_name, include=include, exclude=exclude).ensure_loaded()
+    return discographies.put(artist_mbid, discography)
+
+
+def get_discography(artist_mbid: str, artist_name: str, include: tuple, exclude: tuple) -> Discography:
+    """
+    Return the loaded discography of an artist from the LRU cache, loading it on a miss.
+
+    Concurrent misses for the same artist share one load.
+
+    :return: A loaded Discography object
+    """
+    discography = discographies.get(artist_mbid)
+    if discography is not None:
+        return discography.ensure_loaded()
+    return _discography_flight.do(artist_mbid, _load_discography, artist_mbid, artist_name, include, exclude)
+
+
+def forget_discography(artist_mbid: str = None):
+    """
+    Drop the in-memory discography of an artist (all of them when artist_mbid is None), reloaded on next use.
+    """
+    if artist_mbid is None:
+        discographies.clear()
+    else:
+        discographies.pop(artist_mbid)
+
+
+def warm_discographies(limit: int, include: tuple, exclude: tuple) -> int:
+    """
+    Resolve and load the discographies of the most recently searched artists from the database, e.g. in a new worker.
+
+    :param limit: Maximum number of artists
+    :return: Number of loaded discographies
+    """
+    session = db_session()
+    try:
+        artists = db_retrieve_recent_artists(session, min(limit, discographies.max_entries))
+    finally:
+        session.close()
+    for artist_mbid, name, lookup_name in artists:
+        with _artist_lock:
+            _artists[lookup_name] = (artist_mbid, name)
+        get_discography(artist_mbid, name, include=include, exclude=exclude)
+    return len(artists)
+
+
+cache_sync.subscribe("discography", forget_discography)
@@ -0,0 +1,203 @@
+import os
+import sys
+import gzip
+import json
+import random
+import uuid
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mb_client import build_search_query
+
+"""
+Generate the MusicBrainz WS/2 XML responses replayed by the offline test suite and benchmarks.
+
+MusicBrainz is not reachable from the build environment, so the responses are synthesized: they follow the WS/2
+search schema and musicbrainzngs parses them exactly like live responses, and they mimic what MusicBrainz returns
+for the queries in test_main.py (live versions, remixes, features, compilations, recordings without length).
+Output is deterministic, run `python fixtures/generate_fixtures.py` to rebuild fixtures/musicbrainz/.
+"""
+
+ARTIST = ("012151a8-0f9a-44c9-997f-ebd68b5389f9", "Imagine Dragons")
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "musicbrainz")
+PAGE = 100
+
+# (title, type, first-release-date, [(release title, status), ...])
+RELEASE_GROUPS = [
+    ("Imagine Dragons", "EP", "2009-06-17", [("Imagine Dragons", "Official")]),
+    ("Hell and Silence", "EP", "2010-03-01", [("Hell and Silence", "Official")]),
+    ("It's Time", "EP", "2011-03-12", [("It's Time", "Official"), ("It's Time", "Promotion")]),
+    ("Continued Silence", "EP", "2012-02-14", [("Continued Silence", "Official")]),
+    ("Radioactive", "Single", "2012-04-02", [("Radioactive", "Official"), ("Radioactive", "Promotion")]),
+    ("Night Visions", "Album", "2012-09-04", [("Night Visions", "Official"),
+                                              ("Night Visions (Deluxe Edition)", "Official"),
+                                              ("Night Visions", "Bootleg")]),
+    ("Demons", "Single", "2013-01-28", [("Demons", "Official")]),
+    ("Night Visions Live", "Album", "2014-02-17", [("Night Visions Live", "Official")]),
+    ("Monster", "Single", "2013-09-16", [("Monster", "Official")]),
+    ("Smoke + Mirrors", "Album", "2015-02-17", [("Smoke + Mirrors", "Official"),
+                                                ("Smoke + Mirrors (Deluxe)", "Official")]),
+    ("Smoke + Mirrors Live", "Album", "2016-01-21", [("Smoke + Mirrors Live", "Official")]),
+    ("Not Today", "Single", "2016-05-20", [("Not Today", "Official")]),
+    ("Believer", "Single", "2017-02-01", [("Believer", "Official")]),
+    ("Thunder", "Single", "2017-04-27", [("Thunder", "Official")]),
+    ("Evolve", "Album", "2017-06-23", [("Evolve", "Official"), ("Evolve (Deluxe)", "Official")]),
+    ("Believer (Remixes)", "Single", "2017-07-14", [("Believer (Remixes)", "Official")]),
+    ("Next to Me", "Single", "2018-02-21", [("Next to Me", "Official")]),
+    ("Origins", "Album", "2018-11-09", [("Origins", "Official"), ("Origins (Deluxe)", "Official")]),
+    ("Origins (iTunes Session)", "Album", "2019-01-10", [("Origins (iTunes Session)", "Official")]),
+    ("Mercury – Act 1", "Album", "2021-09-03", [("Mercury – Act 1", "Official")]),
+    ("Mercury – Acts 1 & 2", "Album", "2022-07-01", [("Mercury – Acts 1 & 2", "Official")]),
+    ("Spotify Singles", "EP", "2018-03-20", [("Spotify Singles", "Official")]),
+    ("Loom", "Album", "2024-06-28", [("Loom", "Official")]),
+    ("Greatest Hits Live in Vegas", "Live", "2019-05-01", [("Greatest Hits Live in Vegas", "Bootleg")]),
+    ("Now That's What I Call Music! 85", "Compilation", "2013-07-22", [("Now That's What I Call Music! 85",
+                                                                         "Official")]),
+]
+
+# query -> (recording title, album release, length ms, number of recordings returned, page of the match)
+SONGS = {
+    "Demons": ("Demons", "Night Visions", 175880, 260, 2),
+    "Amsterdam": ("Amsterdam", "Night Visions", 241000, 35, 0),
+    "It's Time": ("It's Time", "It's Time", 240000, 140, 1),
+    "Bad Liar": ("Bad Liar", "Origins", 260000, 60, 0),
+    "Radioactive": ("Radioactive", "Night Visions", 186813, 420, 3),
+    "Monster": ("Monster", "Monster", 249000, 90, 0),
+    "Polaroid": ("Polaroid", "Smoke + Mirrors", 230000, 25, 0),
+    "Mouth of the River": ("Mouth of the River", "Evolve", 221000, 20, 0),
+    "My Life": ("My Life", "Mercury – Act 1", 235000, 30, 0),
+    "Natural": ("Natural", "Origins", 189000, 120, 1),
+    "Monday": ("Monday", "Mercury – Act 1", 207000, 18, 0),
+    "Machine": ("Machine", "Origins", 181000, 22, 0),
+    "Love of Mine": ("Love of Mine", "Mercury – Act 1", 200000, 12, 0),
+    "Love": ("Love", "Origins", 164000, 80, 0),
+    "Every Night": ("Every Night", "Night Visions (Deluxe Edition)", 217000, 15, 0),
+    "Believer": ("Believer", "Evolve", 204346, 310, 2),
+    "Thunder": ("Thunder", "Evolve", 187000, 150, 1),
+    "Whatever it Takes": ("Whatever It Takes", "Evolve", 201000, 70, 0),
+    "Not Today": ("Not Today", "Not Today", 260000, 14, 0),
+    "Next to Me": ("Next to Me", "Next to Me", 230000, 28, 0),
+    "Fallen": ("Fallen", "Night Visions (Deluxe Edition)", 182000, 16, 0),
+    "Nothing Left to Say": ("Nothing Left to Say / Rocks", "Night Visions", 537000, 10, 0),
+    "Tokyo": ("Tokyo", "Night Visions (Deluxe Edition)", 226000, 12, 0),
+    "Real Life": ("Real Life", "Smoke + Mirrors (Deluxe)", 233000, 11, 0),
+    "Cha-Ching": ("Cha-Ching (Till We Grow Older)", "Night Visions", 251000, 9, 0),
+    "Round and Round": ("Round and Round", "Night Visions", 203000, 13, 0),
+    "Cover Up": ("Cover Up", "Imagine Dragons", 198000, 8, 0),
+    # Nothing by the artist meets the criteria for these
+    "Back in Black": (None, None, None, 3, None),
+    "Fed Up": (None, None, None, 2, None),
+    "What's my age": (None, None, None, 0, None),
+}
+
+NAMESPACES = 'xmlns="http://musicbrainz.org/ns/mmd-2.0#" xmlns:ns2="http://musicbrainz.org/ns/ext#-2.0"'
+
+
+def mbid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def artist_credit(name: str = ARTIST[1], artist_id: str = ARTIST[0]) -> str:
+    return (f'<artist-credit><name-credit><artist id="{artist_id}"><name>{escape(name)}</name>'
+            f'<sort-name>{escape(name)}</sort-name></artist></name-credit></artist-credit>')
+
+
+def release_xml(rng: random.Random, title: str, status: str) -> str:
+    return f'<release id="{mbid(rng)}"><title>{escape(title)}</title><status>{status}</status></release>'
+
+
+def recording_xml(rng, score, title, length, releases, credit=None) -> str:
+    length_xml = f"<length>{length}</length>" if length else ""
+    release_list = "".join(release_xml(rng, release, status) for release, status in releases)
+    return (f'<recording id="{mbid(rng)}" ns2:score="{score}"><title>{escape(title)}</title>{length_xml}'
+            f'{credit or artist_credit()}<release-list count="{len(releases)}">{release_list}</release-list>'
+            f'</recording>')
+
+
+def decoy(rng: random.Random, title: str, length: int) -> tuple:
+    """
+    A recording MusicBrainz returns for the query that must not be selected, and why.
+    """
+    kind = rng.choice(("live", "remix", "no_length", "feature", "compilation", "live_album", "bootleg",
+                       "acoustic_single"))
+    base_length = (length or 200000) + rng.randint(-20000, 20000)
+    if kind == "live":
+        return f"{title} (Live)", base_length, [("Night Visions Live", "Official")], None
+    if kind == "remix":
+        return f"{title} (Remix)", base_length, [("Believer (Remixes)", "Official")], None
+    if kind == "no_length":
+        return title, None, [("Night Visions", "Official")], None
+    if kind == "feature":
+        credit = artist_credit(f"{ARTIST[1]} & Kendrick Lamar", mbid(rng))
+        return title, base_length, [("Evolve", "Official")], credit
+    if kind == "compilation":
+        return title, base_length, [("Now That's What I Call Music! 85", "Official")], None
+    if kind == "live_album":
+        return title, base_length, [("Greatest Hits Live in Vegas", "Bootleg")], None
+    if kind == "bootleg":
+        return f"{title} (Spotify Session)", base_length, [("Spotify Singles", "Official")], None
+    return f"{title} (Acoustic)", base_length, [("Live at Rock in Rio", "Official")], None
+
+
+def metadata(entity: str, count: int, offset: int, body: str) -> bytes:
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><metadata {NAMESPACES}>'
+            f'<{entity}-list count="{count}" offset="{offset}">{body}</{entity}-list></metadata>').encode("utf-8")
+
+
+def write(index: list, entity: str, query: str, offset: int, name: str, content: bytes):
+    path = os.path.join(OUTPUT, entity, f"{name}.xml.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb", mtime=0) as gz_file:
+        gz_file.write(content)
+    index.append({"entity": entity, "query": query, "offset": offset,
+                  "file": os.path.relpath(path, OUTPUT).replace(os.sep, "/")})
+
+
+def slug(text: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in text.lower()).strip("_")
+
+
+def generate():
+    rng = random.Random(20240318)
+    index = list()
+
+    artist = (f'<artist id="{ARTIST[0]}" type="Group" ns2:score="100"><name>{ARTIST[1]}</name>'
+              f'<sort-name>{ARTIST[1]}</sort-name></artist>')
+    write(index, "artist", build_search_query(strict=True, artist=ARTIST[1]), 0, slug(ARTIST[1]),
+          metadata("artist", 1, 0, artist))
+
+    release_groups = "".join(
+        f'<release-group id="{mbid(rng)}" type="{kind}" ns2:score="100"><title>{escape(title)}</title>'
+        f'<first-release-date>{date}</first-release-date><primary-type>{kind}</primary-type>{artist_credit()}'
+        f'<release-list count="{len(releases)}">{"".join(release_xml(rng, *r) for r in releases)}</release-list>'
+        f'</release-group>'
+        for title, kind, date, releases in RELEASE_GROUPS)
+    write(index, "release-group", build_search_query(strict=True, arid=ARTIST[0]), 0, ARTIST[0],
+          metadata("release-group", len(RELEASE_GROUPS), 0, release_groups))
+
+    for query, (title, album, length, count, match_page) in SONGS.items():
+        recordings = list()
+        match_position = None
+        if title is not None:
+            match_position = match_page * PAGE + rng.randrange(0, min(PAGE, count - match_page * PAGE))
+        for position in range(count):
+            score = max(100 - position // 3, 30)
+            if position == match_position:
+                releases = [("Now That's What I Call Music! 85", "Official"), (album, "Official")]
+                recordings.append(recording_xml(rng, score, title, length, releases))
+                continue
+            decoy_title, decoy_length, releases, credit = decoy(rng, title or query, length)
+            recordings.append(recording_xml(rng, score, decoy_title, decoy_length, releases, credit))
+
+        lucene = build_search_query(query, strict=True, arid=ARTIST[0])
+        for offset in range(0, max(count, 1), PAGE):
+            write(index, "recording", lucene, offset, f"{slug(query)}-{offset}",
+                  metadata("recording", count, offset, "".join(recordings[offset:offset + PAGE])))
+
+    with open(os.path.join(OUTPUT, "index.json"), "w") as index_file:
+        json.dump(index, index_file, indent=1, ensure_ascii=False)
+    return index
+
+
+if __name__ == "__main__":
+    print(f"{len(generate())} responses written to {OUTPUT}")
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+"""
+Concurrent load test for the /search endpoint of a running instance of the application.
+
+Compare throughput of the two request paths by starting the server with MB_ASYNC=false, then MB_ASYNC=true:
+    python load_test.py --url http://localhost:8080 --concurrency 50 --requests 200
+"""
+
+default_titles = ["Demons", "Believer", "Thunder", "Radioactive", "Bad Liar",
+                  "Natural", "Enemy", "Back in Black", "Fed Up", "What's my age"]
+
+
+async def worker(client: httpx.AsyncClient, url: str, titles: list, counter: list, results: list):
+    while True:
+        if counter[0] <= 0:
+            return
+        counter[0] -= 1
+        title = titles[counter[0] % len(titles)]
+        started = time.perf_counter()
+        try:
+            response = await client.get(f"{url}/search", params={"title": title})
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        results.append((status, time.perf_counter() - started))
+
+
+async def collect(url: str, concurrency: int, total_requests: int, titles: list) -> tuple:
+    """
+    Send total_requests GET /search requests over concurrency parallel connections.
+
+    :return: Tuple (list of (status, latency in seconds) pairs, elapsed seconds)
+    """
+    counter, results = [total_requests], []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client, url, titles, counter, results) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def summarize(results: list, elapsed: float, concurrency: int) -> dict:
+    """
+    Aggregate the (status, latency) pairs collected by one or several collect() calls.
+
+    :return: A dict with elapsed time, requests per second, latency percentiles and status code counts
+    """
+    latencies = sorted(latency for _, latency in results)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    statuses = dict()
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {"requests": len(results),
+            "concurrency": concurrency,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(len(results) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(quantiles[49] * 1000, 1),
+            "p95_ms": round(quantiles[94] * 1000, 1),
+            "p99_ms": round(quantiles[98] * 1000, 1),
+            "statuses": statuses}
+
+
+async def run(url: str, concurrency: int, total_requests: int, titles: list) -> dict:
+    """
+    Send total_requests GET /search requests over concurrency parallel connections.
+
+    :return: A dict with elapsed time, requests per second, latency percentiles and status code counts
+    """
+    results, elapsed = await collect(url, concurrency, total_requests, titles)
+    return summarize(results, elapsed, concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test for the /search endpoint")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--titles", nargs="*", default=default_titles)
+    arguments = parser.parse_args()
+    print(asyncio.run(run(arguments.url, arguments.concurrency, arguments.requests, arguments.titles)))
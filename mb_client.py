@@ -0,0 +1,174 @@
+import os
+import re
+import inspect
+import httpx
+import musicbrainzngs
+from musicbrainzngs import musicbrainz as mb_ws
+
+"""
+Asynchronous client for the MusicBrainz WS/2 search API.
+
+Responses are requested in the same XML format musicbrainzngs uses and are parsed by musicbrainzngs' own parser,
+so the async path receives exactly the same dicts ("recording-list", "artist-credit-phrase", "release-list", ...)
+as the synchronous musicbrainzngs.search_*() functions. Host, protocol and User-Agent follow the musicbrainzngs
+globals (set_hostname(), set_useragent()).
+
+Both paths give up on a request after MB_TIMEOUT seconds. musicbrainzngs opens its requests without any timeout and
+retries 5xx answers and timeouts 8 times with growing delays (up to 56 seconds of sleep), so its request function is
+wrapped to pass the timeout and make at most MB_ATTEMPTS attempts, MB_RETRY_DELAY seconds apart (growing linearly),
+before raising musicbrainzngs.NetworkError. musicbrainzngs has no public setting for either: the wrapped function is
+its private _safe_read(), whose signature is checked on import so that a musicbrainzngs release changing it fails
+loudly instead of silently dropping the timeout. socket.setdefaulttimeout() would be public, but applies to every
+socket of the process.
+"""
+
+client_options = {
+    "timeout": float(os.environ.get("MB_TIMEOUT", 10.0)),
+    "attempts": int(os.environ.get("MB_ATTEMPTS", 2)),
+    "retry_delay": float(os.environ.get("MB_RETRY_DELAY", 0.5)),
+    "max_connections": 10
+}
+
+
+class _TimeoutOpener:
+    """
+    urllib opener passing a timeout to every open() call musicbrainzngs makes.
+    """
+    def __init__(self, opener, timeout: float):
+        self._opener = opener
+        self._timeout = timeout
+
+    def open(self, req, body=None):
+        return self._opener.open(req, body, self._timeout)
+
+
+def _bounded_safe_read(opener, req, body=None, max_retries=None, retry_delay_delta=None):
+    return _musicbrainzngs_safe_read(_TimeoutOpener(opener, client_options.get("timeout")), req, body,
+                                     max_retries=max(client_options.get("attempts"), 1),
+                                     retry_delay_delta=client_options.get("retry_delay"))
+
+
+SAFE_READ_PARAMETERS = ("opener", "req", "body", "max_retries", "retry_delay_delta")
+
+
+def _check_safe_read(safe_read):
+    """
+    :return: safe_read, when it is musicbrainzngs' request function mb_client wraps, raises ImportError otherwise
+    """
+    if safe_read is None or tuple(inspect.signature(safe_read).parameters) != SAFE_READ_PARAMETERS:
+        raise ImportError("musicbrainzngs.musicbrainz._safe_read(%s) is missing or changed, MB_TIMEOUT and "
+                          "MB_ATTEMPTS can not be applied" % ", ".join(SAFE_READ_PARAMETERS))
+    return safe_read
+
+
+_musicbrainzngs_safe_read = _check_safe_read(getattr(mb_ws, "_safe_read", None))
+mb_ws._safe_read = _bounded_safe_read
+
+
+def build_search_query(query: str = "", strict: bool = False, **fields) -> str:
+    """
+    Encode query terms as a Lucene query string, the same way musicbrainzngs._do_mb_search() does.
+
+    :param query: Free text query
+    :param strict: Join quoted terms with AND when True
+    :param fields: Search fields such as artistname="Imagine Dragons"
+
+    :return: A Lucene query string
+    """
+    query_parts = []
+    if query:
+        clean_query = query
+        if fields:
+            clean_query = re.sub(mb_ws.LUCENE_SPECIAL, r'\\\1', clean_query)
+            if strict:
+                query_parts.append('"%s"' % clean_query)
+            else:
+                query_parts.append(clean_query.lower())
+        else:
+            query_parts.append(clean_query)
+    for key, value in fields.items():
+        value = re.sub(mb_ws.LUCENE_SPECIAL, r'\\\1', str(value))
+        if value:
+            if strict:
+                query_parts.append('%s:"%s"' % (key, value))
+            else:
+                query_parts.append('%s:(%s)' % (key, value.lower()))
+    full_query = (' AND ' if strict else ' ').join(query_parts).strip()
+    if not full_query:
+        raise ValueError('at least one query term is required')
+    return full_query
+
+
+def build_any_query(queries, **fields) -> str:
+    """
+    Encode a Lucene query matching any of the quoted phrases, restricted by fields joined with AND, e.g.
+    ("Demons" OR "Believer") AND arid:"012151a8-0f9a-44c9-997f-ebd68b5389f9"
+
+    :param queries: Free text phrases
+    :param fields: Search fields such as arid=artist_mbid
+    :return: A Lucene query string, used as query of a search without fields
+    """
+    phrases = " OR ".join('"%s"' % re.sub(mb_ws.LUCENE_SPECIAL, r'\\\1', query) for query in queries)
+    restrictions = ['%s:"%s"' % (key, re.sub(mb_ws.LUCENE_SPECIAL, r'\\\1', str(value)))
+                    for key, value in fields.items()]
+    return " AND ".join(["(%s)" % phrases] + restrictions)
+
+
+class AsyncMusicBrainzClient:
+    """
+    Thin async wrapper around MusicBrainz WS/2 search endpoints sharing one pooled httpx.AsyncClient.
+    """
+    def __init__(self, timeout: float = client_options.get("timeout"),
+                 max_connections: int = client_options.get("max_connections")):
+        self._timeout = timeout
+        self._limits = httpx.Limits(max_connections=max_connections)
+        self._client = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self._timeout, limits=self._limits)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _search(self, entity: str, query: str, limit: int, offset: int, strict: bool, **fields) -> dict:
+        params = {"query": build_search_query(query, strict=strict, **fields)}
+        if limit:
+            params["limit"] = str(limit)
+        if offset:
+            params["offset"] = str(offset)
+        url = "%s://%s/ws/2/%s" % ("https" if mb_ws.https else "http", mb_ws.hostname, entity)
+        try:
+            response = await self._http().get(url, params=params, headers={"User-Agent": mb_ws._useragent})
+            response.raise_for_status()
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code in (400, 404, 411):
+                raise musicbrainzngs.ResponseError(cause=exc)
+            raise musicbrainzngs.NetworkError(cause=exc)
+        except httpx.HTTPError as exc:
+            raise musicbrainzngs.NetworkError(cause=exc)
+        return mb_ws.mb_parser_xml(response.content)
+
+    async def search_recordings(self, query: str = "", limit: int = None, offset: int = None,
+                                strict: bool = False, **fields) -> dict:
+        """
+        Async counterpart of musicbrainzngs.search_recordings()
+
+        :return: A dict with 'recording-list' and 'recording-count' keys
+        """
+        return await self._search("recording", query, limit, offset, strict, **fields)
+
+    async def search_release_groups(self, query: str = "", limit: int = None, offset: int = None,
+                                    strict: bool = False, **fields) -> dict:
+        """
+        Async counterpart of musicbrainzngs.search_release_groups()
+
+        :return: A dict with 'release-group-list' and 'release-group-count' keys
+        """
+        return await self._search("release-group", query, limit, offset, strict, **fields)
+
+
+mb_async = AsyncMusicBrainzClient()
@@ -0,0 +1,249 @@
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import musicbrainzngs
+from musicbrainzngs import musicbrainz as mb_ws
+
+"""
+Offline stand-in for the MusicBrainz WS/2 search endpoints, replaying the responses stored in fixtures/musicbrainz.
+
+Responses are looked up by (entity, Lucene query, offset), exactly as musicbrainzngs and mb_client request them.
+Unknown queries get an empty result list, like MusicBrainz does. Browsing the recordings of a release
+(/ws/2/recording?release=...) lists the recorded recordings appearing on a release of the same title (recorded
+responses do not hold track lists, editions of an album mostly share theirs). A query OR-ing recorded
+phrases, ("Demons" OR "Believer") AND arid:"...", gets the first pages of those phrases merged by score. Every
+response can be delayed (MB_REPLAY_LATENCY seconds, plus up to MB_REPLAY_JITTER seconds at random) and a share of
+them (MB_REPLAY_ERROR_RATE, 0..1) answered with 503, the status MusicBrainz uses when it throttles. Run standalone:
+    python mb_replay.py --port 8765 --latency 0.05 --error-rate 0.01
+and point the application at it with musicbrainzngs.set_hostname("127.0.0.1:8765"), or in-process with use_replay().
+"""
+
+replay_options = {
+    "fixtures": os.environ.get("MB_REPLAY_FIXTURES",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "musicbrainz")),
+    "latency": float(os.environ.get("MB_REPLAY_LATENCY", 0)),
+    "jitter": float(os.environ.get("MB_REPLAY_JITTER", 0)),
+    "error_rate": float(os.environ.get("MB_REPLAY_ERROR_RATE", 0))
+}
+
+_any_query = re.compile(r'^\((?P<phrases>"(?:[^"\\]|\\.)*"(?: OR "(?:[^"\\]|\\.)*")*)\) AND (?P<fields>.+)$')
+_phrase = re.compile(r'"(?:[^"\\]|\\.)*"')
+_recording = re.compile(rb'<recording [^>]*ns2:score="(\d+)".*?</recording>', re.DOTALL)
+_count = re.compile(rb'<recording-list count="(\d+)"')
+_release = re.compile(rb'<release id="([^"]+)"[^>]*><title>([^<]*)</title>')
+_recording_id = re.compile(rb'<recording id="([^"]+)"')
+_score = re.compile(rb' ns2:score="\d+"')
+_empty_response = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                   '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#"'
+                   ' xmlns:ns2="http://musicbrainz.org/ns/ext#-2.0">'
+                   '<{entity}-list count="0" offset="{offset}"/></metadata>')
+
+
+def load_fixtures(fixtures_dir: str = replay_options.get("fixtures")) -> dict:
+    """
+    Read every recorded response listed in fixtures_dir/index.json.
+
+    :return: A dict {(entity, Lucene query, offset): raw XML bytes}
+    """
+    with open(os.path.join(fixtures_dir, "index.json")) as index_file:
+        index = json.load(index_file)
+    responses = dict()
+    for entry in index:
+        with gzip.open(os.path.join(fixtures_dir, entry["file"])) as response_file:
+            responses[(entry["entity"], entry["query"], entry["offset"])] = response_file.read()
+    return responses
+
+
+def load_pages(entity: str, fixtures_dir: str = replay_options.get("fixtures")) -> list:
+    """
+    Parse every recorded response of an entity the way musicbrainzngs does.
+
+    :return: A list of parsed responses (dicts), in index order
+    """
+    return [mb_ws.mb_parser_xml(raw_response) for (response_entity, _, _), raw_response
+            in load_fixtures(fixtures_dir).items() if response_entity == entity]
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        entity = url.path.rstrip("/").rsplit("/", 1)[-1]
+        params = urllib.parse.parse_qs(url.query)
+        query = params.get("query", [""])[0]
+        offset = int(params.get("offset", [0])[0])
+        release = params.get("release", [None])[0]
+
+        status, body = self.server.respond(entity, query, offset, release=release)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server replaying recorded MusicBrainz search responses, with artificial latency and 503 injection.
+
+    with ReplayServer(latency=0.05, error_rate=0.01) as server, use_replay(server):
+        musicbrainzngs.search_recordings(...)
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple = ("127.0.0.1", 0), fixtures_dir: str = replay_options.get("fixtures"),
+                 latency: float = replay_options.get("latency"), jitter: float = replay_options.get("jitter"),
+                 error_rate: float = replay_options.get("error_rate"), seed: int = None):
+        super().__init__(address, _ReplayHandler)
+        self.responses = load_fixtures(fixtures_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._releases = None
+        self.counters = {"requests": 0, "replayed": 0, "unknown": 0, "errors": 0}
+
+    @property
+    def host(self) -> str:
+        return "%s:%d" % self.server_address[:2]
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def respond(self, entity: str, query: str, offset: int, release: str = None) -> tuple:
+        """
+        Build the reply to one search (or release browse) request, after the configured delay.
+
+        :return: Tuple (HTTP status code, body bytes)
+        """
+        with self._lock:
+            self.counters["requests"] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            self._count("errors")
+            return 503, b"Your requests are exceeding the allowable rate limit."
+        if entity == "recording" and release is not None:
+            body = self._browse(release, offset)
+        else:
+            body = self.responses.get((entity, query, offset))
+        if body is None and entity == "recording" and offset == 0:
+            body = self._merge(query)
+        if body is None:
+            self._count("unknown")
+            return 200, _empty_response.format(entity=entity, offset=offset).encode("utf-8")
+        self._count("replayed")
+        return 200, body
+
+    def handle_error(self, request, client_address):
+        # Clients drop prefetched pages they no longer need, a closed connection is not an error.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def _merge(self, query: str):
+        """
+        Answer ("a" OR "b") AND fields with the recordings of the recorded '"a" AND fields', '"b" AND fields' pages.
+        """
+        match = _any_query.match(query)
+        if match is None:
+            return None
+        pages = [self.responses.get(("recording", f"{phrase} AND {match.group('fields')}", 0))
+                 for phrase in _phrase.findall(match.group("phrases"))]
+        pages = [page for page in pages if page is not None]
+        if not pages:
+            return None
+        recordings = sorted((recording for page in pages for recording in _recording.finditer(page)),
+                            key=lambda recording: -int(recording.group(1)))[:100]
+        count = sum(int(_count.search(page).group(1)) for page in pages)
+        head = _empty_response.format(entity="recording", offset=0).split("<recording-list")[0].encode("utf-8")
+        return (head + b'<recording-list count="%d" offset="0">' % count +
+                b"".join(recording.group(0) for recording in recordings) + b"</recording-list></metadata>")
+
+    def _browse(self, release_id: str, offset: int, limit: int = 100):
+        """
+        Answer a browse of the recordings of a release with the recorded recordings listing a release of that title.
+        """
+        with self._lock:
+            if self._releases is None:
+                titles, by_title = dict(), dict()
+                for (entity, _, _), page in self.responses.items():
+                    for release_id_bytes, title in _release.findall(page):
+                        titles.setdefault(release_id_bytes.decode("ascii"), title)
+                    if entity != "recording":
+                        continue
+                    for recording in _recording.finditer(page):
+                        block = _score.sub(b"", recording.group(0), count=1)
+                        recording_id = _recording_id.match(block).group(1)
+                        for _, title in _release.findall(block):
+                            by_title.setdefault(title, dict()).setdefault(recording_id, block)
+                self._releases = {release: by_title.get(title, dict()) for release, title in titles.items()}
+        recordings = list(self._releases.get(release_id, dict()).values())
+        if not recordings:
+            return None
+        head = _empty_response.format(entity="recording", offset=0).split("<recording-list")[0].encode("utf-8")
+        return (head + b'<recording-list count="%d" offset="%d">' % (len(recordings), offset) +
+                b"".join(recordings[offset:offset + limit]) + b"</recording-list></metadata>")
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="mb-replay", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+@contextmanager
+def use_replay(server: ReplayServer):
+    """
+    Send musicbrainzngs and mb_client requests to a ReplayServer, restoring the previous host afterwards.
+    """
+    previous_hostname, previous_https = mb_ws.hostname, mb_ws.https
+    musicbrainzngs.set_hostname(server.host, use_https=False)
+    try:
+        yield server
+    finally:
+        musicbrainzngs.set_hostname(previous_hostname, use_https=previous_https)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded MusicBrainz search responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default=replay_options.get("fixtures"))
+    parser.add_argument("--latency", type=float, default=replay_options.get("latency"))
+    parser.add_argument("--jitter", type=float, default=replay_options.get("jitter"))
+    parser.add_argument("--error-rate", type=float, default=replay_options.get("error_rate"))
+    arguments = parser.parse_args()
+    replay_server = ReplayServer((arguments.host, arguments.port), fixtures_dir=arguments.fixtures,
+                                 latency=arguments.latency, jitter=arguments.jitter, error_rate=arguments.error_rate)
+    print(f"Replaying {len(replay_server.responses)} responses on http://{replay_server.host}")
+    replay_server.serve_forever()
@@ -0,0 +1,184 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import nullcontext
+from typing import Callable, Iterable, List, Tuple
+
+"""
+Prometheus-style instrumentation of the search path, exposed in the text exposition format by GET /metrics.
+
+    with metrics.stage("filter"):
+        ...
+
+records the duration of a stage in the mb_search_stage_seconds histogram and passes it to every hook registered
+with metrics.add_hook(callback(stage, seconds)), e.g. to forward it to a tracer. With MB_METRICS=false, stage()
+returns a shared no-op context manager and nothing is timed. Counters of errors are always kept (they are rare).
+Statistics kept elsewhere (pool, pages, caches, rate limiter) are added at scrape time by collectors.
+"""
+
+metrics_options = {
+    "enabled": os.environ.get("MB_METRICS", "true").lower() in ("1", "true", "yes"),
+    "buckets": (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+}
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+# A metric family as returned by collectors: (name, type, help, [(sample suffix, labels, value), ...])
+Family = Tuple[str, str, str, List[Tuple[str, dict, float]]]
+
+
+def histogram_samples(buckets: Iterable[float], counts: Iterable[int], total: float, labels: dict = None) -> list:
+    """
+    Samples of one histogram from per-bucket (not cumulative) counts.
+
+    :param buckets: Upper bounds, the last one may be float("inf")
+    :param counts: Number of observations that fell in each bucket
+    :param total: Sum of all observations
+    :return: A list of (suffix, labels, value) samples: cumulative _bucket, _sum and _count
+    """
+    labels = labels or {}
+    samples, cumulative = list(), 0
+    for bucket, count in zip(buckets, counts):
+        cumulative += count
+        samples.append(("_bucket", dict(labels, le="+Inf" if bucket == float("inf") else repr(float(bucket))),
+                        cumulative))
+    if not samples or samples[-1][1]["le"] != "+Inf":
+        samples.append(("_bucket", dict(labels, le="+Inf"), cumulative))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, cumulative))
+    return samples
+
+
+class Histogram:
+    """
+    Thread-safe histogram with one label, e.g. stage.
+    """
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self) -> Family:
+        with self._lock:
+            series = {label_value: (list(counts), total) for label_value, (counts, total) in self._series.items()}
+        samples = list()
+        for label_value, (counts, total) in sorted(series.items()):
+            samples.extend(histogram_samples(self.buckets + (float("inf"),), counts, total,
+                                             {self.label: label_value}))
+        return self.name, "histogram", self.help_text, samples
+
+
+class Counter:
+    """
+    Thread-safe counter with one label, e.g. error type.
+    """
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def collect(self) -> Family:
+        with self._lock:
+            values = dict(self._values)
+        return self.name, "counter", self.help_text, [("", {self.label: label_value}, value)
+                                                      for label_value, value in sorted(values.items())]
+
+
+class _StageTimer:
+    __slots__ = ("_metrics", "_stage", "_started")
+
+    def __init__(self, metrics: "Metrics", stage: str):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.observe(self._stage, time.perf_counter() - self._started)
+
+
+class Metrics:
+    """
+    Stage timings, error counters, tracing hooks and scrape-time collectors of one process.
+    """
+    def __init__(self, enabled: bool = True, buckets: tuple = metrics_options.get("buckets")):
+        self.enabled = enabled
+        self.stage_seconds = Histogram("mb_search_stage_seconds", "Time spent in each stage of a search", "stage",
+                                       buckets)
+        self.errors = Counter("mb_search_errors_total", "Searches answered with 500, by exception type", "type")
+        self.upstream_errors = Counter("mb_upstream_errors_total", "Failed MusicBrainz calls, by exception type",
+                                       "type")
+        self.degraded = Counter("mb_search_degraded_total",
+                                "Searches answered while MusicBrainz was unavailable, by answer", "answer")
+        self.hooks = list()
+        self.collectors = list()
+        self._disabled = nullcontext()
+
+    def stage(self, name: str):
+        """
+        Context manager timing one stage, a no-op when metrics are disabled.
+        """
+        if not self.enabled:
+            return self._disabled
+        return _StageTimer(self, name)
+
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        self.stage_seconds.observe(stage, seconds)
+        for hook in self.hooks:
+            hook(stage, seconds)
+
+    def add_hook(self, hook: Callable[[str, float], None]):
+        """
+        Call hook(stage, seconds) after every timed stage.
+        """
+        self.hooks.append(hook)
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        """
+        Add the metric families returned by collector() to every scrape.
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format (version 0.0.4)
+        """
+        families = [self.stage_seconds.collect(), self.errors.collect(), self.upstream_errors.collect(),
+                    self.degraded.collect()]
+        for collector in self.collectors:
+            families.extend(collector())
+        lines = list()
+        for name, metric_type, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for suffix, labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, str(label_value).replace("\\", r"\\").replace('"', r'\"'))
+                                      for key, label_value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=metrics_options.get("enabled"))
@@ -0,0 +1,194 @@
+import os
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ratelimit import mb_call, mb_call_async
+
+"""
+Paginated MusicBrainz search as a stream of pages.
+
+While the caller filters one page, up to `prefetch` following pages are already being fetched (each still takes a
+token from the shared rate limiter). When the caller stops early, e.g. on a match, pages not yet requested are
+never requested. Pages already in flight are discarded and counted in page_stats.
+"""
+
+pager_options = {
+    "prefetch": int(os.environ.get("MB_PREFETCH_PAGES", 1)),
+    "workers": int(os.environ.get("MB_PREFETCH_WORKERS", 8))
+}
+
+_executor = ThreadPoolExecutor(max_workers=pager_options.get("workers"), thread_name_prefix="mb-prefetch")
+
+
+class PageStats:
+    """
+    Process-wide counters of pages fetched per lookup.
+    """
+    buckets = (1, 2, 3, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.pages_used = 0
+        self.pages_discarded = 0
+        self.histogram = {bucket: 0 for bucket in self.buckets + (float("inf"),)}
+
+    def record(self, pages_used: int, pages_discarded: int):
+        with self._lock:
+            self.lookups += 1
+            self.pages_used += pages_used
+            self.pages_discarded += pages_discarded
+            fetched = pages_used + pages_discarded
+            self.histogram[next(bucket for bucket in self.histogram if fetched <= bucket)] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"lookups": self.lookups,
+                    "pages_used": self.pages_used,
+                    "pages_discarded": self.pages_discarded,
+                    "pages_per_lookup": round((self.pages_used + self.pages_discarded) / self.lookups, 3)
+                    if self.lookups else 0.0,
+                    "histogram": {str(bucket): count for bucket, count in self.histogram.items()}}
+
+
+page_stats = PageStats()
+
+
+class _Pages:
+    def __init__(self, search_fn, entity: str, step: int, initial_offset: int, limit: int, prefetch: int = None,
+                 **query):
+        self.search_fn = search_fn
+        self.entity = entity
+        self.step = step
+        self.initial_offset = initial_offset
+        self.limit = limit
+        self.prefetch = pager_options.get("prefetch") if prefetch is None else prefetch
+        self.query = query
+        self.pages_used = 0
+        self.pages_discarded = 0
+        self._pending = deque()
+        self._iterator = None
+
+    def _offsets(self, count: int):
+        return iter(range(self.initial_offset + self.step, min(count, self.limit), self.step))
+
+    def _request(self, offset: int) -> dict:
+        return dict(self.query, limit=self.step, offset=offset)
+
+
+class PageFetcher(_Pages):
+    """
+    Iterate over raw search responses page by page, prefetching in a thread pool.
+
+    with PageFetcher(musicbrainzngs.search_recordings, "recording", step=100, initial_offset=0, limit=1000,
+                     query="Believer", arid=artist_mbid, strict=True) as pages:
+        for raw_api_response in pages:
+            ...
+    """
+    def _fill(self, offsets):
+        while len(self._pending) < self.prefetch:
+            offset = next(offsets, None)
+            if offset is None:
+                return
+            self._pending.append(_executor.submit(mb_call, self.search_fn, **self._request(offset)))
+
+    def __iter__(self):
+        self._iterator = self._iterate()
+        return self._iterator
+
+    def _iterate(self):
+        raw_api_response = mb_call(self.search_fn, **self._request(self.initial_offset))
+        self.pages_used += 1
+        yield raw_api_response
+
+        offsets = self._offsets(raw_api_response.get(f"{self.entity}-count", 0))
+        self._fill(offsets)
+        while True:
+            if self._pending:
+                future = self._pending.popleft()
+                # Keep `prefetch` pages in flight while this one is awaited and filtered.
+                self._fill(offsets)
+                raw_api_response = future.result()
+            else:
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+                raw_api_response = mb_call(self.search_fn, **self._request(offset))
+            self.pages_used += 1
+            yield raw_api_response
+
+    def close(self):
+        if self._iterator is not None:
+            self._iterator.close()
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.cancel():
+                self.pages_discarded += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        page_stats.record(self.pages_used, self.pages_discarded)
+
+
+class AsyncPageFetcher(_Pages):
+    """
+    Async counterpart of PageFetcher for mb_client coroutines, prefetching in asyncio tasks.
+
+    async with AsyncPageFetcher(mb_async.search_recordings, ...) as pages:
+        async for raw_api_response in pages:
+            ...
+    """
+    def _fill(self, offsets):
+        while len(self._pending) < self.prefetch:
+            offset = next(offsets, None)
+            if offset is None:
+                return
+            self._pending.append(asyncio.ensure_future(mb_call_async(self.search_fn, **self._request(offset))))
+
+    def __aiter__(self):
+        self._iterator = self._iterate()
+        return self._iterator
+
+    async def _iterate(self):
+        raw_api_response = await mb_call_async(self.search_fn, **self._request(self.initial_offset))
+        self.pages_used += 1
+        yield raw_api_response
+
+        offsets = self._offsets(raw_api_response.get(f"{self.entity}-count", 0))
+        self._fill(offsets)
+        while True:
+            if self._pending:
+                task = self._pending.popleft()
+                # Keep `prefetch` pages in flight while this one is awaited and filtered.
+                self._fill(offsets)
+                raw_api_response = await task
+            else:
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+                raw_api_response = await mb_call_async(self.search_fn, **self._request(offset))
+            self.pages_used += 1
+            yield raw_api_response
+
+    async def aclose(self):
+        if self._iterator is not None:
+            await self._iterator.aclose()
+        while self._pending:
+            task = self._pending.popleft()
+            if task.done():
+                self.pages_discarded += 1
+                if not task.cancelled():
+                    # Retrieve the outcome so a failed, discarded page is not reported as an unhandled error.
+                    task.exception()
+            task.cancel()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+        page_stats.record(self.pages_used, self.pages_discarded)
@@ -0,0 +1,250 @@
+import os
+import re
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from cache import LRUCache
+from sql import db_session, db_get_cached_result, db_get_cached_results, db_clear_query_cache, \
+    db_backfill_query_cache, db_get_recent_cached_results
+from write_behind import write_behind
+from cache_sync import cache_sync
+
+"""
+Cache of query results keyed by (artist MBID, normalized query).
+
+Two tiers: a bounded in-process LRU in front of the query_cache table. Both successful (track) and unsuccessful
+(no match) results are cached, so repeated hits and repeated misses are answered without calling MusicBrainz.
+Negative entries expire after MB_NEGATIVE_CACHE_TTL seconds, positive ones after MB_CACHE_TTL (never by default).
+New entries go to memory at once and to the table through the write-behind queue (write_behind.py).
+The table is shared by every worker process; clear() in one of them is propagated to the others by cache_sync.py.
+Expired entries are kept (in memory until evicted, in the table until replaced) for get_stale(), which answers from
+them while MusicBrainz is unavailable.
+"""
+
+query_cache_options = {
+    "positive_ttl": int(os.environ.get("MB_CACHE_TTL", 0)) or None,
+    "negative_ttl": int(os.environ.get("MB_NEGATIVE_CACHE_TTL", 24 * 60 * 60)),
+    "memory_entries": int(os.environ.get("MB_CACHE_MEMORY_ENTRIES", 10000))
+}
+
+_non_word = re.compile(r"[^\w\s]+")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Cache key of a user query: Unicode-normalized, case-folded, punctuation removed, whitespace collapsed.
+
+    "Whatever it Takes", "whatever  it takes!" and "WHATEVER IT TAKES" share one key.
+
+    :param query: User's input query
+    :return: Normalized query string
+    """
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = _non_word.sub(" ", query.replace("'", "").replace("’", ""))
+    return _whitespace.sub(" ", query).strip()
+
+
+class QueryCache:
+    """
+    Two-tier (memory, then database) cache of query results with hit/miss counters.
+
+    get() returns None on a miss, otherwise a tuple (track_id, track, expires_on) where track is a
+    (title, artist, album, length) tuple, or None for a cached "no match". track_id is None until the entry is
+    written to the database, check track to tell a match from a "no match".
+    """
+    def __init__(self, memory_entries: int, positive_ttl: int = None, negative_ttl: int = None):
+        self.memory = LRUCache(max_entries=memory_entries)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.forget_handlers = list()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "db_hits": 0, "negative_hits": 0, "misses": 0, "expired": 0,
+                         "stale_hits": 0}
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def expires_on(self, found: bool):
+        """
+        :return: Expiry of a new entry, positive when the query found a track, negative otherwise (None: never)
+        """
+        ttl = self.positive_ttl if found else self.negative_ttl
+        return datetime.now() + timedelta(seconds=ttl) if ttl else None
+
+    def get(self, search_session, artist_mbid: str, query: str):
+        """
+        Look the query up in memory, then in query_cache table.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the artist the query is restricted to
+        :param query: User's input query (normalized here)
+        :return: None on a miss, (track_id, track, expires_on) on a hit
+        """
+        key = (artist_mbid, normalize_query(query))
+        entry, tier = self.memory.get(key), "memory_hits"
+        if entry is None:
+            entry, tier = db_get_cached_result(search_session, *key), "db_hits"
+        if entry is None:
+            self._count("misses")
+            return None
+
+        track_id, track, expires_on = entry
+        if expires_on is not None and expires_on <= datetime.now():
+            self._count("expired")
+            self._count("misses")
+            return None
+
+        self.memory.put(key, entry)
+        self._count(tier)
+        if track is None:
+            self._count("negative_hits")
+        return entry
+
+    def peek(self, artist_mbid: str, query: str):
+        """
+        Memory-only lookup, expired entries included, without counting a hit or a miss.
+
+        :return: None if the query is not in the memory tier, otherwise (track_id, track, expires_on)
+        """
+        return self.memory.get((artist_mbid, normalize_query(query)))
+
+    def get_stale(self, search_session, artist_mbid: str, query: str):
+        """
+        Look the query up like get(), expired entries included. Used to answer while MusicBrainz is unavailable.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the artist the query is restricted to
+        :param query: User's input query (normalized here)
+        :return: None if the query was never cached, otherwise (track_id, track, expires_on)
+        """
+        key = (artist_mbid, normalize_query(query))
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = db_get_cached_result(search_session, *key)
+        if entry is not None:
+            self._count("stale_hits")
+        return entry
+
+    def get_many(self, search_session, artist_mbid: str, queries) -> dict:
+        """
+        Bulk counterpart of get(): memory first, then a single IN query for the remaining normalized queries.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the artist the queries are restricted to
+        :param queries: Iterable of user queries (normalized here, duplicates looked up once)
+        :return: A dict {normalized query: (track_id, track, expires_on)} of the hits only
+        """
+        query_keys = {normalize_query(query) for query in queries}
+        entries, tiers = dict(), dict()
+        for query_key in query_keys:
+            entry = self.memory.get((artist_mbid, query_key))
+            if entry is not None:
+                entries[query_key], tiers[query_key] = entry, "memory_hits"
+        stored = db_get_cached_results(search_session, artist_mbid, query_keys - entries.keys())
+        entries.update(stored)
+        tiers.update(dict.fromkeys(stored, "db_hits"))
+
+        now, hits = datetime.now(), dict()
+        for query_key in query_keys:
+            entry = entries.get(query_key)
+            if entry is not None and entry[2] is not None and entry[2] <= now:
+                self._count("expired")
+                entry = None
+            if entry is None:
+                self._count("misses")
+                continue
+            self.memory.put((artist_mbid, query_key), entry)
+            self._count(tiers[query_key])
+            if entry[1] is None:
+                self._count("negative_hits")
+            hits[query_key] = entry
+        return hits
+
+    def put(self, artist_mbid: str, query: str, track: tuple = None):
+        """
+        Store the result of a query in memory and queue it for query_cache table. track None stores a negative
+        ("no match") entry. The track itself is stored in tracks table along with the entry.
+
+        :param artist_mbid: MusicBrainz ID of the artist the query was restricted to
+        :param query: User's input query (normalized here)
+        :param track: Tuple of strings (Title, Artist, Album, Length) of the matching Track
+        """
+        key = (artist_mbid, normalize_query(query))
+        expires_on = self.expires_on(track is not None)
+        self.memory.put(key, (None, track, expires_on))
+        write_behind.put_result(*key, track, expires_on)
+
+    def on_forget(self, handler):
+        """
+        Call handler(artist_mbid) whenever results are dropped, locally or by another worker, e.g. to drop copies
+        of them kept elsewhere.
+        """
+        self.forget_handlers.append(handler)
+
+    def forget(self, artist_mbid: str = None):
+        """
+        Drop cached results from the memory tier only, of one artist or all of them.
+        """
+        if artist_mbid is None:
+            self.memory.clear()
+        else:
+            for key in [key for key in self.memory.keys() if key[0] == artist_mbid]:
+                self.memory.pop(key)
+        for handler in self.forget_handlers:
+            handler(artist_mbid)
+
+    def clear(self, search_session, artist_mbid: str = None) -> int:
+        """
+        Drop cached results from both tiers, of one artist or all of them, in every worker process.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the artist whose entries are dropped, None to drop every entry
+        :return: Number of entries deleted from query_cache table
+        """
+        self.forget(artist_mbid)
+        deleted = db_clear_query_cache(search_session, artist_mbid)
+        cache_sync.publish("query_cache", artist_mbid)
+        return deleted
+
+    def warm(self, search_session, limit: int) -> int:
+        """
+        Fill the memory tier with the most recent unexpired entries of query_cache table, e.g. in a new worker.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param limit: Maximum number of entries, capped by the size of the memory tier
+        :return: Number of loaded entries
+        """
+        entries = db_get_recent_cached_results(search_session, min(limit, self.memory.max_entries))
+        # Oldest first, so the most recent entries end up as the most recently used ones.
+        for key, entry in reversed(entries):
+            self.memory.put(key, entry)
+        return len(entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        hits = counters["memory_hits"] + counters["db_hits"]
+        counters["hit_ratio"] = round(hits / (hits + counters["misses"]), 4) if hits + counters["misses"] else 0.0
+        counters["memory"] = self.memory.stats()
+        return counters
+
+
+query_cache = QueryCache(memory_entries=query_cache_options.get("memory_entries"),
+                         positive_ttl=query_cache_options.get("positive_ttl"),
+                         negative_ttl=query_cache_options.get("negative_ttl"))
+cache_sync.subscribe("query_cache", query_cache.forget)
+
+
+def backfill_query_cache() -> int:
+    """
+    Seed an empty query_cache table from the searches log, where older versions kept their results.
+
+    :return: Number of created cache entries
+    """
+    session = db_session()
+    try:
+        return db_backfill_query_cache(session, normalize_query)
+    finally:
+        session.close()
@@ -0,0 +1,172 @@
+import os
+import time
+import threading
+from typing import Iterable, List, Mapping, NamedTuple, Optional, Tuple
+from cache import LRUCache
+from query_cache import normalize_query
+from recording_index import trigrams
+from recording_filter import Candidate
+
+"""
+Ranking of the recordings that met the search criteria, across every page fetched for a query.
+
+Each candidate gets a confidence between 0 and 1, the weighted sum of:
+ - title: trigram similarity of its normalized title to the normalized query (1.0 for the same title)
+ - score: MusicBrainz search score (ext:score) / 100
+ - album: place of its album in the discography, 1.0 for the earliest official release, 0.0 for the latest
+The best candidate seen so far is kept while pages are fetched, and pagination stops as soon as it reaches
+MB_MATCH_CONFIDENCE (default 0.75: the same title with some support from score or album). Otherwise every page up to
+the search limit is fetched and the best candidate of all of them is kept.
+
+The candidates of every query (MB_RANKED_CANDIDATES best ones, default 20) are kept in memory for
+MB_CANDIDATE_CACHE_TTL seconds (default 86400), bounded to MB_CANDIDATE_CACHE_ENTRIES queries (default 10000). When
+the result of a query was dropped (query_cache.clear(), here or in another worker) they are ranked again, against
+the current discography, instead of fetching the pages again.
+"""
+
+ranking_options = {
+    "threshold": float(os.environ.get("MB_MATCH_CONFIDENCE", 0.75)),
+    "weights": {"title": 0.7, "score": 0.2, "album": 0.1},
+    "candidates": int(os.environ.get("MB_RANKED_CANDIDATES", 20)),
+    "cache_entries": int(os.environ.get("MB_CANDIDATE_CACHE_ENTRIES", 10000)),
+    "cache_ttl": int(os.environ.get("MB_CANDIDATE_CACHE_TTL", 24 * 60 * 60))
+}
+
+
+class ScoredCandidate(NamedTuple):
+    confidence: float
+    candidate: Candidate
+
+
+def title_similarity(query_key: str, title: str) -> float:
+    """
+    :param query_key: A query normalized by query_cache.normalize_query()
+    :param title: Title of a recording, as given by MusicBrainz
+    :return: |common trigrams| / |all trigrams| of both normalized strings, 1.0 when they are the same
+    """
+    title_key = normalize_query(title)
+    if title_key == query_key:
+        return 1.0
+    query_grams, title_grams = trigrams(query_key), trigrams(title_key)
+    if not query_grams or not title_grams:
+        return 0.0
+    common = len(query_grams & title_grams)
+    return common / (len(query_grams) + len(title_grams) - common)
+
+
+def confidence(candidate: Candidate, query_key: str, positions: Mapping[str, int],
+               weights: dict = ranking_options.get("weights")) -> float:
+    """
+    :param candidate: A Candidate tuple returned by RecordingFilter.filter_page()
+    :param query_key: The normalized query
+    :param positions: {album: place in the discography}, as Discography.positions
+    :return: The confidence of the candidate, between 0 and 1
+    """
+    position = positions.get(candidate.album)
+    album = 1.0 - position / max(len(positions) - 1, 1) if position is not None else 0.0
+    return (weights["title"] * title_similarity(query_key, candidate.title) +
+            weights["score"] * min(candidate.score, 100) / 100 +
+            weights["album"] * album)
+
+
+def rank_candidates(candidates: Iterable[Candidate], query: str, positions: Mapping[str, int]) \
+        -> List[ScoredCandidate]:
+    """
+    :param candidates: Candidate tuples, in the order they were found
+    :param query: User's input query
+    :param positions: {album: place in the discography}, as Discography.positions
+    :return: ScoredCandidate tuples, best first: highest confidence, then highest score, then first found
+    """
+    query_key = normalize_query(query)
+    scored = [ScoredCandidate(confidence(candidate, query_key, positions), candidate) for candidate in candidates]
+    scored.sort(key=lambda scored_candidate: (-scored_candidate.confidence, -scored_candidate.candidate.score))
+    return scored
+
+
+class Ranking:
+    """
+    Best candidate among the pages of one lookup, updated page by page.
+    """
+    def __init__(self, query: str, positions: Mapping[str, int], threshold: float = ranking_options.get("threshold"),
+                 keep: int = ranking_options.get("candidates")):
+        self.query = query
+        self.positions = positions
+        self.threshold = threshold
+        self.keep = keep
+        self.ranked = list()
+
+    def add(self, candidates: List[Candidate]) -> Optional[ScoredCandidate]:
+        """
+        Rank the candidates of a new page along with the best ones of the previous pages.
+
+        :return: The best ScoredCandidate so far, None when no page had any candidate
+        """
+        if candidates:
+            ranked = rank_candidates(candidates, self.query, self.positions)
+            # Stable sort: on a tie, candidates of earlier pages stay first.
+            self.ranked = sorted(self.ranked + ranked, key=lambda scored_candidate: (
+                -scored_candidate.confidence, -scored_candidate.candidate.score))[:self.keep]
+        return self.best()
+
+    def best(self) -> Optional[ScoredCandidate]:
+        return self.ranked[0] if self.ranked else None
+
+    def confident(self) -> bool:
+        """
+        :return: True when the best candidate is good enough to stop fetching pages
+        """
+        return bool(self.ranked) and self.ranked[0].confidence >= self.threshold
+
+    def candidates(self) -> Tuple[Candidate, ...]:
+        return tuple(scored_candidate.candidate for scored_candidate in self.ranked)
+
+
+class CandidateCache:
+    """
+    Bounded LRU of the ranked candidates of queries, {(artist_mbid, normalized query): (candidates, expires_on)}.
+    """
+    def __init__(self, entries: int, ttl: int):
+        self.memory = LRUCache(max_entries=entries)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stored": 0, "confident": 0, "exhausted": 0}
+
+    def count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def get(self, artist_mbid: str, query: str) -> Optional[Tuple[Candidate, ...]]:
+        """
+        :return: The candidates of the query, best first when they were stored, None on a miss or when expired
+        """
+        key = (artist_mbid, normalize_query(query))
+        entry = self.memory.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            self.memory.pop(key)
+            entry = None
+        self.count("misses" if entry is None else "hits")
+        return entry[0] if entry is not None else None
+
+    def put(self, artist_mbid: str, query: str, ranking: Ranking):
+        """
+        Keep the candidates of a finished lookup, and count how it finished. Lookups without any are not kept, the
+        query result cache holds their "no match".
+        """
+        self.count("confident" if ranking.confident() else "exhausted")
+        if not ranking.ranked:
+            return
+        self.memory.put((artist_mbid, normalize_query(query)), (ranking.candidates(), time.monotonic() + self.ttl))
+        self.count("stored")
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters["memory"] = self.memory.stats()
+        return counters
+
+
+candidate_cache = CandidateCache(entries=ranking_options.get("cache_entries"),
+                                 ttl=ranking_options.get("cache_ttl"))
@@ -0,0 +1,398 @@
+import os
+import time
+import asyncio
+import threading
+import musicbrainzngs
+from sql import db_session, db_reserve_token
+from metrics import metrics
+
+"""
+Process-wide (optionally cross-worker) token bucket for outbound MusicBrainz calls, and request coalescing.
+
+Every musicbrainzngs / mb_client call goes through mb_call() or mb_call_async(), which check mb_breaker and take a
+token from mb_limiter before calling upstream. The bucket backend is chosen with MB_RATE_BACKEND:
+ - "local"    - tokens kept in memory, shared by all threads and coroutines of one process (default)
+ - "file"     - tokens kept in a flock()-protected file, shared by all workers on one host (MB_RATE_FILE)
+ - "postgres" - tokens kept in rate_limit_buckets table, serialized with an advisory lock, shared by every host
+After MB_BREAKER_FAILURES consecutive failed calls (network errors, timeouts, 5xx answers) the circuit breaker opens:
+calls raise CircuitOpen at once for MB_BREAKER_RESET seconds, then one probe call is let through (half-open), which
+closes the circuit on success and opens it again on failure.
+A call whose token would only be valid more than MB_RATE_MAX_WAIT seconds from now does not take it and raises
+RateLimited, answered like an open circuit (503 with Retry-After, or the stale result) instead of queueing for ever.
+"""
+
+limiter_options = {
+    "rate": float(os.environ.get("MB_RATE_LIMIT", 1.0)),
+    "burst": float(os.environ.get("MB_RATE_BURST", 1)),
+    "max_wait": float(os.environ.get("MB_RATE_MAX_WAIT", 10)),
+    "backend": os.environ.get("MB_RATE_BACKEND", "local"),
+    "file": os.environ.get("MB_RATE_FILE", "/tmp/mb_rate_limit.bucket"),
+    "bucket_name": "musicbrainz"
+}
+
+breaker_options = {
+    "failures": int(os.environ.get("MB_BREAKER_FAILURES", 5)),
+    "reset_timeout": float(os.environ.get("MB_BREAKER_RESET", 30))
+}
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, capacity: float, max_wait: float):
+    """
+    Add tokens accumulated since `updated`, then take one. Tokens may go negative, which reserves a future slot, unless
+    that slot is more than `max_wait` seconds away: the token is not taken then.
+
+    :return: Remaining tokens and seconds the caller has to wait before its token becomes valid
+    """
+    tokens = min(capacity, tokens + max(now - updated, 0.0) * rate)
+    wait = (1.0 - tokens) / rate if tokens < 1.0 else 0.0
+    if wait <= max_wait:
+        tokens -= 1.0
+    return tokens, wait
+
+
+class LocalBucketBackend:
+    blocking = False
+
+    def __init__(self, capacity: float):
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self, rate: float, capacity: float, max_wait: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, wait = _refill(self._tokens, self._updated, now, rate, capacity, max_wait)
+            self._updated = now
+            return wait
+
+
+class FileBucketBackend:
+    blocking = True
+
+    def __init__(self, path: str, capacity: float):
+        self.path = path
+        self._capacity = capacity
+        self._lock = threading.Lock()
+
+    def reserve(self, rate: float, capacity: float, max_wait: float) -> float:
+        import fcntl
+        with self._lock, open(self.path, "a+") as bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            try:
+                bucket_file.seek(0)
+                state = bucket_file.read().split()
+                now = time.time()
+                tokens, updated = (float(state[0]), float(state[1])) if len(state) == 2 else (self._capacity, now)
+                tokens, wait = _refill(tokens, updated, now, rate, capacity, max_wait)
+                bucket_file.seek(0)
+                bucket_file.truncate()
+                bucket_file.write(f"{tokens} {now}")
+                bucket_file.flush()
+            finally:
+                fcntl.flock(bucket_file, fcntl.LOCK_UN)
+        return wait
+
+
+class PostgresBucketBackend:
+    blocking = True
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def reserve(self, rate: float, capacity: float, max_wait: float) -> float:
+        session = db_session()
+        try:
+            return db_reserve_token(session, self.name, rate, capacity, max_wait, _refill)
+        finally:
+            session.close()
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` calls per second with bursts of up to `burst` calls, waiting at most `max_wait`
+    seconds for a token.
+    """
+    def __init__(self, rate: float, burst: float, backend, max_wait: float = limiter_options.get("max_wait")):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.max_wait = max_wait
+        self.backend = backend
+        self._stats_lock = threading.Lock()
+        self.acquired = 0
+        self.refused = 0
+        self.wait_seconds_total = 0.0
+
+    def _account(self, wait: float):
+        if wait > self.max_wait:
+            with self._stats_lock:
+                self.refused += 1
+            raise RateLimited(wait)
+        with self._stats_lock:
+            self.acquired += 1
+            self.wait_seconds_total += wait
+
+    def acquire(self) -> float:
+        """
+        Block the calling thread until a token is available, raise RateLimited when it is more than max_wait away.
+
+        :return: Seconds spent waiting
+        """
+        wait = self.backend.reserve(self.rate, self.capacity, self.max_wait)
+        self._account(wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        """
+        Suspend the calling coroutine until a token is available, raise RateLimited when it is more than max_wait away.
+
+        :return: Seconds spent waiting
+        """
+        if self.backend.blocking:
+            wait = await asyncio.to_thread(self.backend.reserve, self.rate, self.capacity, self.max_wait)
+        else:
+            wait = self.backend.reserve(self.rate, self.capacity, self.max_wait)
+        self._account(wait)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class CircuitOpen(musicbrainzngs.NetworkError):
+    """
+    Raised instead of calling MusicBrainz while the circuit breaker is open, handled like any other NetworkError.
+    """
+    def __init__(self, retry_after: float):
+        super().__init__(message="MusicBrainz circuit breaker is open, retry in %.0f seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+class RateLimited(musicbrainzngs.NetworkError):
+    """
+    Raised instead of calling MusicBrainz when the next token of the rate limiter is too far away, handled like any
+    other NetworkError but not counted as a failure by the circuit breaker.
+    """
+    def __init__(self, retry_after: float):
+        super().__init__(message="MusicBrainz rate limit reached, retry in %.0f seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of the calls to MusicBrainz: closed, open after `failures` consecutive failures, half-open (a
+    single probe call allowed) once `reset_timeout` seconds have passed.
+    """
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = max(failures, 1)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.counters = {"opened": 0, "rejected": 0}
+
+    def _open(self):
+        if self.state != "open":
+            self.counters["opened"] += 1
+        self.state = "open"
+        self._opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        """
+        :return: Seconds until the next probe call is allowed, 0 when the circuit is closed
+        """
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            return max(self._opened_at + self.reset_timeout - time.monotonic(), 1.0)
+
+    def before_call(self):
+        """
+        Raise CircuitOpen unless the circuit is closed or this call is the half-open probe.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.counters["rejected"] += 1
+        raise CircuitOpen(max(remaining, 1.0))
+
+    def record(self, error: BaseException = None):
+        """
+        Account for the outcome of a call let through by before_call().
+
+        :param error: The exception the call raised, None on success. Only musicbrainzngs.NetworkError (timeouts
+                      and 5xx answers included) counts as a failure, MusicBrainz answered anything else.
+        """
+        with self._lock:
+            if error is None or isinstance(error, musicbrainzngs.ResponseError):
+                self._failed, self._probing, self.state = 0, False, "closed"
+            elif isinstance(error, musicbrainzngs.NetworkError) and not isinstance(error, RateLimited):
+                self._failed += 1
+                self._probing = False
+                if self.state == "half_open" or self._failed >= self.failures:
+                    self._open()
+            else:
+                # Cancelled or failed on our side: neither outcome, let another probe through.
+                self._probing = False
+
+    def trip(self):
+        """
+        Open the circuit now, e.g. during maintenance of the upstream service.
+        """
+        with self._lock:
+            self._open()
+
+    def reset(self):
+        """
+        Close the circuit now.
+        """
+        with self._lock:
+            self._failed, self._probing, self.state = 0, False, "closed"
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            counters.update({"state": self.state, "consecutive_failures": self._failed})
+        return counters
+
+
+class SingleFlight:
+    """
+    Run a function once per key at a time; threads calling do() with a key already in flight wait for its result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+class AsyncSingleFlight:
+    """
+    Coroutine counterpart of SingleFlight, for callers running on one event loop.
+    """
+    def __init__(self):
+        self._calls = dict()
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_fn, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await coroutine_fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, there may be no follower awaiting it.
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+
+def build_limiter(options: dict = limiter_options) -> TokenBucket:
+    """
+    Create a TokenBucket with the backend selected in options.
+
+    :return: A TokenBucket object
+    """
+    backend_name = options.get("backend")
+    if backend_name == "file":
+        backend = FileBucketBackend(options.get("file"), options.get("burst"))
+    elif backend_name == "postgres":
+        backend = PostgresBucketBackend(options.get("bucket_name"))
+    else:
+        backend = LocalBucketBackend(options.get("burst"))
+    return TokenBucket(rate=options.get("rate"), burst=options.get("burst"), backend=backend,
+                       max_wait=options.get("max_wait"))
+
+
+mb_limiter = build_limiter()
+mb_breaker = CircuitBreaker(failures=breaker_options.get("failures"),
+                            reset_timeout=breaker_options.get("reset_timeout"))
+# All calls are paced by mb_limiter, musicbrainzngs' own per-process limiter would only add a second wait.
+musicbrainzngs.set_rate_limit(False)
+
+
+def mb_call(fn, *args, **kwargs):
+    """
+    Call a musicbrainzngs function once the circuit breaker and the shared rate limiter allow it.
+
+    Raises CircuitOpen without calling MusicBrainz while the circuit breaker is open, and RateLimited when no token is
+    available within mb_limiter.max_wait seconds.
+    """
+    mb_breaker.before_call()
+    try:
+        # Inside the try: a half-open probe failing or interrupted while it waits still releases the probe.
+        with metrics.stage("rate_limit_wait"):
+            mb_limiter.acquire()
+        with metrics.stage(f"mb_{fn.__name__}"):
+            result = fn(*args, **kwargs)
+    except BaseException as e:
+        mb_breaker.record(e)
+        if isinstance(e, musicbrainzngs.WebServiceError) and not isinstance(e, RateLimited):
+            metrics.upstream_errors.inc(type(e).__name__)
+        raise
+    mb_breaker.record()
+    return result
+
+
+async def mb_call_async(coroutine_fn, *args, **kwargs):
+    """
+    Await an mb_client coroutine once the circuit breaker and the shared rate limiter allow it.
+    """
+    mb_breaker.before_call()
+    try:
+        with metrics.stage("rate_limit_wait"):
+            await mb_limiter.acquire_async()
+        with metrics.stage(f"mb_{coroutine_fn.__name__}"):
+            result = await coroutine_fn(*args, **kwargs)
+    except BaseException as e:
+        mb_breaker.record(e)
+        if isinstance(e, musicbrainzngs.WebServiceError) and not isinstance(e, RateLimited):
+            metrics.upstream_errors.inc(type(e).__name__)
+        raise
+    mb_breaker.record()
+    return result
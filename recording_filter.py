@@ -0,0 +1,77 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple
+
+
+class Candidate(NamedTuple):
+    title: str
+    artist: str
+    album: str
+    length: str
+    score: int
+    position: int
+
+
+@lru_cache(maxsize=64)
+def compile_stop_words(stop_words: frozenset):
+    """
+    Compile a set of stop words into one case-insensitive regex matching any of them anywhere in a string.
+
+    :param stop_words: A frozenset of stop words
+    :return: A compiled regex, None when there are no stop words
+    """
+    if not stop_words:
+        return None
+    alternatives = sorted((re.escape(word.lower()) for word in stop_words if word), key=len, reverse=True)
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+def format_length(milliseconds: int) -> str:
+    """
+    Format a recording length as MM:SS (hours are dropped, as in the original timedelta formatting).
+    """
+    minutes, seconds = divmod((int(milliseconds) // 1000) % 3600, 60)
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+class RecordingFilter:
+    """
+    Evaluates a whole page of musicbrainzngs recordings against the search criteria at once.
+
+    A recording is a candidate when it has a length, its artist-credit-phrase is artist_name, its title contains
+    none of the stop words, and one of its releases is an album of the discography (the first such release, in
+    release-list order, becomes the candidate's album).
+    """
+    def __init__(self, artist_name: str, discography: Iterable[str], stop_words: Iterable[str]):
+        self.artist_name = artist_name
+        self.discography = discography if isinstance(discography, (set, frozenset, dict)) else frozenset(discography)
+        self.stop_words = compile_stop_words(frozenset(stop_words))
+
+    def filter_page(self, raw_recording_list: list) -> List[Candidate]:
+        """
+        Return every recording of the page that meets the criteria, best first.
+
+        Candidates are ranked by MusicBrainz search score, then by their position within the page.
+
+        :param raw_recording_list: A raw list of recordings sent as part of response by MB.search_recordings() method
+        :return: A list of Candidate tuples
+        """
+        artist_name = self.artist_name
+        discography = self.discography
+        stop_words = self.stop_words
+        candidates = list()
+        for position, raw_record in enumerate(raw_recording_list):
+            length = raw_record.get("length")
+            if not length or raw_record.get("artist-credit-phrase") != artist_name:
+                continue
+            title = raw_record.get("title", "")
+            if stop_words is not None and stop_words.search(title):
+                continue
+            album = next((release.get("title") for release in raw_record.get("release-list", ())
+                          if release.get("title") in discography), None)
+            if album is None:
+                continue
+            candidates.append(Candidate(title, artist_name, album, format_length(length),
+                                        int(raw_record.get("ext:score", 0)), position))
+        candidates.sort(key=lambda candidate: (-candidate.score, candidate.position))
+        return candidates
@@ -0,0 +1,178 @@
+import os
+import threading
+from typing import Iterable, Optional, Tuple
+from cache import LRUCache
+from query_cache import normalize_query
+from sql import db_put_recordings, db_retrieve_recordings
+from cache_sync import cache_sync
+
+"""
+Local per-artist index of recordings for fuzzy title matching without calling MusicBrainz.
+
+Every recording that met the search criteria on a page fetched from MusicBrainz (not only the one returned) is kept
+in recordings table, stored tracks are indexed too. In memory, each artist gets a trigram index of normalized titles
+(pg_trgm style: words padded with two leading and one trailing space). A query is answered locally when the
+similarity |common trigrams| / |all trigrams| of its best match reaches MB_LOCAL_INDEX_THRESHOLD (1.0 = same
+normalized title only). MB_LOCAL_INDEX=false turns the index off.
+"""
+
+index_options = {
+    "enabled": os.environ.get("MB_LOCAL_INDEX", "true").lower() in ("1", "true", "yes"),
+    "threshold": float(os.environ.get("MB_LOCAL_INDEX_THRESHOLD", 0.8)),
+    "artists": int(os.environ.get("MB_LOCAL_INDEX_ARTISTS", 64))
+}
+
+Track = Tuple[str, str, str, str]
+
+
+def trigrams(normalized_text: str) -> frozenset:
+    """
+    :param normalized_text: A string normalized by query_cache.normalize_query()
+    :return: The set of trigrams of every word, pg_trgm style
+    """
+    grams = set()
+    for word in normalized_text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+class RecordingIndex:
+    """
+    Trigram index of the known recordings of one artist.
+
+    For every normalized title only the best recording is kept: highest search score, then first seen.
+    """
+    def __init__(self):
+        self.entries = dict()
+        self.postings = dict()
+        self._lock = threading.Lock()
+
+    def add(self, title: str, artist: str, album: str, length: str, score: int = 0) -> str:
+        """
+        :return: The normalized title the recording is indexed under
+        """
+        title_key = normalize_query(title)
+        grams = trigrams(title_key)
+        with self._lock:
+            current = self.entries.get(title_key)
+            if current is not None and current[1] >= score:
+                return title_key
+            self.entries[title_key] = ((title, artist, album, length), score, grams)
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(title_key)
+        return title_key
+
+    def search(self, query: str) -> Optional[Tuple[float, Track]]:
+        """
+        Find the indexed recording whose title is the most similar to query.
+
+        :return: None when nothing shares a trigram with query, otherwise (similarity, track)
+        """
+        query_key = normalize_query(query)
+        with self._lock:
+            entry = self.entries.get(query_key)
+            if entry is not None:
+                return 1.0, entry[0]
+            query_grams = trigrams(query_key)
+            shared = dict()
+            for gram in query_grams:
+                for title_key in self.postings.get(gram, ()):
+                    shared[title_key] = shared.get(title_key, 0) + 1
+            if not shared:
+                return None
+            similarity, title_key = max((common / (len(query_grams) + len(self.entries[title_key][2]) - common),
+                                         title_key) for title_key, common in shared.items())
+            return similarity, self.entries[title_key][0]
+
+    def titles(self) -> frozenset:
+        with self._lock:
+            return frozenset(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class LocalRecordingIndexes:
+    """
+    Per-artist RecordingIndex objects, loaded from the database on first use and kept in an LRU cache.
+    """
+    def __init__(self, artists: int, threshold: float, enabled: bool = True):
+        self.indexes = LRUCache(max_entries=artists)
+        self.threshold = threshold
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def _index(self, search_session, artist_mbid: str) -> RecordingIndex:
+        index = self.indexes.get(artist_mbid)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self.indexes.get(artist_mbid)
+            if index is None:
+                index = RecordingIndex()
+                for recording in db_retrieve_recordings(search_session, artist_mbid):
+                    index.add(*recording)
+                self.indexes.put(artist_mbid, index)
+        return index
+
+    def match(self, search_session, artist_mbid: str, query: str) -> Optional[Track]:
+        """
+        Answer a query from the local index.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the artist the query is restricted to
+        :param query: User's input query
+        :return: Tuple of strings (Title, Artist, Album, Length) when a recording is similar enough, None otherwise
+        """
+        if not self.enabled:
+            return None
+        found = self._index(search_session, artist_mbid).search(query)
+        hit = found is not None and found[0] >= self.threshold
+        with self._lock:
+            self.counters["hits" if hit else "misses"] += 1
+        return found[1] if hit else None
+
+    def add(self, search_session, artist_mbid: str, candidates: Iterable[tuple]):
+        """
+        Index recordings that met the search criteria and store them in recordings table.
+
+        :param search_session: A sessionmaker Session object created by db_session() function
+        :param artist_mbid: MusicBrainz ID of the recordings' artist
+        :param candidates: recording_filter.Candidate tuples (title, artist, album, length, score, position)
+        """
+        if not self.enabled:
+            return
+        index = self._index(search_session, artist_mbid)
+        recordings = [(candidate.title, index.add(*candidate[:5]), *candidate[1:5]) for candidate in candidates]
+        db_put_recordings(search_session, artist_mbid, recordings)
+
+    def titles(self, search_session, artist_mbid: str) -> frozenset:
+        """
+        :return: The normalized titles indexed for an artist, each one answers a query without calling MusicBrainz
+        """
+        if not self.enabled:
+            return frozenset()
+        return self._index(search_session, artist_mbid).titles()
+
+    def forget(self, artist_mbid: str = None):
+        """
+        Drop the in-memory index of one artist or of all of them, it is reloaded from the database on next use.
+        """
+        if artist_mbid is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(artist_mbid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters["artists"] = len(self.indexes)
+        return counters
+
+
+local_index = LocalRecordingIndexes(artists=index_options.get("artists"),
+                                    threshold=index_options.get("threshold"),
+                                    enabled=index_options.get("enabled"))
+cache_sync.subscribe("local_index", local_index.forget)
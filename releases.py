@@ -0,0 +1,43 @@
+import sys
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+"""
+Compact in-memory records of MusicBrainz release groups and their releases.
+
+musicbrainzngs returns every release group as a dict of dicts (with keys the discography never reads); these are
+converted once, when a page arrives from MB's API or rows are read from the database, into tuples of interned
+strings. Titles, types and statuses repeat across release groups and artists, interning keeps one copy of each.
+"""
+
+
+class ReleaseRecord(NamedTuple):
+    id: str
+    title: str
+    status: Optional[str]
+
+
+class ReleaseGroupRecord(NamedTuple):
+    id: str
+    title: str
+    type: Optional[str]
+    first_release_date: Optional[str]
+    releases: Tuple[ReleaseRecord, ...]
+
+
+def intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+def compact_release_groups(raw_release_groups: Iterable[dict]) -> List[ReleaseGroupRecord]:
+    """
+    :param raw_release_groups: Release-group dicts as returned by musicbrainzngs.search_release_groups()
+    :return: A list of ReleaseGroupRecord tuples, in the same order
+    """
+    return [ReleaseGroupRecord(raw_release_group["id"],
+                               intern(raw_release_group.get("title") or ""),
+                               intern(raw_release_group.get("type")),
+                               raw_release_group.get("first-release-date"),
+                               tuple(ReleaseRecord(release["id"], intern(release.get("title") or ""),
+                                                   intern(release.get("status")))
+                                     for release in raw_release_group.get("release-list", ())))
+            for raw_release_group in raw_release_groups]
@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import threading
+from typing import NamedTuple, Optional, Tuple
+from cache import LRUCache
+from query_cache import query_cache
+
+"""
+In-process cache of serialized /search responses, and the HTTP validators sent with them.
+
+Every 200/201/204 answer of /search carries an ETag derived from what it answers with: the artist and the stored
+track's (title, artist, album, length), the same columns the unique index of tracks table is on, or "no match".
+It is the same in every worker and after restarts, and only changes when the answer does. Cache-Control allows
+clients and CDNs to reuse an answer for MB_SEARCH_MAX_AGE seconds (default 3600), or MB_SEARCH_NEGATIVE_MAX_AGE
+(default 300) for a 204.
+
+The serialized body of every such answer is kept for MB_RESPONSE_CACHE_TTL seconds (default 60) in a bounded LRU
+(MB_RESPONSE_CACHE_ENTRIES, default 10000) keyed by the exact (artist, title) of the request. A repeated request is
+then answered from memory only, with 304 Not Modified and no body when its If-None-Match holds the ETag. A 201 is
+replayed as 200. Stale answers, 503 and 500 are never cached. The cache is emptied whenever query results are
+dropped (query_cache.clear(), here or in another worker). MB_RESPONSE_CACHE=false turns it off, headers are still
+sent.
+"""
+
+response_cache_options = {
+    "enabled": os.environ.get("MB_RESPONSE_CACHE", "true").lower() in ("1", "true", "yes"),
+    "entries": int(os.environ.get("MB_RESPONSE_CACHE_ENTRIES", 10000)),
+    "ttl": float(os.environ.get("MB_RESPONSE_CACHE_TTL", 60)),
+    "max_age": int(os.environ.get("MB_SEARCH_MAX_AGE", 60 * 60)),
+    "negative_max_age": int(os.environ.get("MB_SEARCH_NEGATIVE_MAX_AGE", 5 * 60))
+}
+
+Track = Tuple[str, str, str, str]
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    body: bytes
+    etag: str
+    max_age: int
+    artist_mbid: str
+    track: Optional[Track]
+    expires_on: float
+
+
+def entity_tag(artist_mbid: str, track: Optional[Track]) -> str:
+    """
+    :return: A strong ETag (quoted) identifying the answer: the artist and the track, or "no match"
+    """
+    identity = "\x1f".join((artist_mbid,) + (tuple(track) if track is not None else ("no match",)))
+    return '"%s"' % hashlib.sha1(identity.encode("utf-8")).hexdigest()[:24]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of an If-None-Match header (a list of ETags, or *) with an ETag, as RFC 9110 requires for it.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class ResponseCache:
+    """
+    Bounded LRU of serialized /search answers expiring after `ttl` seconds, with hit/miss counters.
+    """
+    def __init__(self, entries: int, ttl: float, max_age: int, negative_max_age: int, enabled: bool = True):
+        self.memory = LRUCache(max_entries=entries)
+        self.ttl = ttl
+        self.max_age = max_age
+        self.negative_max_age = negative_max_age
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "not_modified": 0, "stored": 0}
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    @staticmethod
+    def key(artist: str, title: str) -> tuple:
+        return artist.strip().lower(), title
+
+    def get(self, artist: str, title: str) -> Optional[CachedResponse]:
+        """
+        :param artist: Artist name as given by the user
+        :param title: User's input query, as given
+        :return: The cached answer, None on a miss or when it expired
+        """
+        if not self.enabled:
+            return None
+        key = self.key(artist, title)
+        entry = self.memory.get(key)
+        if entry is not None and entry.expires_on <= time.monotonic():
+            self.memory.pop(key)
+            entry = None
+        self._count("misses" if entry is None else "hits")
+        return entry
+
+    def put(self, artist: str, title: str, status: int, body: bytes, artist_mbid: str,
+            track: Optional[Track]) -> CachedResponse:
+        """
+        Keep the answer to a request, if enabled, and return it along with its validators.
+
+        :param artist: Artist name as given by the user
+        :param title: User's input query, as given
+        :param status: HTTP status of the answer, 200, 201 or 204
+        :param body: Serialized body of the answer (empty for a 204)
+        :param artist_mbid: MusicBrainz ID of the artist
+        :param track: Tuple of strings (Title, Artist, Album, Length) answered with, None for "no match"
+        :return: A CachedResponse tuple
+        """
+        entry = CachedResponse(status=200 if status == 201 else status,
+                               body=body,
+                               etag=entity_tag(artist_mbid, track),
+                               max_age=self.max_age if track is not None else self.negative_max_age,
+                               artist_mbid=artist_mbid,
+                               track=track,
+                               expires_on=time.monotonic() + self.ttl)
+        if self.enabled:
+            self.memory.put(self.key(artist, title), entry)
+            self._count("stored")
+        return entry
+
+    def not_modified(self, entry: CachedResponse, if_none_match: Optional[str]) -> bool:
+        """
+        :return: True when the client already holds this answer and gets a 304
+        """
+        if etag_matches(if_none_match, entry.etag):
+            self._count("not_modified")
+            return True
+        return False
+
+    @staticmethod
+    def headers(entry: CachedResponse) -> dict:
+        return {"ETag": entry.etag, "Cache-Control": f"public, max-age={entry.max_age}"}
+
+    def forget(self, artist_mbid: str = None):
+        """
+        Drop every cached answer. Entries are keyed by the artist name users send, dropping all is simpler than
+        finding those of one artist, and results are rarely dropped.
+        """
+        self.memory.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters["enabled"] = self.enabled
+        counters["memory"] = self.memory.stats()
+        return counters
+
+
+response_cache = ResponseCache(entries=response_cache_options.get("entries"),
+                               ttl=response_cache_options.get("ttl"),
+                               max_age=response_cache_options.get("max_age"),
+                               negative_max_age=response_cache_options.get("negative_max_age"),
+                               enabled=response_cache_options.get("enabled"))
+query_cache.on_forget(response_cache.forget)
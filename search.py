@@ -1,9 +1,19 @@
+import os
+import asyncio
 import musicbrainzngs
-import time
-import bisect
-import datetime as dt
-from typing import List, Tuple
-from sql import db_session, db_put_search, db_update_search, db_retrieve_track, db_put_track
+from typing import Tuple
+from sql import db_init, db_session
+from mb_client import mb_async
+from ratelimit import SingleFlight, AsyncSingleFlight, mb_breaker
+from pager import PageFetcher, AsyncPageFetcher
+from recording_filter import RecordingFilter
+from ranking import Ranking, rank_candidates, candidate_cache
+from discography import resolve_artist, resolved_artist, get_discography, warm_discographies, ArtistNotFound
+from query_cache import query_cache
+from recording_index import local_index
+from metrics import metrics
+from write_behind import write_behind
+from cache_sync import cache_sync_options
 
 options = {
     "artist": "Imagine Dragons",
@@ -11,49 +21,29 @@ options = {
     "discography_excludes": {"live", "remix", "itunes", "spotify"},
     "search_step": 100,
     "initial_offset": 0,
-    "total_limit": 1000
+    "total_limit": 1000,
+    "async_mode": os.environ.get("MB_ASYNC", "true").lower() in ("1", "true", "yes")
 }
 
 
-def fetch_discography(artist_name: str, include: tuple, exclude: tuple) -> List[str]:
+class MusicBrainzUnavailable(Exception):
     """
-    Get a list of albums released by artist_name, sorted by first release date
+    Raised by lookup() when MusicBrainz could not be reached (timeout, 5xx answers, circuit breaker open).
 
-    :param artist_name: A string used to call for MB API search_release_groups
-    :param include: A tuple of strings representing types of release-groups that contain official recordings/tracks
-    :param exclude: A tuple of strings representing stop-words that should not be included in official discography
-
-    :return: A list of strings (album names) previously sorted by first release date
+    stale holds the (x_string, http status) answer of the last cached result of the query, even expired, to serve
+    instead, None if the query was never cached. retry_after is the number of seconds until MusicBrainz is called
+    again.
     """
-    albums_list = list()
-    allowed_album_types = include
-    stop_words = exclude
-
-    raw_api_response = musicbrainzngs.search_release_groups(query=f"{artist_name}",
-                                                            artistname=artist_name,
-                                                            strict=True,
-                                                            limit=100)
-    for raw_release_group in raw_api_response["release-group-list"]:
-        album_type_allowed = raw_release_group.get("type") in allowed_album_types
-        if not album_type_allowed:
-            continue
-
-        includes_stop_words = any((word.lower() in raw_release_group.get("title").lower() for word in stop_words))
-        if includes_stop_words:
-            continue
-
-        first_release_date = raw_release_group.get("first-release-date")[:]
-        for release in raw_release_group["release-list"]:
-            includes_stop_words = any((word.lower() in release.get("title").lower() for word in stop_words))
-            if includes_stop_words:
-                continue
-            if release.get("status") != 'Official':
-                continue
-            bisect.insort(albums_list, (first_release_date, release.get("title")), lo=0)
-
-    clean_albums_list = list()
-    [clean_albums_list.append(item[1]) for item in albums_list if item[1] not in clean_albums_list]
-    return clean_albums_list
+    def __init__(self, retry_after: float, stale: Tuple[str, int] = None):
+        super().__init__("MusicBrainz is unavailable, retry in %.0f seconds" % retry_after)
+        self.retry_after = retry_after
+        self.stale = stale
+
+
+def unavailable(error: musicbrainzngs.NetworkError, stale: Tuple[str, int] = None) -> MusicBrainzUnavailable:
+    metrics.degraded.inc("stale" if stale is not None else "unavailable")
+    retry_after = getattr(error, "retry_after", None) or mb_breaker.retry_after() or 1.0
+    return MusicBrainzUnavailable(retry_after, stale)
 
 
 class Search:
@@ -63,23 +53,53 @@ class Search:
     default_artist = options.get("artist")
     album_types = options.get("discography_includes")
     stop_words = options.get("discography_excludes")
-    artist_discography = fetch_discography(artist_name=default_artist, include=album_types, exclude=stop_words)
     initial_offset = options.get("initial_offset")
     default_step = options.get("search_step")
     search_limit = options.get("total_limit")
-    _session = db_session()
 
     def __init__(self, query: str,
-                 by_artist: str = default_artist):
-        self.artist_name = by_artist
+                 by_artist: str = default_artist,
+                 session=None):
+        self.artist_mbid, self.artist_name, self.artist_discography = self.prepare_artist(by_artist)
         self.query = query
-        self._id, self.existing_reference_id = self.put_search_in_db()
+        self._session = session if session is not None else db_session()
+        self.seen_candidates = list()
+        self.ranking = None
+        with metrics.stage("cache_lookup"):
+            self.apply_cached_result(query_cache.get(self._session, self.artist_mbid, self.query))
+
+    @classmethod
+    def prepare_artist(cls, by_artist: str):
+        """
+        Resolve the artist name to its MusicBrainz ID and get the artist's discography from the per-artist cache.
+
+        Raises discography.ArtistNotFound when MusicBrainz knows no artist with this name.
+
+        :return: Tuple (artist_mbid, artist name as spelled by MusicBrainz, loaded Discography object)
+        """
+        with metrics.stage("artist"):
+            artist_mbid, artist_name = resolve_artist(by_artist, claim_legacy_rows=by_artist == cls.default_artist)
+            discography = get_discography(artist_mbid, artist_name, include=cls.album_types, exclude=cls.stop_words)
+        return artist_mbid, artist_name, discography
+
+    def apply_cached_result(self, cached):
+        """
+        Assign the result of a previous identical (normalized) query, if any, to current Search object.
 
-        if self.existing_reference_id:
-            self.track_bdid = self.existing_reference_id
-            self.title, self.artist_name, self.album, self.length = self.quick_find()
-        else:
-            self.title, self.album, self.length, self.track_bdid = [False]*4
+        :param cached: None on a cache miss, otherwise (track_id, track, expires_on) as returned by QueryCache.get()
+        """
+        self.title, self.album, self.length, self.track_bdid = [False]*4
+        self.existing_reference_id = False
+        self.cached_match = self.cached_no_match = False
+        if cached is None:
+            return
+        track_id, track, _ = cached
+        if track is None:
+            self.cached_no_match = True
+            return
+        self.cached_match = True
+        self.track_bdid = self.existing_reference_id = track_id
+        self.title, self.artist_name, self.album, self.length = track
 
     def __str__(self):
         """
@@ -95,177 +115,419 @@ class Search:
 
         return ", ".join([self.title, self.artist_name, self.album, self.length])
 
-    def put_search_in_db(self) -> bool:
+    def track(self):
         """
-        Calls database module function to insert new entry into searches table.
-
-        :return: True if new entry was successfully inserted into the table, False if process failed.
+        :return: Tuple of strings (Title, Artist, Album, Length) of the found track, None if nothing was found
         """
-        return db_put_search(search_session=self._session,
-                             search_query=self.query)
+        if not self.title:
+            return None
+        return self.title, self.artist_name, self.album, self.length
 
-    def put_track_in_db(self) -> bool:
+    def log_search(self) -> bool:
         """
-        Calls database module function to insert new entry into tracks table
+        Queue the searches table entry of this search, referencing the track it answered with, if any.
 
-        :return: True if new entry was successfully inserted into the table, False if process failed.
+        :return: False if the write-behind queue was full and the entry dropped.
         """
-        try:
-            self.track_bdid = db_put_track(self._session, self.title, self.artist_name, self.album, self.length)
-            return True
-        except Exception as e:
-            return False
+        return write_behind.put_search(self.artist_mbid, self.query, self.track())
 
-    def update_search_with_track_bdid(self) -> bool:
+    def cache_result(self):
         """
-        Calls database module function to update existing entry with a track_id created during by put_track_in_db().
-
-        :return: True if new entry was successfully updated, False if process failed.
+        Store the outcome of this search (found track or "no match") in the query result cache. The track and the
+        cache entry are written to the database by the write-behind queue.
         """
-        return db_update_search(search_session=self._session,
-                                search_id=self._id,
-                                track_bdid=self.track_bdid)
+        with metrics.stage("cache_store"):
+            query_cache.put(self.artist_mbid, self.query, self.track())
 
-    def quick_find(self) -> Tuple[str]:
+    def answer_stale(self, cached):
         """
-        Calls database module to select an entry with track_id == existing_reference_id
+        Assign the last cached result of the query, expired or not, when MusicBrainz is unavailable.
 
-        This method is  used when user's query has a duplicate within searches table that has track_bdid as not empty
+        :param cached: None, or (track_id, track, expires_on) as returned by QueryCache.get_stale()
+        :return: None if nothing was cached, otherwise (x_string, http status) as lookup() returns them
+        """
+        if cached is None:
+            return None
+        self.apply_cached_result(cached)
+        return self.__str__(), 200 if self.cached_match else 204
 
-        :return: Tuple of strings (Title, Artist, Album, Length)
+    def stale_result(self):
+        """
+        :return: (x_string, http status) of the last cached result of the query, None if it was never cached.
         """
-        return db_retrieve_track(search_session=self._session,
-                                 existing_reference_id=self.existing_reference_id)
+        with metrics.stage("cache_lookup"):
+            stale = self.answer_stale(query_cache.get_stale(self._session, self.artist_mbid, self.query))
+        if stale is not None:
+            self.close()
+        return stale
 
     def close(self):
         """
-        Commits all pending updates, if any, then closes the database session.
+        Queues the searches table entry, commits all pending updates, if any, then closes the database session.
 
         :return: False on success
         """
+        self.log_search()
         self._session.commit()
         return self._session.close()
 
     def process_raw_recording_list(self, raw_recording_list: list) -> bool:
         """
-        Process a response from musicbrainzngs.search_recordings(), one by one. When criteria is met -> return True
+        Process a response from musicbrainzngs.search_recordings() as a batch. When a confident match is found ->
+        return True
 
         For each entry from MB's response, check if:
         - recording contains length field
         - 'artist-credit-phrase' matches artist_name of a current Search object
         - title of current recording contains any of the words from stop-words set
         - the release is attached to current recording, and is within official_discography of a current Search object
+        All candidates of the page are evaluated at once by recording_filter.RecordingFilter, then ranked with those
+        of the previous pages (ranking.Ranking). The best one so far is kept.
 
         :param raw_recording_list: A raw list of recordings sent as part of response by MB.search_recordings() method
 
-        :return: True upon assigning title, artist_name, album and length to current Search object, False otherwise
-        """
-        for raw_record in raw_recording_list:
-            if not raw_record.get("length"):
-                continue
-            raw_length = dt.timedelta(milliseconds=int(raw_record.get("length")))
-
-            if raw_record.get("artist-credit-phrase") != self.artist_name:
-                continue
-            raw_artist_name = raw_record.get("artist-credit-phrase")
-
-            if any((word in raw_record.get("title").lower() for word in self.stop_words)):
-                continue
-            raw_title = raw_record.get("title")
-            if "release-list" not in raw_record.keys():
-                continue
-            album_from_discography = any((release.get("title") in self.artist_discography
-                                          for release in raw_record["release-list"]))
-            if not album_from_discography:
-                continue
-            for release in raw_record["release-list"]:
-                if release.get("title") not in self.artist_discography:
-                    continue
-                album_from_discography = release.get("title")
-                break
-            if not isinstance(album_from_discography, str):
-                continue
-
-            self.title = raw_title
-            self.artist_name = raw_artist_name
-            self.album = album_from_discography
-            self.length = ':'.join(str(raw_length).split(':')[-2:]).split('.')[0]
-
-            return True
-        return False
+        :return: True when the best candidate so far is confident enough to stop fetching pages, False otherwise
+        """
+        with metrics.stage("filter"):
+            discography = self.artist_discography.ensure_loaded()
+            recording_filter = RecordingFilter(artist_name=self.artist_name,
+                                               discography=discography.index,
+                                               stop_words=self.stop_words)
+            candidates = recording_filter.filter_page(raw_recording_list)
+            if self.ranking is None:
+                self.ranking = Ranking(self.query, discography.positions)
+            best = self.ranking.add(candidates)
+        self.seen_candidates.extend(candidates)
+        if best is None:
+            return False
+
+        self.title, self.artist_name, self.album, self.length = best.candidate[:4]
+        return self.ranking.confident()
+
+    def rerank_cached(self):
+        """
+        Rank again, against the current discography, the candidates kept by ranking.candidate_cache the last time
+        the query was sent to MusicBrainz.
+
+        :return: Tuple of strings (Title, Artist, Album, Length) of the best one, None if none is kept or is still in
+                 the discography.
+        """
+        cached = candidate_cache.get(self.artist_mbid, self.query)
+        if not cached:
+            return None
+        discography = self.artist_discography.ensure_loaded()
+        ranked = rank_candidates([candidate for candidate in cached if candidate.album in discography.index],
+                                 self.query, discography.positions)
+        return tuple(ranked[0].candidate[:4]) if ranked else None
+
+    def finish_ranking(self):
+        if self.ranking is not None:
+            candidate_cache.put(self.artist_mbid, self.query, self.ranking)
+
+    def find_locally(self) -> bool:
+        """
+        Look the query up in the local recording index (recording_index.py) before calling MB's API.
+
+        :return: True upon assigning title, artist_name, album and length of a similar enough known recording.
+        """
+        with metrics.stage("local_index"):
+            match = local_index.match(self._session, self.artist_mbid, self.query)
+        if match is None:
+            return False
+        self.title, self.artist_name, self.album, self.length = match
+        return True
 
     def call_mb(self) -> bool:
         """
         Call MB's API recordings endpoint to get a list of raw entries possible results to user's input.
 
+        Concurrent Search objects with the same artist and query share one pagination run (see fetch_match). The
+        candidates kept from a previous run of the query, if any, are ranked again instead.
+
+        :return: True if any of the received entries met the processing criteria fully, False otherwise.
+        """
+        match = self.rerank_cached() or mb_flight.do((self.artist_mbid, self.query), self.fetch_match)
+        if self.seen_candidates:
+            with metrics.stage("index_update"):
+                local_index.add(self._session, self.artist_mbid, self.seen_candidates)
+        if not match:
+            return False
+        self.title, self.artist_name, self.album, self.length = match
+        return True
+
+    def fetch_match(self):
+        """
+        Stream MB's recordings search page by page (next pages prefetched, see pager.PageFetcher), filtering and
+        ranking each page as it arrives and stopping at the first confident match.
+
+        :return: Tuple of strings (Title, Artist, Album, Length) of the best match, None if nothing matched.
+        """
+        with PageFetcher(musicbrainzngs.search_recordings, "recording",
+                         step=self.default_step,
+                         initial_offset=self.initial_offset,
+                         limit=self.search_limit,
+                         query=f"{self.query}",
+                         arid=self.artist_mbid,
+                         strict=True) as pages:
+            for raw_api_response in pages:
+                if self.process_raw_recording_list(raw_api_response["recording-list"]):
+                    break
+        self.finish_ranking()
+        return self.track()
+
+
+mb_flight = SingleFlight()
+mb_flight_async = AsyncSingleFlight()
+
+
+class AsyncSearch(Search):
+    """
+    Search running on an AsyncSession and the async MusicBrainz client.
+
+    Database and API methods are coroutines; create instances with `await AsyncSearch.create(...)`
+    since __init__ can not await the query result cache lookup.
+    """
+    def __init__(self, query: str,
+                 artist: tuple,
+                 session=None):
+        self.artist_mbid, self.artist_name, self.artist_discography = artist
+        self.query = query
+        self._session = session
+        self.seen_candidates = list()
+        self.ranking = None
+        self.apply_cached_result(None)
+
+    @classmethod
+    async def create(cls, query: str, session, by_artist: str = Search.default_artist):
+        """
+        Async counterpart of Search.__init__(): load the cached result of the query, if any.
+
+        :return: An initialized AsyncSearch object
+        """
+        artist = await asyncio.to_thread(cls.prepare_artist, by_artist)
+        search = cls(query=query, artist=artist, session=session)
+        with metrics.stage("cache_lookup"):
+            search.apply_cached_result(await session.run_sync(query_cache.get, search.artist_mbid, search.query))
+        return search
+
+    async def stale_result(self):
+        with metrics.stage("cache_lookup"):
+            stale = self.answer_stale(await self._session.run_sync(query_cache.get_stale, self.artist_mbid,
+                                                                   self.query))
+        if stale is not None:
+            await self.close()
+        return stale
+
+    async def close(self):
+        self.log_search()
+        await self._session.commit()
+        return await self._session.close()
+
+    async def find_locally(self) -> bool:
+        with metrics.stage("local_index"):
+            match = await self._session.run_sync(local_index.match, self.artist_mbid, self.query)
+        if match is None:
+            return False
+        self.title, self.artist_name, self.album, self.length = match
+        return True
+
+    async def call_mb(self) -> bool:
+        """
+        Async counterpart of Search.call_mb(), concurrent identical searches share one pagination run.
+
         :return: True if any of the received entries met the processing criteria fully, False otherwise.
         """
-        offset = self.initial_offset
-        step = self.default_step
-        limit = self.search_limit
+        match = self.rerank_cached() or await mb_flight_async.do((self.artist_mbid, self.query), self.fetch_match)
+        if self.seen_candidates and self._session is not None:
+            with metrics.stage("index_update"):
+                await self._session.run_sync(local_index.add, self.artist_mbid, self.seen_candidates)
+        if not match:
+            return False
+        self.title, self.artist_name, self.album, self.length = match
+        return True
+
+    async def fetch_match(self):
+        """
+        Same streaming pagination as Search.fetch_match(), with pages prefetched in asyncio tasks.
 
-        while True:
-            time.sleep(1)
-            raw_api_response = musicbrainzngs.search_recordings(query=f"{self.query}",
-                                                                artistname=self.artist_name,
-                                                                strict=True,
-                                                                limit=step,
-                                                                offset=offset)
+        :return: Tuple of strings (Title, Artist, Album, Length) of the best match, None if nothing matched.
+        """
+        async with AsyncPageFetcher(mb_async.search_recordings, "recording",
+                                    step=self.default_step,
+                                    initial_offset=self.initial_offset,
+                                    limit=self.search_limit,
+                                    query=f"{self.query}",
+                                    arid=self.artist_mbid,
+                                    strict=True) as pages:
+            async for raw_api_response in pages:
+                if self.process_raw_recording_list(raw_api_response["recording-list"]):
+                    break
+        self.finish_ranking()
+        return self.track()
+
+
+def warm_caches(query_results: int = cache_sync_options.get("warm_results"),
+                artists: int = cache_sync_options.get("warm_artists")) -> dict:
+    """
+    Fill the in-memory caches of this process from the database shared by all workers: the most recent query
+    results and the discographies of the most recently searched artists. Called on application startup.
+
+    :return: A dict with the number of loaded query results and discographies
+    """
+    session = db_session()
+    try:
+        loaded_results = query_cache.warm(session, query_results)
+    finally:
+        session.close()
+    return {"query_results": loaded_results,
+            "discographies": warm_discographies(artists, include=Search.album_types, exclude=Search.stop_words)}
 
-            if self.process_raw_recording_list(raw_api_response["recording-list"]):
-                return True
 
-            offset += step
-            if any((raw_api_response["recording-count"] <= offset,
-                   offset >= limit)):
-                break
+def answer_of(title: str, artist: str = None):
+    """
+    What lookup() answered a query with, read from memory only (no database read, no call to MusicBrainz).
 
-        return False
+    :param title: User's input query
+    :param artist: Name of the artist the query was restricted to, options["artist"] by default
+    :return: (artist_mbid, track) where track is None for "no match", None if the artist or the query is not in memory
+    """
+    artist = resolved_artist(artist or Search.default_artist)
+    if artist is None:
+        return None
+    cached = query_cache.peek(artist[0], title)
+    if cached is None:
+        return None
+    return artist[0], cached[1]
 
 
-def lookup(title: str):
+def lookup(title: str, session=None, artist: str = None):
     """
     Called by FastAPI endpoint when user initiates search session with title as their search query
 
-    Step 1. Initiate new Search object and PostgreSQL session, insert new entry into searches database table,
+    Step 1. Initiate new Search object bound to the request's PostgreSQL session, look the normalized query up in the
+    query result cache (a single indexed read on a memory miss),
     and assign default parameters as per logic defined in Search __init__() function.
-    Step 2. Check if Step 1 found this search as new or duplicate in database:
-        If it's a duplicate of an entry that successfully returned track before:
-            - Update search object accordingly
+    Step 2. Check if Step 1 found this search in the query result cache:
+        If it's a duplicate of a query that successfully returned track before:
+            - Close database session (queues the searches table entry)
+            - Return 200 and previously found track info from the cache.
+        If it's a duplicate of a query that recently returned nothing:
             - Close database session
-            - Return 200 and previously found track info from database.
+            - Return 204 without calling MusicBrainz.
+        If a known recording (local recording index) is similar enough to the query:
+            - Cache the result, its track is stored by the write-behind queue.
+            - Return 200 without calling MusicBrainz, close db session.
         If it's a new entry:
             - Call MusicBrainz API and process results.
-            - Return 204 if no results were returned, close db session.
+            - Return 204 if no results were returned, cache "no match", close db session.
             - Return 204 if no results met the criteria, or there was an error during processing, close db session.
-            - Return 201 and new track info as string after inserting new track into db, updating current search in db.
+            - Return 201 and new track info as string after caching the result.
             - Close db session.
+        If MusicBrainz is unavailable (timeout, 5xx answers, circuit breaker open):
+            - Raise MusicBrainzUnavailable holding the last cached result of the query, even expired, if any.
+    Tracks, cache entries and searches table entries are written in batches by write_behind.py, not by the request.
 
     :param title: User's input query
+    :param session: Optional SQLAlchemy Session handed out per request by sql.get_db(), a new one is opened otherwise
+    :param artist: Name of the artist to search recordings of, options["artist"] by default
     :return: x_string: A string formatted to met hometask description criteria.
              http_status code: A value presenting one of the possible outcomes during function execution.
     """
-    search = Search(query=f"{title}")
-    if search.track_bdid and search.update_search_with_track_bdid():
+    artist = artist or Search.default_artist
+    try:
+        search = Search(query=f"{title}", by_artist=artist, session=session)
+    except ArtistNotFound:
+        return f"Artist \'{artist}\' was not found.", 204
+    except musicbrainzngs.NetworkError as e:
+        raise unavailable(e) from e
+    if search.cached_match:
+        x_string = search.__str__()
+        search.close()
+        return x_string, 200
+
+    if search.cached_no_match:
+        x_string = search.__str__()
+        search.close()
+        return x_string, 204
+
+    if search.find_locally():
+        search.cache_result()
         x_string = search.__str__()
         search.close()
         return x_string, 200
 
-    if not search.call_mb():
+    try:
+        found = search.call_mb()
+    except musicbrainzngs.NetworkError as e:
+        raise unavailable(e, search.stale_result()) from e
+    if not found:
+        search.cache_result()
         x_string = search.__str__()
         search.close()
         return x_string, 204
 
-    search.put_track_in_db()
-    search.update_search_with_track_bdid()
+    search.cache_result()
     search.close()
 
     x_string = search.__str__()
-    time.sleep(1)
     if "was not processed" in x_string:
         return x_string, 204
 
     return x_string, 201
 
+
+async def lookup_async(title: str, session, artist: str = None):
+    """
+    Non-blocking variant of lookup() used by the async /search endpoint. Follows the same steps and return values.
+
+    :param title: User's input query
+    :param session: SQLAlchemy AsyncSession handed out per request by sql.get_async_db()
+    :param artist: Name of the artist to search recordings of, options["artist"] by default
+    :return: x_string: A string formatted to met hometask description criteria.
+             http_status code: A value presenting one of the possible outcomes during function execution.
+    """
+    artist = artist or Search.default_artist
+    try:
+        search = await AsyncSearch.create(query=f"{title}", session=session, by_artist=artist)
+    except ArtistNotFound:
+        return f"Artist \'{artist}\' was not found.", 204
+    except musicbrainzngs.NetworkError as e:
+        raise unavailable(e) from e
+    if search.cached_match:
+        x_string = search.__str__()
+        await search.close()
+        return x_string, 200
+
+    if search.cached_no_match:
+        x_string = search.__str__()
+        await search.close()
+        return x_string, 204
+
+    if await search.find_locally():
+        search.cache_result()
+        x_string = search.__str__()
+        await search.close()
+        return x_string, 200
+
+    try:
+        found = await search.call_mb()
+    except musicbrainzngs.NetworkError as e:
+        raise unavailable(e, await search.stale_result()) from e
+    if not found:
+        search.cache_result()
+        x_string = search.__str__()
+        await search.close()
+        return x_string, 204
+
+    search.cache_result()
+    await search.close()
+
+    x_string = search.__str__()
+    if "was not processed" in x_string:
+        return x_string, 204
+
+    return x_string, 201
+
+
 if __name__ == "__main__":
-    db_session()
\ No newline at end of file
+    db_init()
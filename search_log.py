@@ -0,0 +1,124 @@
+import os
+import json
+import logging
+import argparse
+import threading
+from datetime import date, timedelta
+from sql import db_init, db_session, db_create_search_logs, db_last_rollup_day, db_first_search_day, \
+    db_rollup_searches, db_drop_search_logs, month_start, next_month
+from query_cache import normalize_query
+
+"""
+Maintenance of the searches log: daily rollups and retention.
+
+Every search is logged in the table of its month, searches_YYYY_MM (see sql.py), so the log of old months can be
+dropped whole instead of deleting rows one by one from an ever-growing table.
+Step 1. Create the tables of this month and the next one, ahead of the write-behind queue.
+Step 2. Aggregate every day since the last rollup, that day included, into search_rollups table: one row per day,
+        artist and normalized query with the number of searches and of those that found a track. Rolling up a day
+        again replaces its rows, so a partial day or an interrupted run is completed by the next run.
+Step 3. Drop the monthly tables of months that ended more than MB_SEARCH_LOG_RETENTION_DAYS days ago (default 90),
+        once all their days are rolled up. 0 keeps the log forever.
+Runs every MB_SEARCH_LOG_MAINTENANCE_INTERVAL seconds (default 3600) in a background thread of the application, or
+from a shell or cron:
+    python search_log.py
+Several workers running it at once only repeat the same statements.
+"""
+
+search_log_options = {
+    "retention_days": int(os.environ.get("MB_SEARCH_LOG_RETENTION_DAYS", 90)),
+    "interval": float(os.environ.get("MB_SEARCH_LOG_MAINTENANCE_INTERVAL", 60 * 60))
+}
+
+logger = logging.getLogger(__name__)
+
+
+def rollup(session, today: date) -> dict:
+    """
+    Aggregate every day from the last rolled up one (or the first logged one) to today.
+
+    :return: A dict {ISO date: number of search_rollups rows}
+    """
+    day = db_last_rollup_day(session) or db_first_search_day(session)
+    rolled_up = dict()
+    while day is not None and day <= today:
+        rolled_up[day.isoformat()] = db_rollup_searches(session, day, normalize_query)
+        day += timedelta(days=1)
+    return rolled_up
+
+
+def apply_retention(session, today: date, retention_days: int) -> list:
+    """
+    Drop the monthly tables older than the retention window whose days are all rolled up.
+
+    :return: A list of the names of dropped tables
+    """
+    if retention_days <= 0:
+        return []
+    last_rollup_day = db_last_rollup_day(session)
+    if last_rollup_day is None:
+        return []
+    return db_drop_search_logs(session, min(today - timedelta(days=retention_days), last_rollup_day))
+
+
+def maintain(today: date = None, retention_days: int = None) -> dict:
+    """
+    Run the three steps above.
+
+    :param today: Day the run is for, today by default
+    :param retention_days: Days of searches kept, search_log_options["retention_days"] by default
+    :return: A report dict: rolled up days with their number of rows, and dropped tables
+    """
+    today = today or date.today()
+    retention_days = search_log_options.get("retention_days") if retention_days is None else retention_days
+    session = db_session()
+    try:
+        db_create_search_logs(session, (month_start(today), next_month(today)))
+        rolled_up = rollup(session, today)
+        dropped = apply_retention(session, today, retention_days)
+    finally:
+        session.close()
+    return {"rolled_up": rolled_up, "dropped": dropped}
+
+
+class SearchLogMaintenance:
+    """
+    Runs maintain() on startup and every `interval` seconds from a background thread.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                logger.info("Searches log maintenance: %s", maintain())
+            except Exception as e:
+                logger.exception("Searches log maintenance failed")
+            if self._stopping.wait(self.interval):
+                break
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="search-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+search_log_maintenance = SearchLogMaintenance(interval=search_log_options.get("interval"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll up the searches log and drop months past retention")
+    parser.add_argument("--retention-days", type=int, default=search_log_options.get("retention_days"))
+    arguments = parser.parse_args()
+    db_init()
+    print(json.dumps(maintain(retention_days=arguments.retention_days)))
@@ -1,15 +1,36 @@
-from sqlalchemy import create_engine, URL
-from sqlalchemy.orm import sessionmaker
+import os
+import re
+import threading
+import time
+from inspect import signature
+from sqlalchemy import create_engine, URL, make_url, inspect
+from sqlalchemy.orm import Session, sessionmaker, aliased
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy import Column, Integer, DateTime, Text
-from datetime import datetime
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import Column, Integer, DateTime, Date, Text, Float, ForeignKey, Index, MetaData, Table, text, \
+    delete, select, insert, func, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import date, datetime, timedelta
+from metrics import metrics
+from releases import ReleaseGroupRecord, ReleaseRecord, intern
+
+db_options = {
+    "url": os.environ.get("MB_DB_URL"),
+    "pool_size": int(os.environ.get("MB_DB_POOL_SIZE", 10)),
+    "max_overflow": int(os.environ.get("MB_DB_MAX_OVERFLOW", 20)),
+    "pool_timeout": float(os.environ.get("MB_DB_POOL_TIMEOUT", 30)),
+    "pool_recycle": int(os.environ.get("MB_DB_POOL_RECYCLE", 1800)),
+    "pool_pre_ping": os.environ.get("MB_DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+}
 
 Base = declarative_base()
 
 
 class Track(Base):
     __tablename__ = 'tracks'
+    __table_args__ = (Index('ix_tracks_artist_title_album', 'artist_mbid', 'title', 'album', unique=True),)
 
     track_id = Column(Integer(), nullable=False, primary_key=True)
     created_on = Column(DateTime(), nullable=False, default=datetime.now)
@@ -17,24 +38,227 @@ class Track(Base):
     artist = Column(Text(), nullable=False, unique=False)
     album = Column(Text(), nullable=False, unique=False)
     length = Column(Text(), nullable=False, unique=False)
+    artist_mbid = Column(Text(), nullable=True)
+
+
+# The searches log is split in one table per calendar month, searches_YYYY_MM, created on first insert: old months
+# are dropped whole by retention (search_log.py) and no query reads more than the months it needs. The tables are
+# not part of Base.metadata, create_all() must not create them. searches is the single log table of older versions,
+# moved into the monthly tables by db_migrate().
+search_log_metadata = MetaData()
+_search_log_lock = threading.Lock()
+_search_log_name = re.compile(r"^searches_(\d{4})_(\d{2})$")
+_created_search_logs = set()
+
+
+def _search_log_columns():
+    return [Column('search_id', Integer(), nullable=False, primary_key=True),
+            Column('created_on', DateTime(), nullable=False, default=datetime.now),
+            Column('query', Text(), nullable=False),
+            Column('track_id_ref', Integer(), nullable=True),
+            Column('artist_mbid', Text(), nullable=True)]
 
 
-class Search(Base):
-    __tablename__ = 'searches'
+legacy_searches = Table('searches', search_log_metadata, *_search_log_columns())
+
+
+def search_log_table(month: date) -> Table:
+    """
+    :param month: Any day of the month
+    :return: The Table of the searches logged during that month
+    """
+    name = "searches_%04d_%02d" % (month.year, month.month)
+    with _search_log_lock:
+        table = search_log_metadata.tables.get(name)
+        if table is None:
+            table = Table(name, search_log_metadata, *_search_log_columns(),
+                          Index(f'ix_{name}_created_on', 'created_on'))
+        return table
+
 
-    search_id = Column(Integer(), nullable=False, primary_key=True)
+def month_start(moment) -> date:
+    return date(moment.year, moment.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class SearchRollup(Base):
+    __tablename__ = 'search_rollups'
+    __table_args__ = (Index('ix_search_rollups_day_artist_query', 'day', 'artist_mbid', 'query_key', unique=True),)
+
+    rollup_id = Column(Integer(), nullable=False, primary_key=True)
+    day = Column(Date(), nullable=False)
+    artist_mbid = Column(Text(), nullable=False)
+    query_key = Column(Text(), nullable=False)
+    searches = Column(Integer(), nullable=False, default=0)
+    hits = Column(Integer(), nullable=False, default=0)
+
+
+class CachedResult(Base):
+    __tablename__ = 'query_cache'
+    __table_args__ = (Index('ix_query_cache_artist_query', 'artist_mbid', 'query_key', unique=True),)
+
+    cache_id = Column(Integer(), nullable=False, primary_key=True)
+    artist_mbid = Column(Text(), nullable=True)
+    query_key = Column(Text(), nullable=False)
+    track_id = Column(Integer(), nullable=True)
     created_on = Column(DateTime(), nullable=False, default=datetime.now)
-    query = Column(Text(), nullable=False)
-    track_id_ref = Column(Integer(), nullable=True)
+    expires_on = Column(DateTime(), nullable=True)
 
 
-def db_session():
+class Recording(Base):
+    __tablename__ = 'recordings'
+    __table_args__ = (Index('ix_recordings_artist_title_album', 'artist_mbid', 'title_key', 'album', unique=True),)
+
+    recording_id = Column(Integer(), nullable=False, primary_key=True)
+    artist_mbid = Column(Text(), nullable=False)
+    title = Column(Text(), nullable=False)
+    title_key = Column(Text(), nullable=False)
+    artist = Column(Text(), nullable=False)
+    album = Column(Text(), nullable=False)
+    length = Column(Text(), nullable=False)
+    score = Column(Integer(), nullable=False, default=0)
+    seen_on = Column(DateTime(), nullable=False, default=datetime.now)
+
+
+class BrowsedRelease(Base):
+    __tablename__ = 'browsed_releases'
+
+    release_id = Column(Text(), nullable=False, primary_key=True)
+    artist_mbid = Column(Text(), nullable=False, index=True)
+    album = Column(Text(), nullable=False)
+    recordings = Column(Integer(), nullable=False, default=0)
+    browsed_on = Column(DateTime(), nullable=False, default=datetime.now)
+
+
+class CacheEvent(Base):
+    __tablename__ = 'cache_events'
+
+    event_id = Column(Integer(), nullable=False, primary_key=True)
+    kind = Column(Text(), nullable=False)
+    artist_mbid = Column(Text(), nullable=True)
+    origin = Column(Text(), nullable=False)
+    created_on = Column(DateTime(), nullable=False, default=datetime.now, index=True)
+
+
+class Artist(Base):
+    __tablename__ = 'artists'
+
+    artist_mbid = Column(Text(), nullable=False, primary_key=True)
+    name = Column(Text(), nullable=False)
+    lookup_name = Column(Text(), nullable=False, unique=True)
+    created_on = Column(DateTime(), nullable=False, default=datetime.now)
+
+
+class ReleaseGroup(Base):
+    __tablename__ = 'release_groups'
+
+    release_group_id = Column(Text(), nullable=False, primary_key=True)
+    artist = Column(Text(), nullable=False)
+    artist_mbid = Column(Text(), nullable=True, index=True)
+    title = Column(Text(), nullable=False)
+    type = Column(Text(), nullable=True)
+    first_release_date = Column(Text(), nullable=True)
+    fetched_on = Column(DateTime(), nullable=False, default=datetime.now)
+
+
+class Release(Base):
+    __tablename__ = 'releases'
+
+    release_id = Column(Text(), nullable=False, primary_key=True)
+    release_group_id = Column(Text(), ForeignKey('release_groups.release_group_id', ondelete="CASCADE"),
+                              nullable=False, index=True)
+    title = Column(Text(), nullable=False)
+    status = Column(Text(), nullable=True)
+
+
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+
+    name = Column(Text(), nullable=False, primary_key=True)
+    tokens = Column(Float(), nullable=False)
+    updated_on = Column(Float(), nullable=False)
+
+
+class _PoolStats:
     """
-    Establish connection to a database and return a database session to work with on database-related tasks.
+    Process-wide counters describing how long callers waited to check a connection out of the pool.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
 
-    :return: An SQLAlchemy sessionmaker Session object to interact with PostgreSQL database
+    def record(self, waited: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_count += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            self.timeouts += int(timed_out)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"wait_count": self.wait_count,
+                    "wait_seconds_total": round(self.wait_seconds_total, 6),
+                    "wait_seconds_max": round(self.wait_seconds_max, 6),
+                    "timeouts": self.timeouts}
+
+
+pool_stats = _PoolStats()
+
+
+def _check_do_get(pool_class):
+    """
+    :return: pool_class, when it has the _do_get() method _MeteredQueuePool wraps, raises ImportError otherwise
+    """
+    do_get = getattr(pool_class, "_do_get", None)
+    if do_get is None or tuple(signature(do_get).parameters) != ("self",):
+        raise ImportError("sqlalchemy.pool.QueuePool._do_get(self) is missing or changed, the wait for a pooled "
+                          "connection can not be measured")
+    return pool_class
+
+
+class _MeteredQueuePool(_check_do_get(QueuePool)):
+    """
+    QueuePool that records the time spent waiting for a connection in pool_stats and in the db_pool_wait stage.
+
+    No pool event fires before a checkout starts waiting, so the private QueuePool._do_get() is wrapped instead. Its
+    signature is checked on import: an SQLAlchemy release changing it fails loudly instead of reporting no waits.
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            pool_stats.record(waited, timed_out)
+            metrics.observe("db_pool_wait", waited)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker()
+_async_engine = None
+_async_session_factory = async_sessionmaker(expire_on_commit=False)
+
+
+def db_url():
     """
-    db_url = URL.create(
+    Build the database URL. MB_DB_URL environment variable overrides the default docker-compose PostgreSQL server.
+
+    :return: An SQLAlchemy URL object
+    """
+    if db_options.get("url"):
+        return make_url(db_options.get("url"))
+    return URL.create(
         drivername='postgresql',
         username='postgres',
         password="postgres_user",
@@ -42,100 +266,284 @@ def db_session():
         port=5432,
         database='postgres'
     )
-    # Write with statement
-    db_engine = create_engine(db_url)
-    with db_engine.connect():
-        session = sessionmaker(bind=db_engine)
-        session = session()
 
-        Base.metadata.create_all(db_engine)
-        return session
 
+def get_engine():
+    """
+    Return the process-wide SQLAlchemy engine, creating it (and its connection pool) on first use.
 
-def db_put_search(search_session, search_query):
+    :return: An SQLAlchemy Engine shared by every session in this process
     """
-    Initiated every time new Search object is instantiated.
-    Insert initiated Search into searches database, return track_ref_bdid if the Search entry is duplicate.
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is None:
+            url = db_url()
+            if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+                engine = create_engine(url,
+                                       poolclass=StaticPool,
+                                       connect_args={"check_same_thread": False})
+            else:
+                engine = create_engine(url,
+                                       poolclass=_MeteredQueuePool,
+                                       pool_size=db_options.get("pool_size"),
+                                       max_overflow=db_options.get("max_overflow"),
+                                       pool_timeout=db_options.get("pool_timeout"),
+                                       pool_recycle=db_options.get("pool_recycle"),
+                                       pool_pre_ping=db_options.get("pool_pre_ping"))
+            _session_factory.configure(bind=engine)
+            _engine = engine
+    return _engine
 
-    Step 1. Check if an entry exists within searches database where query == (current) search_query
-            If such an entry exists: - assign track_ref_bdid if it exists
-                                     - assign False to track_ref_bdid if it doesn't exist
-    Step 2. Create new Search database object and add to current db session.
-    Step 3. Flush and refresh databasesession to confirm insertion by getting a search_id Serial key.
 
-    :param search_session: A sessionmaker Session object created by db_session() function
-    :param search_query: An initial string input from user
-    :return: search_id: A Serial primary key of a newly created entry in searches table
-             track_ref_bdid: A Serial primary key of a Track from tracks table that correspond to an original search_id
-    """
-    query_existed = False
-    try:
-        query_existed = search_session.query(Search).filter(Search.query == search_query).first()
-        query_existed = query_existed.track_id_ref
-    except AttributeError as ve:
-        query_existed = False
-    finally:
-        track_ref_bdid = query_existed
+def _connection(search_session):
+    return search_session.connection() if isinstance(search_session, Session) else search_session
 
-    insert_search = Search(query=search_query)
-    search_session.add(insert_search)
 
-    search_session.flush()
-    search_session.refresh(insert_search)
-    search_session.commit()
-    return insert_search.search_id, track_ref_bdid
+def _create_search_log(engine, month):
+    # Created once per process and database, next months are created ahead by search_log.maintain(). In a transaction
+    # of its own: PostgreSQL would roll a CREATE TABLE back with a failed batch of writes, after it was remembered.
+    table = search_log_table(month)
+    key = (engine.url.render_as_string(), table.name)
+    if key not in _created_search_logs:
+        with engine.begin() as connection:
+            table.create(connection, checkfirst=True)
+        _created_search_logs.add(key)
+    return table
 
 
-def db_update_search(search_session, search_id, track_bdid):
+def db_search_log_tables(search_session, include_legacy=True):
     """
-    Update an entry from searches table to include corresponding track_bdid from tracks table as track_id_ref.
+    :param search_session: A sessionmaker Session object or a Connection.
+    :param include_legacy: Include searches table of older versions, if it was not migrated yet.
+    :return: A list of the existing searches_YYYY_MM Tables, oldest month first.
+    """
+    existing_tables = inspect(_connection(search_session)).get_table_names()
+    tables = [search_log_table(date(int(match.group(1)), int(match.group(2)), 1))
+              for match in sorted(filter(None, map(_search_log_name.match, existing_tables)),
+                                  key=lambda match: match.group(0))]
+    if include_legacy and legacy_searches.name in existing_tables:
+        tables.insert(0, legacy_searches)
+    return tables
+
+
+def db_create_search_logs(search_session, months):
+    """
+    Create the searches_YYYY_MM tables of some months, if missing.
 
     :param search_session: A sessionmaker Session object created by db_session() function.
-    :param search_id: A Serial key of an entry from searches table.
-    :param track_bdid: A Serial key of an entry from track table.
-    :return: True on successful update, False otherwise.
+    :param months: An iterable of dates, any day of each month.
     """
-    try:
-        current_entry = search_session.query(Search).filter(Search.search_id == search_id).first()
+    for month in months:
+        _create_search_log(search_session.get_bind(), month)
 
-        current_entry.track_id_ref = track_bdid
-        search_session.flush()
-        search_session.commit()
-    except Exception as e:
-        return False
-    return True
 
+def _move_legacy_searches(connection, existing_columns):
+    # searches table of older versions held the whole log, copy it month by month into the monthly tables.
+    first, last = connection.execute(select(func.min(legacy_searches.c.created_on),
+                                            func.max(legacy_searches.c.created_on))).one()
+    columns = [column for column in ("created_on", "query", "track_id_ref", "artist_mbid")
+               if column in existing_columns]
+    month = month_start(first) if first is not None else None
+    while month is not None and month <= last.date():
+        table = search_log_table(month)
+        table.create(connection, checkfirst=True)
+        connection.execute(insert(table).from_select(
+            columns, select(*(legacy_searches.c[column] for column in columns))
+            .where(legacy_searches.c.created_on >= month, legacy_searches.c.created_on < next_month(month))
+            .order_by(legacy_searches.c.search_id)))
+        month = next_month(month)
+    legacy_searches.drop(connection)
 
-# Inserting new Track into the 'tracks' table and returning its serial key upon success.
-def db_put_track(search_session, title, artist, album, length):
+
+def db_merge_tracks(search_session, duplicates):
     """
-    Insert new Track into tracks db after successful processing.
-    Step 1. Check if an Entry exists containing the same parameters. Return track_id if such entry exists.
-    Step 2. Create new Track object using function parameters.
-    Step 3. Flush and refresh database session to confirm insertion by getting a track_id Serial key.
+    Replace duplicate tracks by the track they duplicate in searches and query_cache tables, then delete them.
+
+    :param search_session: A sessionmaker Session object or a Connection.
+    :param duplicates: A dict {track_id of a duplicate: track_id of the track kept}.
+    :return: Number of deleted tracks.
+    """
+    if not duplicates:
+        return 0
+    search_logs = db_search_log_tables(search_session)
+    for duplicate_id, kept_id in duplicates.items():
+        for table in search_logs:
+            search_session.execute(table.update().where(table.c.track_id_ref == duplicate_id)
+                                   .values(track_id_ref=kept_id))
+        search_session.execute(CachedResult.__table__.update().where(CachedResult.track_id == duplicate_id)
+                               .values(track_id=kept_id))
+    search_session.execute(delete(Track).where(Track.track_id.in_(list(duplicates))))
+    return len(duplicates)
 
-    :param search_session: A sessionmaker Session object created by db_session() function.
-    :param title: A string containing recording's title.
-    :param artist: A string containing recording's artist.
-    :param album: A string containing recording's album.
-    :param length: A string containing recording's length.
 
-    :return: A Serial key of an existing entry in tracks database
+def _merge_duplicate_tracks(connection):
+    # Older versions could store the same (artist_mbid, title, album) twice, the unique index needs one row each.
+    kept, duplicates = dict(), dict()
+    for track_id, artist_mbid, title, album in connection.execute(
+            select(Track.track_id, Track.artist_mbid, Track.title, Track.album)
+            .where(Track.artist_mbid.isnot(None)).order_by(Track.track_id)):
+        kept_id = kept.setdefault((artist_mbid, title, album), track_id)
+        if kept_id != track_id:
+            duplicates[track_id] = kept_id
+    db_merge_tracks(connection, duplicates)
+
+
+def db_migrate(engine):
+    """
+    Bring tables created by an older version up to date: add missing (nullable) columns and missing indexes, and
+    move searches table into monthly searches_YYYY_MM tables.
+
+    :param engine: An SQLAlchemy Engine
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        if legacy_searches.name in existing_tables:
+            _move_legacy_searches(connection, {column["name"]
+                                               for column in inspector.get_columns(legacy_searches.name)})
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            if table.name == Track.__tablename__ and 'ix_tracks_artist_title_album' not in existing_indexes:
+                _merge_duplicate_tracks(connection)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def db_init():
+    """
+    Create missing tables and columns. Called once on application startup, not per session.
+
+    :return: The shared SQLAlchemy engine
+    """
+    engine = get_engine()
+    # Missing tables first: merging duplicate tracks in db_migrate() updates query_cache table.
+    Base.metadata.create_all(engine)
+    db_migrate(engine)
+    return engine
+
+
+def get_async_engine():
+    """
+    Return the process-wide async engine (asyncpg for PostgreSQL, aiosqlite for SQLite) with the same pool settings.
+
+    :return: An SQLAlchemy AsyncEngine
+    """
+    global _async_engine
+    if _async_engine is not None:
+        return _async_engine
+    with _engine_lock:
+        if _async_engine is None:
+            url = db_url()
+            async_drivers = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+            url = url.set(drivername=async_drivers.get(url.get_backend_name(), url.drivername))
+            if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+                engine = create_async_engine(url, poolclass=StaticPool)
+            else:
+                engine = create_async_engine(url,
+                                             pool_size=db_options.get("pool_size"),
+                                             max_overflow=db_options.get("max_overflow"),
+                                             pool_timeout=db_options.get("pool_timeout"),
+                                             pool_recycle=db_options.get("pool_recycle"),
+                                             pool_pre_ping=db_options.get("pool_pre_ping"))
+            _async_session_factory.configure(bind=engine)
+            _async_engine = engine
+    return _async_engine
+
+
+def db_dispose():
+    """
+    Close every pooled connection and forget the shared engine. Called on application shutdown.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+async def async_db_dispose():
+    """
+    Async counterpart of db_dispose() for the async engine.
+    """
+    global _async_engine
+    engine, _async_engine = _async_engine, None
+    if engine is not None:
+        await engine.dispose()
+
+
+def db_session():
+    """
+    Return a new database session bound to the shared, pooled engine.
+
+    :return: An SQLAlchemy sessionmaker Session object to interact with PostgreSQL database
     """
+    get_engine()
+    return _session_factory()
+
+
+def get_db():
+    """
+    FastAPI dependency handing out one session per request, returned to the pool once the response is sent.
+
+    :return: A generator yielding an SQLAlchemy Session
+    """
+    session = db_session()
     try:
-        existing_track = search_session.query(Track).filter(Track.title == title,
-                                                            Track.album == album).one()
-        return existing_track.track_id
-    except NoResultFound as unique_entry:
-        new_track = Track(title=title,
-                          artist=artist,
-                          album=album,
-                          length=length)
-        search_session.add(new_track)
+        yield session
+    finally:
+        session.close()
+
 
-        search_session.flush()
-        search_session.refresh(new_track)
-    return new_track.track_id
+def async_db_session():
+    """
+    Return a new AsyncSession bound to the shared async engine, for work that outlives a request dependency.
+
+    :return: An SQLAlchemy AsyncSession
+    """
+    get_async_engine()
+    return _async_session_factory()
+
+
+async def get_async_db():
+    """
+    FastAPI dependency handing out one AsyncSession per request.
+
+    The db_* functions below take a synchronous session; call them through AsyncSession.run_sync(), e.g.
+    await session.run_sync(db_get_cached_result, artist_mbid, query_key)
+
+    :return: An async generator yielding an SQLAlchemy AsyncSession
+    """
+    get_async_engine()
+    async with _async_session_factory() as session:
+        yield session
+
+
+def db_pool_metrics() -> dict:
+    """
+    Describe the state of the shared connection pool.
+
+    :return: A dict with pool size, checked-in/checked-out connections, overflow and checkout wait statistics
+    """
+    pool = get_engine().pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({"size": pool.size(),
+                      "checked_in": pool.checkedin(),
+                      "checked_out": pool.checkedout(),
+                      "overflow": max(pool.overflow(), 0),
+                      "max_overflow": db_options.get("max_overflow")})
+    stats.update(pool_stats.as_dict())
+    return stats
 
 
 def db_retrieve_track(search_session, existing_reference_id):
@@ -153,3 +561,598 @@ def db_retrieve_track(search_session, existing_reference_id):
 
     return quick_find.title, quick_find.artist, quick_find.album, quick_find.length
 
+
+def db_reserve_token(search_session, bucket_name, rate, capacity, max_wait, refill):
+    """
+    Take one token from a rate limit bucket shared by every worker connected to the database.
+
+    On PostgreSQL concurrent callers are serialized by a transaction-level advisory lock derived from bucket_name.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param bucket_name: Primary key of the bucket in rate_limit_buckets table.
+    :param rate: Tokens added per second.
+    :param capacity: Maximum number of tokens the bucket holds.
+    :param max_wait: Seconds the caller is ready to wait, no token is taken when it would have to wait longer.
+    :param refill: Function (tokens, updated_on, now, rate, capacity, max_wait) -> (tokens, wait) computing the new
+    state.
+    :return: Seconds the caller has to wait before using its token, more than max_wait when none was taken.
+    """
+    if search_session.get_bind().dialect.name == "postgresql":
+        search_session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": bucket_name})
+    bucket = search_session.get(RateLimitBucket, bucket_name, with_for_update=True)
+    now = time.time()
+    if bucket is None:
+        bucket = RateLimitBucket(name=bucket_name, tokens=capacity, updated_on=now)
+        search_session.add(bucket)
+    bucket.tokens, wait = refill(bucket.tokens, bucket.updated_on, now, rate, capacity, max_wait)
+    bucket.updated_on = now
+    search_session.commit()
+    return wait
+
+
+def db_put_discography(search_session, artist_mbid, artist, release_groups):
+    """
+    Replace stored release groups (and their releases) of an artist with a freshly fetched list.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist the release groups were fetched for.
+    :param artist: Name of the artist.
+    :param release_groups: A list of releases.ReleaseGroupRecord tuples.
+    :return: Number of stored release groups.
+    """
+    fetched_on = datetime.now()
+    stored_ids = select(ReleaseGroup.release_group_id).where(ReleaseGroup.artist_mbid == artist_mbid)
+    search_session.execute(delete(Release).where(Release.release_group_id.in_(stored_ids)))
+    search_session.execute(delete(ReleaseGroup).where(ReleaseGroup.artist_mbid == artist_mbid))
+
+    unique_groups = {release_group.id: release_group for release_group in release_groups}
+    releases = dict()
+    for release_group in unique_groups.values():
+        for release in release_group.releases:
+            releases.setdefault(release.id, {"release_id": release.id, "release_group_id": release_group.id,
+                                             "title": release.title, "status": release.status})
+    if unique_groups:
+        search_session.execute(insert(ReleaseGroup), [{"release_group_id": release_group.id,
+                                                       "artist": artist,
+                                                       "artist_mbid": artist_mbid,
+                                                       "title": release_group.title,
+                                                       "type": release_group.type,
+                                                       "first_release_date": release_group.first_release_date,
+                                                       "fetched_on": fetched_on}
+                                                      for release_group in unique_groups.values()])
+    if releases:
+        search_session.execute(insert(Release), list(releases.values()))
+    search_session.commit()
+    return len(release_groups)
+
+
+def db_put_recordings(search_session, artist_mbid, recordings):
+    """
+    Remember recordings that met the search criteria on a fetched page, keeping the best search score of each.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the recordings' artist.
+    :param recordings: An iterable of (title, title_key, artist, album, length, score) tuples.
+    :return: Number of stored (inserted or updated) recordings.
+    """
+    rows = {(title_key, album): {"artist_mbid": artist_mbid, "title": title, "title_key": title_key,
+                                 "artist": artist, "album": album, "length": length, "score": score,
+                                 "seen_on": datetime.now()}
+            for title, title_key, artist, album, length, score in recordings}
+    if not rows:
+        return 0
+    statement = upsert(search_session, Recording)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Recording.artist_mbid, Recording.title_key, Recording.album],
+        set_={"score": func.max(Recording.score, statement.excluded.score)
+              if search_session.get_bind().dialect.name == "sqlite"
+              else func.greatest(Recording.score, statement.excluded.score),
+              "seen_on": statement.excluded.seen_on})
+    search_session.execute(statement, list(rows.values()))
+    search_session.commit()
+    return len(rows)
+
+
+def db_retrieve_recordings(search_session, artist_mbid):
+    """
+    Load every known recording of an artist: those remembered by db_put_recordings() and the stored tracks.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist.
+    :return: A list of (title, artist, album, length, score) tuples.
+    """
+    recordings = search_session.execute(
+        select(Recording.title, Recording.artist, Recording.album, Recording.length, Recording.score)
+        .where(Recording.artist_mbid == artist_mbid)).all()
+    tracks = search_session.execute(
+        select(Track.title, Track.artist, Track.album, Track.length)
+        .where(Track.artist_mbid == artist_mbid)).all()
+    return [tuple(row) for row in recordings] + [tuple(row) + (100,) for row in tracks]
+
+
+def db_retrieve_discography(search_session, artist_mbid):
+    """
+    Load stored release groups of an artist.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist the release groups were fetched for.
+    :return: release_groups: A list of releases.ReleaseGroupRecord tuples.
+             fetched_on: datetime of the last refresh, None if nothing is stored for this artist.
+    """
+    groups = search_session.execute(
+        select(ReleaseGroup.release_group_id, ReleaseGroup.title, ReleaseGroup.type,
+               ReleaseGroup.first_release_date, ReleaseGroup.fetched_on)
+        .where(ReleaseGroup.artist_mbid == artist_mbid)).all()
+    if not groups:
+        return list(), None
+    releases = dict()
+    for release_id, release_group_id, title, status in search_session.execute(
+            select(Release.release_id, Release.release_group_id, Release.title, Release.status)
+            .join(ReleaseGroup, ReleaseGroup.release_group_id == Release.release_group_id)
+            .where(ReleaseGroup.artist_mbid == artist_mbid)):
+        releases.setdefault(release_group_id, []).append(ReleaseRecord(release_id, intern(title), intern(status)))
+    release_groups = [ReleaseGroupRecord(release_group_id, intern(title), intern(release_group_type),
+                                         first_release_date, tuple(releases.get(release_group_id, ())))
+                      for release_group_id, title, release_group_type, first_release_date, _ in groups]
+    return release_groups, max(group.fetched_on for group in groups)
+
+
+def db_retrieve_artist(search_session, lookup_name):
+    """
+    Find a previously resolved artist by the (lowercased) name users search with.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param lookup_name: Lowercased, stripped artist name.
+    :return: Tuple of strings (artist_mbid, name), None if the name was never resolved.
+    """
+    artist = search_session.query(Artist).filter(Artist.lookup_name == lookup_name).first()
+    if artist is None:
+        return None
+    return artist.artist_mbid, artist.name
+
+
+def db_put_artist(search_session, artist_mbid, name, lookup_name):
+    """
+    Remember which MusicBrainz artist a name resolves to.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist.
+    :param name: Artist name as spelled by MusicBrainz.
+    :param lookup_name: Lowercased, stripped artist name.
+    :return: Tuple of strings (artist_mbid, name)
+    """
+    existing = search_session.query(Artist).filter(Artist.lookup_name == lookup_name).first()
+    if existing is None:
+        search_session.add(Artist(artist_mbid=artist_mbid, name=name, lookup_name=lookup_name))
+    else:
+        existing.artist_mbid, existing.name = artist_mbid, name
+    search_session.commit()
+    return artist_mbid, name
+
+
+def db_claim_legacy_rows(search_session, artist_mbid, artist):
+    """
+    Assign rows stored before multi-artist support (artist_mbid is NULL) to the artist they were searched for.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the default artist.
+    :param artist: Name of the default artist.
+    :return: Number of updated rows.
+    """
+    updated = 0
+    for table in db_search_log_tables(search_session):
+        updated += search_session.execute(table.update().where(table.c.artist_mbid.is_(None))
+                                          .values(artist_mbid=artist_mbid)).rowcount
+    claimed = aliased(Track)
+    db_merge_tracks(search_session, dict(search_session.execute(
+        select(Track.track_id, claimed.track_id)
+        .join(claimed, (claimed.artist_mbid == artist_mbid) & (claimed.title == Track.title) &
+              (claimed.album == Track.album))
+        .where(Track.artist_mbid.is_(None), Track.artist == artist)).all()))
+    updated += search_session.query(Track).filter(Track.artist_mbid.is_(None), Track.artist == artist).update(
+        {Track.artist_mbid: artist_mbid}, synchronize_session=False)
+    already_cached = select(CachedResult.query_key).where(CachedResult.artist_mbid == artist_mbid)
+    search_session.execute(delete(CachedResult).where(CachedResult.artist_mbid.is_(None),
+                                                      CachedResult.query_key.in_(already_cached)))
+    # NULLs never collide in the unique index: keep one unclaimed row per query before they all get artist_mbid.
+    first_unclaimed = select(func.min(CachedResult.cache_id)).where(CachedResult.artist_mbid.is_(None)) \
+        .group_by(CachedResult.query_key)
+    search_session.execute(delete(CachedResult).where(CachedResult.artist_mbid.is_(None),
+                                                      CachedResult.cache_id.notin_(first_unclaimed)))
+    updated += search_session.query(CachedResult).filter(CachedResult.artist_mbid.is_(None)).update(
+        {CachedResult.artist_mbid: artist_mbid}, synchronize_session=False)
+    updated += search_session.query(ReleaseGroup).filter(ReleaseGroup.artist_mbid.is_(None),
+                                                         ReleaseGroup.artist == artist).update(
+        {ReleaseGroup.artist_mbid: artist_mbid}, synchronize_session=False)
+    search_session.commit()
+    return updated
+
+
+def upsert(search_session, model):
+    """
+    Dialect specific INSERT supporting ON CONFLICT clauses (PostgreSQL and SQLite).
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param model: Declarative model class to insert into.
+    :return: An Insert construct with on_conflict_do_nothing() / on_conflict_do_update() methods.
+    """
+    dialect = search_session.get_bind().dialect.name
+    return (postgresql.insert if dialect == "postgresql" else sqlite.insert)(model)
+
+
+def db_get_cached_result(search_session, artist_mbid, query_key):
+    """
+    Look up a cached result of a normalized query with a single read on the unique (artist_mbid, query_key) index.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist the query was restricted to.
+    :param query_key: Normalized query string.
+    :return: None if nothing is cached, otherwise a tuple (track_id, track, expires_on) where track is a
+             (title, artist, album, length) tuple, or None for a negative (no match) entry.
+    """
+    row = search_session.execute(
+        select(CachedResult.track_id, CachedResult.expires_on,
+               Track.title, Track.artist, Track.album, Track.length)
+        .outerjoin(Track, Track.track_id == CachedResult.track_id)
+        .where(CachedResult.artist_mbid == artist_mbid, CachedResult.query_key == query_key)
+    ).first()
+    if row is None:
+        return None
+    track = (row.title, row.artist, row.album, row.length) if row.track_id is not None else None
+    return row.track_id, track, row.expires_on
+
+
+def db_get_cached_results(search_session, artist_mbid, query_keys):
+    """
+    Bulk counterpart of db_get_cached_result(): look many normalized queries up with one IN query.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist the queries were restricted to.
+    :param query_keys: Iterable of normalized query strings.
+    :return: A dict {query_key: (track_id, track, expires_on)} of the cached queries only.
+    """
+    query_keys = list(query_keys)
+    if not query_keys:
+        return dict()
+    rows = search_session.execute(
+        select(CachedResult.query_key, CachedResult.track_id, CachedResult.expires_on,
+               Track.title, Track.artist, Track.album, Track.length)
+        .outerjoin(Track, Track.track_id == CachedResult.track_id)
+        .where(CachedResult.artist_mbid == artist_mbid, CachedResult.query_key.in_(query_keys))
+    ).all()
+    return {row.query_key: (row.track_id,
+                            (row.title, row.artist, row.album, row.length) if row.track_id is not None else None,
+                            row.expires_on)
+            for row in rows}
+
+
+def db_put_cached_result(search_session, artist_mbid, query_key, track_id, expires_on):
+    """
+    Insert or replace the cached result of a normalized query.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist the query was restricted to.
+    :param query_key: Normalized query string.
+    :param track_id: A Serial key of the matching Track, None to cache "no match".
+    :param expires_on: datetime after which the entry is ignored, None to keep it forever.
+    """
+    statement = upsert(search_session, CachedResult).values(artist_mbid=artist_mbid,
+                                                            query_key=query_key,
+                                                            track_id=track_id,
+                                                            created_on=datetime.now(),
+                                                            expires_on=expires_on)
+    statement = statement.on_conflict_do_update(index_elements=[CachedResult.artist_mbid, CachedResult.query_key],
+                                                set_={"track_id": statement.excluded.track_id,
+                                                      "created_on": statement.excluded.created_on,
+                                                      "expires_on": statement.excluded.expires_on})
+    search_session.execute(statement)
+    search_session.commit()
+
+
+def db_put_tracks(search_session, tracks):
+    """
+    Insert tracks with one multi-row INSERT ... ON CONFLICT on the unique (artist_mbid, title, album) index.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param tracks: An iterable of (artist_mbid, (title, artist, album, length)) pairs, duplicates are stored once.
+    :return: A dict {(artist_mbid, title, album): track_id} of the given tracks, whether new or already stored.
+    """
+    rows = {(artist_mbid, title, album): {"artist_mbid": artist_mbid, "title": title, "artist": artist,
+                                          "album": album, "length": length, "created_on": datetime.now()}
+            for artist_mbid, (title, artist, album, length) in tracks}
+    if not rows:
+        return dict()
+    statement = upsert(search_session, Track)
+    # DO UPDATE rather than DO NOTHING so RETURNING also reports the tracks that were already stored.
+    statement = statement.on_conflict_do_update(index_elements=[Track.artist_mbid, Track.title, Track.album],
+                                                set_={"length": statement.excluded.length})
+    stored = search_session.execute(statement.returning(Track.track_id, Track.artist_mbid, Track.title,
+                                                        Track.album, sort_by_parameter_order=True),
+                                    list(rows.values()))
+    return {(row.artist_mbid, row.title, row.album): row.track_id for row in stored}
+
+
+def db_put_writes(search_session, results, searches):
+    """
+    Store a batch of queued writes (see write_behind.py) in one transaction.
+
+    Step 1. Upsert every track referenced by results and searches with one multi-row statement.
+    Step 2. Insert or replace the query_cache entries of results, the last one of a query wins.
+    Step 3. Insert the searches rows, referencing their track, if any.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param results: A list of (artist_mbid, query_key, track, expires_on) tuples, track being a
+                    (title, artist, album, length) tuple or None for "no match".
+    :param searches: A list of (artist_mbid, query, track, created_on) tuples, one per search.
+    :return: Number of stored rows.
+    """
+    # Before the write transaction starts, see _create_search_log().
+    search_logs = {month: _create_search_log(search_session.get_bind(), month)
+                   for month in {month_start(created_on) for _, _, _, created_on in searches}}
+    track_ids = db_put_tracks(search_session, [(artist_mbid, track) for artist_mbid, _, track, _
+                                               in results + searches if track is not None])
+
+    def track_id(artist_mbid, track):
+        return track_ids[(artist_mbid, track[0], track[2])] if track is not None else None
+
+    entries = {(artist_mbid, query_key): {"artist_mbid": artist_mbid,
+                                          "query_key": query_key,
+                                          "track_id": track_id(artist_mbid, track),
+                                          "created_on": datetime.now(),
+                                          "expires_on": expires_on}
+               for artist_mbid, query_key, track, expires_on in results}
+    if entries:
+        statement = upsert(search_session, CachedResult)
+        statement = statement.on_conflict_do_update(index_elements=[CachedResult.artist_mbid,
+                                                                    CachedResult.query_key],
+                                                    set_={"track_id": statement.excluded.track_id,
+                                                          "created_on": statement.excluded.created_on,
+                                                          "expires_on": statement.excluded.expires_on})
+        search_session.execute(statement, list(entries.values()))
+    rows_by_month = dict()
+    for artist_mbid, query, track, created_on in searches:
+        rows_by_month.setdefault(month_start(created_on), []).append({"query": query,
+                                                                      "artist_mbid": artist_mbid,
+                                                                      "track_id_ref": track_id(artist_mbid, track),
+                                                                      "created_on": created_on})
+    for month, rows in rows_by_month.items():
+        search_session.execute(insert(search_logs[month]), rows)
+    search_session.commit()
+    return len(track_ids) + len(entries) + len(searches)
+
+
+def db_retrieve_browsed_releases(search_session, artist_mbid):
+    """
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist.
+    :return: A set of the release IDs of the artist whose recordings were browsed by catalogue.py.
+    """
+    return set(search_session.execute(
+        select(BrowsedRelease.release_id).where(BrowsedRelease.artist_mbid == artist_mbid)).scalars())
+
+
+def db_put_browsed_release(search_session, artist_mbid, release_id, album, recordings, tracks):
+    """
+    Store the tracks found on a browsed release and mark the release as browsed, in one transaction.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist.
+    :param release_id: MusicBrainz ID of the browsed release.
+    :param album: Title of the release.
+    :param recordings: Number of the release's recordings that met the search criteria.
+    :param tracks: An iterable of (title, artist, album, length) tuples to store in tracks table.
+    :return: Number of stored tracks.
+    """
+    stored = db_put_tracks(search_session, [(artist_mbid, track) for track in tracks])
+    statement = upsert(search_session, BrowsedRelease).values(release_id=release_id, artist_mbid=artist_mbid,
+                                                              album=album, recordings=recordings,
+                                                              browsed_on=datetime.now())
+    statement = statement.on_conflict_do_update(index_elements=[BrowsedRelease.release_id],
+                                                set_={"recordings": statement.excluded.recordings,
+                                                      "browsed_on": statement.excluded.browsed_on})
+    search_session.execute(statement)
+    search_session.commit()
+    return len(stored)
+
+
+def db_get_recent_cached_results(search_session, limit):
+    """
+    Load the most recently stored query results that have not expired, to warm a new worker's memory tier.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param limit: Maximum number of entries.
+    :return: A list of ((artist_mbid, query_key), (track_id, track, expires_on)) pairs, most recent first.
+    """
+    rows = search_session.execute(
+        select(CachedResult.artist_mbid, CachedResult.query_key, CachedResult.track_id, CachedResult.expires_on,
+               Track.title, Track.artist, Track.album, Track.length)
+        .outerjoin(Track, Track.track_id == CachedResult.track_id)
+        .where((CachedResult.expires_on.is_(None)) | (CachedResult.expires_on > datetime.now()))
+        .order_by(CachedResult.created_on.desc())
+        .limit(limit)
+    ).all()
+    return [((row.artist_mbid, row.query_key),
+             (row.track_id,
+              (row.title, row.artist, row.album, row.length) if row.track_id is not None else None,
+              row.expires_on))
+            for row in rows]
+
+
+def db_retrieve_recent_artists(search_session, limit):
+    """
+    List the artists whose queries were cached most recently.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param limit: Maximum number of artists.
+    :return: A list of (artist_mbid, name, lookup_name) tuples, most recently searched first.
+    """
+    last_cached = select(CachedResult.artist_mbid, func.max(CachedResult.created_on).label("cached_on")) \
+        .group_by(CachedResult.artist_mbid).subquery()
+    rows = search_session.execute(
+        select(Artist.artist_mbid, Artist.name, Artist.lookup_name)
+        .join(last_cached, last_cached.c.artist_mbid == Artist.artist_mbid)
+        .order_by(last_cached.c.cached_on.desc())
+        .limit(limit)
+    ).all()
+    return [tuple(row) for row in rows]
+
+
+def db_put_cache_event(search_session, kind, artist_mbid, origin, keep_seconds):
+    """
+    Record an invalidation for the other workers sharing the database, and delete events older than keep_seconds.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param kind: What was invalidated, e.g. "query_cache" or "discography".
+    :param artist_mbid: MusicBrainz ID of the artist concerned, None for every artist.
+    :param origin: Identifier of the publishing worker, its own events are skipped when polling.
+    :param keep_seconds: Age after which events are deleted.
+    :return: event_id of the new event.
+    """
+    search_session.execute(delete(CacheEvent).where(
+        CacheEvent.created_on < datetime.now() - timedelta(seconds=keep_seconds)))
+    event = CacheEvent(kind=kind, artist_mbid=artist_mbid, origin=origin)
+    search_session.add(event)
+    search_session.flush()
+    search_session.commit()
+    return event.event_id
+
+
+def db_get_cache_events(search_session, after_event_id):
+    """
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param after_event_id: event_id of the last event already seen.
+    :return: A list of (event_id, kind, artist_mbid, origin) tuples of newer events, oldest first.
+    """
+    rows = search_session.execute(
+        select(CacheEvent.event_id, CacheEvent.kind, CacheEvent.artist_mbid, CacheEvent.origin)
+        .where(CacheEvent.event_id > after_event_id)
+        .order_by(CacheEvent.event_id)
+    ).all()
+    return [tuple(row) for row in rows]
+
+
+def db_last_cache_event(search_session):
+    """
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :return: event_id of the newest event, 0 when there is none.
+    """
+    return search_session.execute(select(func.max(CacheEvent.event_id))).scalar() or 0
+
+
+def db_clear_query_cache(search_session, artist_mbid=None):
+    """
+    Delete cached query results, of one artist or all of them.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param artist_mbid: MusicBrainz ID of the artist whose entries are deleted, None to delete every entry.
+    :return: Number of deleted entries.
+    """
+    statement = delete(CachedResult)
+    if artist_mbid is not None:
+        statement = statement.where(CachedResult.artist_mbid == artist_mbid)
+    deleted = search_session.execute(statement).rowcount
+    search_session.commit()
+    return deleted
+
+
+def db_backfill_query_cache(search_session, normalize):
+    """
+    Fill an empty query_cache table from successful searches stored by versions using searches table as cache.
+
+    Run once before worker processes start; entries already stored (by a concurrent run) are left as they are.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param normalize: Function turning a raw query into its cache key.
+    :return: Number of created cache entries.
+    """
+    if search_session.query(CachedResult.cache_id).first() is not None:
+        return 0
+    search_logs = db_search_log_tables(search_session)
+    if not search_logs:
+        return 0
+    logged = union_all(*(select(table.c.artist_mbid, table.c.query, table.c.track_id_ref, table.c.created_on)
+                         .where(table.c.track_id_ref.isnot(None)) for table in search_logs)).subquery()
+    entries = dict()
+    for artist_mbid, query, track_id, _ in search_session.execute(select(logged).order_by(logged.c.created_on)):
+        entries[(artist_mbid, normalize(query))] = track_id
+    if entries:
+        search_session.execute(upsert(search_session, CachedResult).on_conflict_do_nothing(
+            index_elements=[CachedResult.artist_mbid, CachedResult.query_key]),
+            [{"artist_mbid": artist_mbid, "query_key": query_key, "track_id": track_id, "created_on": datetime.now()}
+             for (artist_mbid, query_key), track_id in entries.items()])
+    search_session.commit()
+    return len(entries)
+
+
+def db_last_rollup_day(search_session):
+    """
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :return: The last day aggregated in search_rollups table, None when there is none.
+    """
+    return search_session.execute(select(func.max(SearchRollup.day))).scalar()
+
+
+def db_first_search_day(search_session):
+    """
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :return: The day of the oldest logged search, None when the log is empty.
+    """
+    for table in db_search_log_tables(search_session, include_legacy=False):
+        first = search_session.execute(select(func.min(table.c.created_on))).scalar()
+        if first is not None:
+            return first.date()
+    return None
+
+
+def db_rollup_searches(search_session, day, normalize):
+    """
+    Aggregate the searches logged on a day into search_rollups table, one row per artist and normalized query with
+    the number of searches and of those that found a track. Rolling up a day again replaces its rows.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param day: A date.
+    :param normalize: Function turning a raw query into its cache key.
+    :return: Number of search_rollups rows of the day.
+    """
+    day_start = datetime.combine(day, datetime.min.time())
+    table = search_log_table(day)
+    rollups = dict()
+    if inspect(_connection(search_session)).has_table(table.name):
+        for artist_mbid, query, searches, hits in search_session.execute(
+                select(table.c.artist_mbid, table.c.query, func.count(), func.count(table.c.track_id_ref))
+                .where(table.c.created_on >= day_start, table.c.created_on < day_start + timedelta(days=1))
+                .group_by(table.c.artist_mbid, table.c.query)):
+            rollup = rollups.setdefault((artist_mbid or "", normalize(query)), [0, 0])
+            rollup[0] += searches
+            rollup[1] += hits
+    search_session.execute(delete(SearchRollup).where(SearchRollup.day == day))
+    if rollups:
+        search_session.execute(insert(SearchRollup), [{"day": day, "artist_mbid": artist_mbid, "query_key": query_key,
+                                                       "searches": searches, "hits": hits}
+                                                      for (artist_mbid, query_key), (searches, hits)
+                                                      in rollups.items()])
+    search_session.commit()
+    return len(rollups)
+
+
+def db_drop_search_logs(search_session, before):
+    """
+    Drop the searches_YYYY_MM tables of the months that ended before a day.
+
+    :param search_session: A sessionmaker Session object created by db_session() function.
+    :param before: A date, only months ending on or before it are dropped.
+    :return: A list of the names of dropped tables.
+    """
+    connection = _connection(search_session)
+    dropped = list()
+    for table in db_search_log_tables(search_session, include_legacy=False):
+        month = date(*map(int, _search_log_name.match(table.name).groups()), 1)
+        if next_month(month) > before:
+            break
+        table.drop(connection)
+        dropped.append(table.name)
+    search_session.commit()
+    with _search_log_lock:
+        for name in dropped:
+            _created_search_logs.discard((search_session.get_bind().url.render_as_string(), name))
+    return dropped
@@ -1,7 +1,27 @@
 
+import json
+import asyncio
+import threading
 import pytest
 from fastapi.testclient import TestClient
-from app import app
+from app import app, search_song, search_song_async
+from fastapi.routing import APIRoute
+from ratelimit import mb_breaker, mb_limiter, mb_call_async, TokenBucket, FileBucketBackend, LocalBucketBackend
+from catalogue import warm_catalogue
+from search_log import maintain
+from recording_filter import Candidate
+from write_behind import write_behind, WriteBehind
+from query_cache import QueryCache, query_cache, normalize_query
+from recording_index import local_index
+from ranking import rank_candidates, candidate_cache
+from search import options
+from musicbrainzngs import musicbrainz as mb_ws
+import mb_client
+from datetime import datetime
+from sql import db_session, db_pool_metrics, _check_do_get, db_claim_legacy_rows, db_put_writes, db_put_cache_event, \
+    search_log_table, CachedResult, CacheEvent
+from cache_sync import CacheSync
+from discography import resolve_artist
 
 """
 Test_main.py contains a test function for loading homepage, and 3 test functions to test functionality of the app.
@@ -28,6 +48,44 @@ tests_204 = ((test_song, 204) for test_song in non_existing_songs)
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    """Run application startup (schema creation) and shutdown (pool disposal) around the module."""
+    with client:
+        yield
+
+
+@pytest.fixture(params=["async", "sync"])
+def search_path(request):
+    """Serve /search with the async implementation or the synchronous one (MB_ASYNC=false), whichever MB_ASYNC is."""
+    routes = app.router.routes
+    index = next(i for i, route in enumerate(routes) if getattr(route, "path", None) == "/search")
+    endpoint = search_song_async if request.param == "async" else search_song
+    route, routes[index] = routes[index], APIRoute("/search", endpoint, methods=["GET"], status_code=200)
+    try:
+        yield request.param
+    finally:
+        routes[index] = route
+
+
+def cached_result(artist_mbid: str, query: str) -> CachedResult:
+    session = db_session()
+    try:
+        return session.query(CachedResult).filter(CachedResult.artist_mbid == artist_mbid,
+                                                  CachedResult.query_key == normalize_query(query)).one_or_none()
+    finally:
+        session.close()
+
+
+def logged_searches(query: str) -> list:
+    session = db_session()
+    try:
+        table = search_log_table(datetime.now())
+        return session.execute(table.select().where(table.c.query == query)).all()
+    finally:
+        session.close()
+
+
 def test_load_main():
     response = client.get("/")
 
@@ -35,6 +93,21 @@ def test_load_main():
     assert response.json() == {"homepage": True}
 
 
+def test_db_pool_metrics():
+    response = client.get("/metrics/db")
+
+    assert response.status_code == 200
+    assert {"checked_out", "overflow", "wait_seconds_total"} <= response.json().keys()
+
+
+def test_prometheus_metrics():
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE mb_search_stage_seconds histogram" in response.text
+
+
 @pytest.mark.parametrize("test_input, x_status", tests_201)
 def test_lookup_new_song(test_input, x_status):
     response = client.get(f"/search?title={test_input}")
@@ -54,3 +127,310 @@ def test_lookup_quick_find(test_input, x_status):
     response = client.get(f"/search?title={test_input}")
 
     assert response.status_code == x_status
+
+
+def test_unknown_artist():
+    first = client.get("/search?title=Demons&artist=No Such Artist Anywhere")
+    acquired = mb_limiter.acquired
+    second = client.get("/search?title=Demons&artist=no such artist anywhere ")
+
+    assert first.status_code == second.status_code == 204
+    assert mb_limiter.acquired == acquired
+
+
+def test_lookup_batch():
+    response = client.post("/search/batch", json={"titles": existing_songs + non_existing_songs})
+    statuses = {line["title"]: line["status"] for line in map(json.loads, response.text.splitlines())}
+
+    assert response.status_code == 200
+    assert statuses == {**dict.fromkeys(existing_songs, 200), **dict.fromkeys(non_existing_songs, 204)}
+
+
+def test_write_behind():
+    write_behind.flush()
+    searched = len(logged_searches(existing_songs[2]))
+    response = client.get(f"/search?title={existing_songs[2]}")
+    write_behind.flush()
+    artist_mbid, _ = resolve_artist(options.get("artist"))
+
+    assert response.status_code == 200
+    assert len(logged_searches(existing_songs[2])) == searched + 1
+    assert cached_result(artist_mbid, existing_songs[2]).track_id is not None
+    assert write_behind.stats()["dropped"] == write_behind.stats()["failed"] == 0
+
+
+def test_cache_sync():
+    class OtherWorker(CacheSync):
+        origin = "other-host:1"
+
+    artist_mbid, _ = resolve_artist(options.get("artist"))
+    other_cache, other_sync = QueryCache(memory_entries=100), OtherWorker(interval=0, event_ttl=60)
+    other_sync.subscribe("query_cache", other_cache.forget)
+    other_sync.poll()
+    session = db_session()
+    try:
+        cached = other_cache.get(session, artist_mbid, existing_songs[2])
+        other_cache.memory.put(("cleared-artist", normalize_query(existing_songs[2])), cached)
+        query_cache.clear(session, "cleared-artist")
+        other_sync.poll()
+    finally:
+        session.close()
+
+    assert cached is not None and cached[1] is not None
+    assert list(other_cache.memory.keys()) == [(artist_mbid, normalize_query(existing_songs[2]))]
+
+
+def test_conditional_search():
+    response = client.get(f"/search?title={existing_songs[1]}")
+    revalidated = client.get(f"/search?title={existing_songs[1]}", headers={"If-None-Match": response.headers["etag"]})
+
+    assert response.status_code == 200
+    assert "max-age=" in response.headers["cache-control"]
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    assert revalidated.headers["etag"] == response.headers["etag"]
+
+
+def test_circuit_open():
+    mb_breaker.trip()
+    try:
+        unavailable = client.get("/search?title=Circuit Breaker Test")
+        cached = client.get(f"/search?title={existing_songs[0]}")
+    finally:
+        mb_breaker.reset()
+
+    assert unavailable.status_code == 503
+    assert int(unavailable.headers["retry-after"]) >= 1
+    assert cached.status_code == 200
+
+
+def test_rate_limit_max_wait(monkeypatch):
+    client.get(f"/search?title={existing_songs[0]}")  # The artist is resolved before the bucket runs dry.
+    monkeypatch.setattr(mb_limiter, "rate", 0.01)
+    monkeypatch.setattr(mb_limiter, "backend", LocalBucketBackend(0))
+    refused = mb_limiter.refused
+    unavailable = client.get("/search?title=Rate Limit Test")
+    cached = client.get(f"/search?title={existing_songs[0]}")
+
+    assert unavailable.status_code == 503
+    assert int(unavailable.headers["retry-after"]) > mb_limiter.max_wait
+    assert cached.status_code == 200
+    assert mb_limiter.refused == refused + 1
+    assert mb_limiter.backend._tokens >= 0
+    assert mb_breaker.stats()["state"] == "closed"
+
+
+def test_batch_circuit_open():
+    titles = ["Circuit Breaker Batch 1", "Circuit Breaker Batch 2", "Circuit Breaker Batch 3"]
+    client.get(f"/search?title={existing_songs[0]}")  # The artist is resolved before MusicBrainz goes away.
+    mb_breaker.trip()
+    rejected = mb_breaker.stats()["rejected"]
+    try:
+        response = client.post("/search/batch", json={"titles": titles})
+        calls = mb_breaker.stats()["rejected"] - rejected
+    finally:
+        mb_breaker.reset()
+    lines = list(map(json.loads, response.text.splitlines()))
+
+    assert [line["status"] for line in lines] == [503] * len(titles)
+    assert calls == 1
+
+
+def test_bounded_safe_read():
+    assert mb_ws._safe_read is mb_client._bounded_safe_read
+    assert mb_client._check_safe_read(mb_client._musicbrainzngs_safe_read) is mb_client._musicbrainzngs_safe_read
+    with pytest.raises(ImportError):
+        mb_client._check_safe_read(None)
+    with pytest.raises(ImportError):
+        mb_client._check_safe_read(lambda opener, req, body=None: None)
+
+
+def test_half_open_probe_cancelled(monkeypatch):
+    async def wait_forever():
+        await asyncio.Event().wait()
+
+    async def probe_cancelled_while_waiting_for_a_token():
+        probe = asyncio.ensure_future(mb_call_async(asyncio.sleep, 0))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    monkeypatch.setattr(mb_breaker, "reset_timeout", 0)
+    monkeypatch.setattr(mb_limiter, "acquire_async", wait_forever)
+    mb_breaker.trip()
+    try:
+        asyncio.run(probe_cancelled_while_waiting_for_a_token())
+        # The next call is let through as the new probe instead of being rejected with CircuitOpen.
+        mb_breaker.before_call()
+    finally:
+        mb_breaker.reset()
+
+    assert mb_breaker.stats()["state"] == "closed"
+
+
+def test_catalogue_warmup():
+    report = warm_catalogue()
+
+    assert report["complete"]
+    assert report["answerable"] >= report["answerable_before"]
+    assert warm_catalogue()["browsed"] == 0
+
+
+def test_search_log_rollup():
+    write_behind.flush()
+    report = maintain()
+
+    assert sum(report["rolled_up"].values()) > 0
+    assert report["dropped"] == []
+
+
+def test_ranking():
+    positions = {"Night Visions": 0, "Evolve": 1, "Origins": 2}
+    ranked = rank_candidates([Candidate("Believer (Kaskade remix)", "Imagine Dragons", "Evolve", "03:24", 100, 0),
+                              Candidate("Believer", "Imagine Dragons", "Origins", "03:24", 90, 1),
+                              Candidate("Believer", "Imagine Dragons", "Evolve", "03:24", 90, 2)],
+                             "believer", positions)
+
+    assert [scored.candidate.position for scored in ranked] == [2, 1, 0]
+    assert ranked[0].confidence > 0.9
+
+
+def test_claim_duplicate_legacy_results():
+    artist_mbid, artist = resolve_artist("Imagine Dragons")
+    session = db_session()
+    try:
+        session.add_all([CachedResult(artist_mbid=None, query_key="legacy duplicate"),
+                         CachedResult(artist_mbid=None, query_key="legacy duplicate")])
+        session.commit()
+        db_claim_legacy_rows(session, artist_mbid, artist)
+        claimed = session.query(CachedResult.artist_mbid).filter(CachedResult.query_key == "legacy duplicate").all()
+    finally:
+        session.close()
+
+    assert claimed == [(artist_mbid,)]
+
+
+def test_search_log_failed_batch():
+    logged_on = datetime(2031, 1, 15)
+    session = db_session()
+    try:
+        with pytest.raises(Exception):
+            db_put_writes(session, [(None, "failed batch", ("Failed Batch", "Nobody", "Nothing", "00:01"), None)],
+                          [(None, None, None, logged_on)])
+        session.rollback()
+        db_put_writes(session, [], [(None, "After a failed batch", None, logged_on)])
+        logged = session.execute(search_log_table(logged_on).select()).all()
+    finally:
+        session.close()
+
+    assert [row.query for row in logged] == ["After a failed batch"]
+
+
+def test_cache_sync_late_commit():
+    sync, applied = CacheSync(interval=0, event_ttl=60), []
+    sync.subscribe("late commit", applied.append)
+    sync.poll()
+    session = db_session()
+    try:
+        event_ids = [db_put_cache_event(session, "late commit", artist_mbid, "other:1", 60)
+                     for artist_mbid in ("first", "late", "third")]
+        # Not committed yet when the next poll runs.
+        session.query(CacheEvent).filter(CacheEvent.event_id == event_ids[1]).delete()
+        session.commit()
+        sync.poll()
+        session.add(CacheEvent(event_id=event_ids[1], kind="late commit", artist_mbid="late", origin="other:1"))
+        session.commit()
+        sync.poll()
+        sync.poll()
+    finally:
+        session.close()
+
+    assert applied == ["first", "third", "late"]
+    assert not sync.gaps
+
+
+def test_file_bucket_off_event_loop(tmp_path):
+    class RecordingBackend(FileBucketBackend):
+        def reserve(self, rate, capacity, max_wait):
+            threads.append(threading.current_thread())
+            return super().reserve(rate, capacity, max_wait)
+
+    threads = []
+    bucket = TokenBucket(rate=1000, burst=2, backend=RecordingBackend(str(tmp_path / "bucket"), 2))
+    asyncio.run(bucket.acquire_async())
+
+    assert threads and threads[0] is not threading.main_thread()
+    assert (tmp_path / "bucket").read_text().split()[0] == "1.0"
+
+
+def test_metered_pool():
+    class ChangedPool:
+        def _do_get(self, timeout):
+            pass
+
+    with pytest.raises(ImportError):
+        _check_do_get(object)
+    with pytest.raises(ImportError):
+        _check_do_get(ChangedPool)
+    assert db_pool_metrics()["wait_count"] > 0
+
+
+def test_write_behind_retry(monkeypatch):
+    def fail_once(session, results, searches):
+        calls.append(len(searches))
+        if len(calls) == 1:
+            raise RuntimeError("The database went away")
+        db_put_writes(session, results, searches)
+
+    calls = []
+    monkeypatch.setattr("write_behind.db_put_writes", fail_once)
+    writer = WriteBehind(queue_size=10, batch_size=10, interval=60, retries=1, retry_delay=0)
+    writer.put_search(None, "Write Behind Retry")
+    writer.flush()
+    retrying = writer.stats()["retrying"]
+    writer.flush()
+    writer.stop()
+
+    assert retrying == 1 and calls == [1, 1]
+    assert len(logged_searches("Write Behind Retry")) == 1
+    assert writer.stats()["failed"] == writer.stats()["retrying"] == 0
+
+
+def test_write_behind_disabled(monkeypatch):
+    def record_thread(session, results, searches):
+        threads.append(threading.current_thread())
+        db_put_writes(session, results, searches)
+
+    async def search():
+        writer.put_search(None, "Write Behind Disabled")
+        await asyncio.gather(*writer._tasks)
+
+    threads = []
+    monkeypatch.setattr("write_behind.db_put_writes", record_thread)
+    writer = WriteBehind(queue_size=10, batch_size=10, interval=60, enabled=False)
+    asyncio.run(search())
+
+    assert threads and threads[0] is not threading.main_thread()
+    assert len(logged_searches("Write Behind Disabled")) == 1
+
+
+def test_search_paths(search_path, monkeypatch):
+    found, missing = existing_songs[-1], non_existing_songs[-1]
+    artist_mbid, _ = resolve_artist(options.get("artist"))
+    monkeypatch.setattr(local_index, "enabled", False)
+    session = db_session()
+    try:
+        query_cache.clear(session, artist_mbid)
+    finally:
+        session.close()
+    candidate_cache.clear()
+    acquired = mb_limiter.acquired
+    responses = [client.get(f"/search?title={title}") for title in (found, missing)]
+    write_behind.flush()
+
+    assert [response.status_code for response in responses] == [201, 204]
+    assert responses[0].json()[found].casefold().startswith(f"{found}, imagine dragons, ".casefold())
+    assert mb_limiter.acquired > acquired
+    assert cached_result(artist_mbid, found).track_id is not None
+    assert cached_result(artist_mbid, missing).track_id is None
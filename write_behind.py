@@ -0,0 +1,252 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Tuple
+from sql import db_session, db_put_writes
+from metrics import metrics
+
+"""
+Write-behind queue for the rows a search leaves behind: its searches (log) row, the track it found and its
+query_cache entry.
+
+Requests only enqueue these rows (put_search(), put_result()) and return; a background thread writes them in
+batches, one transaction of multi-row INSERT ... ON CONFLICT statements per batch (sql.db_put_writes). A batch is
+written once MB_WRITE_BATCH rows are queued or MB_WRITE_INTERVAL seconds after the previous one, whichever comes
+first, and whatever is left is written on application shutdown (stop()). The queue holds at most MB_WRITE_QUEUE_SIZE
+rows: when the database can not keep up, new rows are dropped and counted instead of slowing requests down. Results
+are already in the memory tier of the query cache, so a dropped row only loses history or persistence.
+A batch that fails is written again up to MB_WRITE_RETRIES times (default 3), MB_WRITE_RETRY_DELAY seconds later
+(default 1, doubling every time), before its rows are dropped and counted as failed.
+MB_WRITE_BEHIND=false writes every row when it is put instead: in the calling thread, or in a worker thread
+(asyncio.to_thread) when called from the event loop.
+"""
+
+write_behind_options = {
+    "enabled": os.environ.get("MB_WRITE_BEHIND", "true").lower() in ("1", "true", "yes"),
+    "queue_size": int(os.environ.get("MB_WRITE_QUEUE_SIZE", 10000)),
+    "batch_size": int(os.environ.get("MB_WRITE_BATCH", 500)),
+    "interval": float(os.environ.get("MB_WRITE_INTERVAL", 0.5)),
+    "retries": int(os.environ.get("MB_WRITE_RETRIES", 3)),
+    "retry_delay": float(os.environ.get("MB_WRITE_RETRY_DELAY", 1.0))
+}
+
+logger = logging.getLogger(__name__)
+
+Track = Tuple[str, str, str, str]
+
+
+class WriteBehind:
+    """
+    Bounded queue of pending rows with one background writer thread, started on first use.
+    """
+    def __init__(self, queue_size: int, batch_size: int, interval: float, enabled: bool = True,
+                 retries: int = write_behind_options.get("retries"),
+                 retry_delay: float = write_behind_options.get("retry_delay")):
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.retries = max(retries, 0)
+        self.retry_delay = retry_delay
+        # Failed batches waiting for their next attempt, [(due on, attempts made, rows)], guarded by _write_lock.
+        self._retrying = list()
+        self._tasks = set()
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "retried": 0, "batches": 0}
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def put_search(self, artist_mbid: str, query: str, track: Optional[Track] = None) -> bool:
+        """
+        Log one search in the searches log (searches_YYYY_MM table of the month).
+
+        :param artist_mbid: MusicBrainz ID of the artist the search was restricted to
+        :param query: User's input query
+        :param track: Tuple of strings (Title, Artist, Album, Length) answering the search, None if nothing did
+        :return: False if the row was dropped
+        """
+        return self._put(("search", (artist_mbid, query, track, datetime.now())))
+
+    def put_result(self, artist_mbid: str, query_key: str, track: Optional[Track], expires_on: datetime) -> bool:
+        """
+        Store the track found for a normalized query (if any) and its query_cache entry.
+
+        :param artist_mbid: MusicBrainz ID of the artist the query was restricted to
+        :param query_key: Normalized query string
+        :param track: Tuple of strings (Title, Artist, Album, Length), None to cache "no match"
+        :param expires_on: datetime after which the entry is ignored, None to keep it forever
+        :return: False if the row was dropped
+        """
+        return self._put(("result", (artist_mbid, query_key, track, expires_on)))
+
+    def _put(self, row: tuple) -> bool:
+        if not self.enabled:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                self._write_now([row])
+            else:
+                task = asyncio.ensure_future(asyncio.to_thread(self._write_now, [row]))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return True
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("queued")
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _ensure_started(self):
+        # A forked worker does not inherit the writer thread of its parent, is_alive() is False there.
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _drain(self, limit: int) -> list:
+        rows = list()
+        while len(rows) < limit:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows: list) -> bool:
+        """
+        :return: True when the rows were written, False when the batch failed and was rolled back
+        """
+        results = [row for kind, row in rows if kind == "result"]
+        searches = [row for kind, row in rows if kind == "search"]
+        session = db_session()
+        try:
+            with metrics.stage("write_behind"):
+                db_put_writes(session, results, searches)
+            self._count("written", len(rows))
+            self._count("batches")
+            return True
+        except Exception as e:
+            logger.warning("Writing %d queued rows failed", len(rows), exc_info=True)
+            session.rollback()
+            return False
+        finally:
+            session.close()
+
+    def _backoff(self, attempts: int) -> float:
+        return self.retry_delay * 2 ** (attempts - 1)
+
+    def _drop(self, rows: list, attempts: int):
+        self._count("failed", len(rows))
+        logger.error("Dropped %d queued rows after %d failed attempts", len(rows), attempts)
+
+    def _write_now(self, rows: list):
+        """
+        Write rows at once, retrying in the calling thread (MB_WRITE_BEHIND=false).
+        """
+        for attempts in range(1, self.retries + 2):
+            if self._write(rows):
+                return
+            if attempts <= self.retries:
+                self._count("retried", len(rows))
+                time.sleep(self._backoff(attempts))
+        self._drop(rows, self.retries + 1)
+
+    def _write_batch(self, rows: list, attempts: int = 0):
+        """
+        Write a batch, and keep it for a later attempt when it fails, until it was attempted 1 + retries times.
+        """
+        if self._write(rows):
+            return
+        attempts += 1
+        if attempts > self.retries:
+            self._drop(rows, attempts)
+            return
+        self._count("retried", len(rows))
+        self._retrying.append((time.monotonic() + self._backoff(attempts), attempts, rows))
+
+    def _retry_due(self):
+        now = time.monotonic()
+        due = [batch for batch in self._retrying if batch[0] <= now]
+        self._retrying = [batch for batch in self._retrying if batch[0] > now]
+        for _, attempts, rows in due:
+            self._write_batch(rows, attempts)
+
+    def flush(self) -> int:
+        """
+        Write the failed batches due for another attempt, then the rows queued so far, in batches of at most
+        MB_WRITE_BATCH rows. Rows queued meanwhile are left for the next flush, draining until the queue is empty
+        would write a stream of tiny batches under steady traffic.
+
+        :return: Number of rows taken from the queue
+        """
+        taken = 0
+        with self._write_lock:
+            self._retry_due()
+            pending = self._queue.qsize()
+            while taken < pending:
+                rows = self._drain(min(self.batch_size, pending - taken))
+                if not rows:
+                    break
+                taken += len(rows)
+                self._write_batch(rows)
+        return taken
+
+    def stop(self):
+        """
+        Stop the writer thread and write what is left in the queue, failed batches get one last attempt whether they
+        are due or not. Called on application shutdown.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            retrying, self._retrying = self._retrying, list()
+            for _, attempts, rows in retrying:
+                if not self._write(rows):
+                    self._drop(rows, attempts + 1)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters.update({"depth": self.depth(), "queue_size": self.queue_size,
+                         "retrying": sum(len(rows) for _, _, rows in list(self._retrying))})
+        return counters
+
+
+write_behind = WriteBehind(queue_size=write_behind_options.get("queue_size"),
+                           batch_size=write_behind_options.get("batch_size"),
+                           interval=write_behind_options.get("interval"),
+                           enabled=write_behind_options.get("enabled"),
+                           retries=write_behind_options.get("retries"),
+                           retry_delay=write_behind_options.get("retry_delay"))